@@ -0,0 +1,719 @@
+# benchmark.py
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+import paho.mqtt.client as mqtt
+from django.core.management.base import BaseCommand
+from ...mqtt.dispatcher import DeviceDispatcher, BACKGROUND
+from ...mqtt.async_engine import AsyncioEngine
+from ...mqtt.cluster import ClusterMembership
+from ...mqtt.admission import AdmissionController
+from ...mqtt.transport import InMemoryTransport
+from ...mqtt import codec
+
+'''
+Sample payloads sized like the real traffic
+'''
+def sample_volley(device_id):
+    return json.dumps({ 'command': 'continue', 'backend': 'router', 'event_id': str(uuid.uuid4()),
+                        'module_id': 'OPENMOXIE_CHAT', 'content_id': 'default',
+                        'speech': 'tell me something interesting about octopuses please',
+                        'extra_lines': [], 'recommend': { 'exits': [] } }).encode('utf-8')
+
+def print_result(out, name, count, elapsed):
+    out.write(f'{name:32} {count:8} msgs {elapsed:8.3f}s {count/elapsed:10.1f} msg/s')
+
+'''
+INGRESS - Threaded dispatcher lanes vs the asyncio engine for volleys that block on inference
+'''
+class _StubVolleyHandler:
+    def __init__(self, latency, engine=None, native=False):
+        self._latency = latency
+        self._engine = engine
+        self._native = native
+
+    def handle(self, payload):
+        rcr = json.loads(payload)
+        time.sleep(self._latency)
+        return rcr['event_id']
+
+    async def handle_async(self, payload):
+        rcr = json.loads(payload)
+        if self._native:
+            await asyncio.sleep(self._latency)
+        else:
+            await self._engine.run_ai(time.sleep, self._latency)
+        return rcr['event_id']
+
+def bench_ingress(options, out):
+    devices = [ f'd_{uuid.uuid4()}' for _ in range(options['devices']) ]
+    payloads = [ (devices[i % len(devices)], sample_volley(devices[i % len(devices)])) for i in range(options['messages']) ]
+    latency = options['latency']
+
+    def run(name, dispatcher, handler):
+        start = time.perf_counter()
+        futures = [ dispatcher.submit(device_id, handler.handle, payload) for device_id, payload in payloads ]
+        for f in futures:
+            f.result()
+        print_result(out, name, len(futures), time.perf_counter() - start)
+        dispatcher.shutdown()
+
+    run('threaded', DeviceDispatcher({ 'interactive': options['lanes'] }), _StubVolleyHandler(latency))
+    engine = AsyncioEngine(None, { 'ai_workers': options['ai_workers'] })
+    engine.start()
+    run('asyncio (executor inference)', engine, _StubVolleyHandler(latency, engine))
+    engine = AsyncioEngine(None, { 'ai_workers': options['ai_workers'] })
+    engine.start()
+    run('asyncio (native inference)', engine, _StubVolleyHandler(latency, engine, native=True))
+
+'''
+CLUSTER - Overhead of splitting devices by hash ring over 1..N processes, needs a local broker
+
+Workers run ClusterMembership on a bare MQTT client and stand in for a volley with --work-ms
+of busy work, they don't run MoxieServer.  The numbers show ring ownership checks and broker
+fan-out to every worker, not the throughput of a cluster of real mqtt_workers.
+'''
+_BENCH_TOPIC = 'openmoxie/bench'
+
+# Busy work holding the GIL, like decoding and rendering a volley
+def _spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def _cluster_bench_worker(host, port, group, worker_id, work):
+    client = mqtt.Client(client_id=f'bench-{worker_id}')
+    membership = ClusterMembership(client, { 'group': group }, worker_id)
+    members_prefix = membership.members_filter()[:-1]
+    state = { 'processed': 0, 'running': True }
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(f'{_BENCH_TOPIC}/{group}/devices/+/events/+')
+        client.subscribe(f'{_BENCH_TOPIC}/{group}/stop')
+        membership.join()
+
+    def on_message(client, userdata, msg):
+        if msg.topic.startswith(members_prefix):
+            membership.on_member_message(msg.topic[len(members_prefix):], msg.payload)
+        elif msg.topic.endswith('/stop'):
+            state['running'] = False
+        elif membership.owns(msg.topic.split('/')[4]):
+            json.loads(msg.payload)
+            _spin(work)
+            state['processed'] += 1
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port, 60)
+    client.loop_start()
+    while state['running']:
+        client.publish(f'{_BENCH_TOPIC}/{group}/status/{worker_id}',
+                       json.dumps({ 'members': len(membership.members()), 'processed': state['processed'] }))
+        time.sleep(0.1)
+    membership.leave()
+    client.disconnect()
+    client.loop_stop()
+
+def bench_cluster(options, out):
+    host, port = options['host'], options['port']
+    devices = [ f'd_{uuid.uuid4()}' for _ in range(options['devices']) ]
+    status = {}
+    client = mqtt.Client(client_id=f'bench-driver-{uuid.uuid4()}')
+    client.on_message = lambda client, userdata, msg: status.__setitem__(msg.topic, json.loads(msg.payload))
+    client.connect(host, port, 60)
+    client.loop_start()
+
+    def wait_for(check, timeout):
+        end = time.perf_counter() + timeout
+        while not check():
+            if time.perf_counter() > end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    baseline = None
+    for workers in [ int(w) for w in options['workers'].split(',') ]:
+        group = f'bench-{uuid.uuid4().hex[:8]}'
+        status.clear()
+        client.subscribe(f'{_BENCH_TOPIC}/{group}/status/+')
+        procs = [ multiprocessing.Process(target=_cluster_bench_worker, args=(host, port, group, f'w{i}', options['work_ms'] / 1000.0))
+                  for i in range(workers) ]
+        for p in procs:
+            p.start()
+        if not wait_for(lambda: len(status) == workers and all(s['members'] == workers for s in status.values()), 30):
+            out.write(f'{workers} workers failed to form a cluster, is a broker running on {host}:{port}?')
+        else:
+            start = time.perf_counter()
+            for i in range(options['messages']):
+                device_id = devices[i % len(devices)]
+                client.publish(f'{_BENCH_TOPIC}/{group}/devices/{device_id}/events/remote-chat', sample_volley(device_id))
+            done = wait_for(lambda: sum(s['processed'] for s in status.values()) >= options['messages'], 300)
+            elapsed = time.perf_counter() - start
+            processed = sum(s['processed'] for s in status.values())
+            baseline = baseline or processed / elapsed
+            print_result(out, f'{workers} workers{"" if done else " (TIMEOUT)"}', processed, elapsed)
+            out.write(f'{"":32} speedup {processed / elapsed / baseline:5.2f}x  per worker {[ s["processed"] for s in status.values() ]}')
+        client.publish(f'{_BENCH_TOPIC}/{group}/stop', '')
+        for p in procs:
+            p.join(10)
+        client.unsubscribe(f'{_BENCH_TOPIC}/{group}/status/+')
+    client.loop_stop()
+    client.disconnect()
+
+'''
+ADMISSION - Interactive latency during a state/log storm, with and without load shedding
+'''
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+def bench_admission(options, out):
+    devices = [ f'd_{uuid.uuid4()}' for _ in range(options['devices']) ]
+    state = json.dumps({ 'battery_level': 50, 'charging': False, 'wifi_strength': 70 }).encode('utf-8')
+    ingest_delay = options['ingest_ms'] / 1000.0
+
+    def ingest(device_id, statedata):
+        time.sleep(ingest_delay)
+
+    def volley(submitted):
+        time.sleep(0.005)
+        return time.perf_counter() - submitted
+
+    def run(name, shedding):
+        # the baseline never refuses work, however deep its queues get
+        dispatcher = DeviceDispatcher({ 'interactive': options['lanes'], 'background': 2 },
+                                      None if shedding else { BACKGROUND: options['messages'] })
+        admission = AdmissionController(dispatcher, { 'background_high': options['background_high'] })
+        latencies = []
+        max_depth = 0
+        start = time.perf_counter()
+        for i in range(options['messages']):
+            device_id = devices[i % len(devices)]
+            if shedding:
+                admission.submit_latest('state', device_id, ingest, state, decoder=json.loads)
+            else:
+                dispatcher.submit(device_id, ingest, device_id, json.loads(state), work_class=BACKGROUND)
+            if admission.admit('device-logs'):
+                json.loads(state)
+            if i % options['volley_every'] == 0:
+                latencies.append(dispatcher.submit(device_id, volley, time.perf_counter()))
+                max_depth = max(max_depth, dispatcher.class_depths()[BACKGROUND])
+                # pace the storm at --rate messages per second
+                time.sleep(max(0.0, start + (i + 1) / options['rate'] - time.perf_counter()))
+        latencies = [ f.result() * 1000 for f in latencies ]
+        dispatcher.shutdown()
+        drain = time.perf_counter() - start
+        out.write(f'{name:16} volley p50 {percentile(latencies, 50):7.1f}ms p99 {percentile(latencies, 99):7.1f}ms  '
+                  f'max background queue {max_depth:6}  drained in {drain:6.2f}s')
+        if shedding:
+            out.write(f'{"":16} {admission.metrics()} lanes shed {dispatcher.metrics()[BACKGROUND]["shed"]}')
+
+    run('unbounded', False)
+    run('admission', True)
+
+'''
+DISPATCH - MoxieServer.on_message hot path over the in-memory transport, no broker needed
+'''
+def dispatch_samples(device_id, offline_id):
+    return {
+        'notify': (f'/devices/{device_id}/events/remote-chat', json.dumps({ 'command': 'notify', 'backend': 'router',
+                    'event_id': str(uuid.uuid4()), 'module_id': 'ONBOARD', 'content_id': 'default', 'speech': 'Hello there!' })),
+        'device-logs': (f'/devices/{device_id}/events/device-logs', json.dumps({ 'tag': 'brain', 'message': 'behavior tree tick complete' })),
+        'telehealth': (f'/devices/{device_id}/events/client-service-activity-log', json.dumps({ 'subtopic': 'telehealth',
+                       'message': { 'state': { 'mode': 'idle' } } })),
+        'sys-log': ('$SYS/broker/log/N', f'Client {offline_id} closed its connection.'),
+        'sys-log-other': ('$SYS/broker/log/N', 'New connection from 10.0.0.12:51234 on port 8883.'),
+        'sys-clients': ('$SYS/broker/clients/connected', '42'),
+        'state': (f'/devices/{device_id}/state', json.dumps({ 'battery_level': 50, 'charging': False })),
+    }
+
+def bench_dispatch(options, out):
+    from ...mqtt.moxie_server import MoxieServer
+    from ...mqtt.robot_credentials import RobotCredentials
+    from ...mqtt.robot_data import RobotData
+    # handler logging would dominate the measurement
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    transport = InMemoryTransport()
+    server = MoxieServer(RobotCredentials(True), RobotData(), 'openmoxie', 'localhost', 1883, transport=transport)
+    server.connect(start=True)
+    devices = [ f'd_{uuid.uuid4()}' for _ in range(options['devices']) ]
+    offline = [ f'd_{uuid.uuid4()}' for _ in range(options['devices']) ]
+    registry = server.robot_data().registry()
+    for device_id in devices:
+        # already connected and loaded, so messages take the steady state path
+        rec, _ = registry.begin_connect(device_id)
+        registry.mark_loaded(rec)
+    for kind in options['kinds'].split(','):
+        messages = []
+        for i in range(options['messages']):
+            topic, payload = dispatch_samples(devices[i % len(devices)], offline[i % len(offline)])[kind]
+            messages.append(transport.make_message(topic, payload))
+        start = time.perf_counter()
+        transport.inject_many(messages)
+        print_result(out, kind, len(messages), time.perf_counter() - start)
+    out.write(f'Routes: {server.route_counters()}')
+    server.stop()
+    server.publisher().stop()
+    server.dispatcher().shutdown()
+
+'''
+CODEC - JSON encode/decode of real sized payloads, the old str path vs each codec backend
+'''
+def codec_samples(mbh_count):
+    from ...mqtt.robot_data import RobotData, DEFAULT_ROBOT_CONFIG, DEFAULT_ROBOT_SETTINGS
+    device = type('Device', (), { 'robot_config': { 'child_pii': { 'nickname': 'Sam', 'input_speed': 0.5 }, 'audio_volume': '0.4',
+                                                    'screen_brightness': '0.8', 'wake_button_enabled': True },
+                                  'robot_settings': { 'props': { 'default_loglevel': 'info', 'doa_range': '70' } } })()
+    hive_cfg = type('Hive', (), { 'common_config': DEFAULT_ROBOT_CONFIG, 'common_settings': DEFAULT_ROBOT_SETTINGS })()
+    config = RobotData.build_config(device, hive_cfg)
+    modules = [ ('WELCOME', None), ('ENROLLCONVO', None), ('EVENTSANDHOLIDAYS', None), ('OPENMOXIE_CHAT', 'short'),
+                ('DANCE', 'MOVEMENT'), ('SCAVENGERHUNT', 'PLAYFUL_GAME'), ('READ', 'READING'), ('AUDMED', 'REGULATION'),
+                ('COMPOSING', 'CREATIVITY'), ('JOKE', 'FUN_TIDBIT') ]
+    schedule = { 'command': 'query_result', 'query': 'schedule', 'request_id': str(uuid.uuid4()),
+                 'schedule': { 'provided_schedule': [ { 'module_id': m, 'category': c } if c else { 'module_id': m } for m, c in modules ] * 2,
+                               'chat_request': { 'module_id': 'OPENMOXIE_CHAT', 'content_id': 'default' } } }
+    now = int(time.time() * 1000)
+    mbh = { 'command': 'query_result', 'query': 'mentor_behaviors', 'request_id': str(uuid.uuid4()),
+            'mentor_behaviors': [ { 'module_id': modules[i % len(modules)][0], 'content_id': f'content_{i % 37}', 'content_day': str(1 + i // 20),
+                                    'timestamp': now - i * 60000, 'action': 'COMPLETED' if i % 3 else 'STARTED', 'instance_id': 1000 - i,
+                                    'ended_reason': None } for i in range(mbh_count) ] }
+    return { 'config': config, 'schedule': schedule, 'mbh': mbh, 'volley': json.loads(sample_volley('d_bench')) }
+
+def bench_codec(options, out):
+    samples = codec_samples(options['mbh'])
+    # before the codec, payloads were json.dumps str that paho encoded to bytes again
+    backends = { 'json-str': (json.loads, lambda obj: json.dumps(obj).encode('utf-8')) }
+    backends.update(codec.BACKENDS)
+    out.write(f'Codec backend in use: {codec.BACKEND}')
+    out.write(f'{"payload":10} {"bytes":>7} {"backend":10} {"encode us":>10} {"decode us":>10}')
+    for name, obj in samples.items():
+        raw = json.dumps(obj).encode('utf-8')
+        count = max(100, options['iterations'] * 1000 // len(raw))
+        for backend, (loads, dumps) in backends.items():
+            start = time.perf_counter()
+            for _ in range(count):
+                dumps(obj)
+            encode = (time.perf_counter() - start) / count
+            start = time.perf_counter()
+            for _ in range(count):
+                loads(raw)
+            decode = (time.perf_counter() - start) / count
+            out.write(f'{name:10} {len(raw):7} {backend:10} {encode * 1e6:10.2f} {decode * 1e6:10.2f}')
+
+'''
+STATE - Robot state ingest, a transaction per message vs the write-behind state store
+'''
+def bench_state(options, out):
+    from django.utils import timezone
+    from ...models import MoxieDevice
+    from ...mqtt.state_store import StateStore
+    from ...mqtt.util import run_db_atomic
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    device_ids = [ f'd_bench_state_{i}' for i in range(options['devices']) ]
+    MoxieDevice.objects.bulk_create([ MoxieDevice(device_id=d, state={}) for d in device_ids ])
+    reports = [ (device_ids[i % len(device_ids)], { 'battery_level': 100 - i % 90, 'charging': False, 'wifi_strength': 40 + i % 50 })
+                for i in range(options['messages']) ]
+    # the ingest path before the state store, one get and full row save per report
+    def update_state_atomic(device_id, state):
+        device = MoxieDevice.objects.get(device_id=device_id)
+        device.state = state
+        device.state_updated = timezone.now()
+        device.save()
+    try:
+        start = time.perf_counter()
+        for device_id, state in reports:
+            run_db_atomic(update_state_atomic, device_id, dict(state))
+        print_result(out, 'per-message save', len(reports), time.perf_counter() - start)
+        store = StateStore({ 'flush_interval': options['interval'], 'flush_size': options['flush_size'] })
+        start = time.perf_counter()
+        for device_id, state in reports:
+            store.put(device_id, dict(state))
+        store.stop()
+        print_result(out, 'write-behind (incl. final flush)', len(reports), time.perf_counter() - start)
+        m = store.metrics()
+        out.write(f'Rows written {m["written"]} in {m["flushes"]} flushes, {m["coalesced"]} reports coalesced')
+    finally:
+        MoxieDevice.objects.filter(device_id__in=device_ids).delete()
+
+'''
+CONFIG - Merged config for page views and config pushes, built every time vs the config cache
+'''
+def bench_config(options, out):
+    from ...models import MoxieDevice, HiveConfiguration
+    from ...mqtt.robot_data import RobotData, CONFIG_CACHE
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    device_ids = [ f'd_bench_config_{i}' for i in range(options['devices']) ]
+    MoxieDevice.objects.bulk_create([ MoxieDevice(device_id=d, robot_config={ 'child_pii': { 'nickname': f'Moxie {i}' }, 'audio_volume': '0.5' },
+                                                  robot_settings={ 'props': { 'doa_range': '70' } }) for i, d in enumerate(device_ids) ])
+    try:
+        devices = list(MoxieDevice.objects.filter(device_id__in=device_ids))
+        rounds = options['rounds']
+        # the config path before the cache, a hive config query and deep merge every time
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for device in devices:
+                codec.dumps(RobotData.build_config(device, HiveConfiguration.objects.filter(name='default').first()))
+        print_result(out, 'build every time', rounds * len(devices), time.perf_counter() - start)
+        CONFIG_CACHE.invalidate_all()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for device in devices:
+                CONFIG_CACHE.get_payload(device)
+        print_result(out, 'config cache', rounds * len(devices), time.perf_counter() - start)
+        out.write(f'Cache: {CONFIG_CACHE.metrics()}')
+    finally:
+        MoxieDevice.objects.filter(device_id__in=device_ids).delete()
+
+def bench_reconnect(options, out):
+    from django.utils import timezone
+    from ...models import MoxieDevice, MoxieSchedule
+    from ...mqtt.robot_data import RobotData
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    device_ids = [ f'd_bench_reconnect_{i}' for i in range(options['devices']) ]
+    schedule = MoxieSchedule.objects.filter(name='default').first()
+    MoxieDevice.objects.bulk_create([ MoxieDevice(device_id=d, schedule=schedule, last_connect=timezone.now(),
+                                                  robot_config={ 'audio_volume': '0.5' }) for d in device_ids ])
+    try:
+        for warm in (False, True):
+            robot_data = RobotData()
+            start = time.perf_counter()
+            if warm:
+                loaded = robot_data.warm_start()
+                print_result(out, f'warm start ({loaded} devices)', len(device_ids), time.perf_counter() - start)
+            for device_id in device_ids:
+                robot_data.db_connect(device_id)
+            print_result(out, 'warm reconnects' if warm else 'cold reconnects', len(device_ids), time.perf_counter() - start)
+            for device_id in device_ids:
+                robot_data.db_release(device_id)
+            robot_data.shutdown()
+    finally:
+        MoxieDevice.objects.filter(device_id__in=device_ids).delete()
+
+def bench_connect(options, out):
+    from ...models import MoxieDevice
+    from ...mqtt.moxie_server import MoxieServer
+    from ...mqtt.robot_credentials import RobotCredentials
+    from ...mqtt.robot_data import RobotData
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    delay = options['delay']
+    # loading is the same for both, serialized so parallel SQLite writers don't fail on locks
+    db_lock = threading.Lock()
+    def load(server, device_id):
+        with db_lock:
+            server.robot_data().db_connect(device_id)
+    for timers in (False, True):
+        transport = InMemoryTransport()
+        server = MoxieServer(RobotCredentials(True), RobotData(), 'openmoxie', 'localhost', 1883, transport=transport)
+        server.connect(start=True)
+        device_ids = [ f'd_bench_connect_{i}' for i in range(options['devices']) ]
+        # the connect handling before timers, sleeping in the lane
+        def sleeping_connect(device_id):
+            load(server, device_id)
+            time.sleep(delay)
+            server.send_connect_setup(device_id)
+        def timer_connect(device_id):
+            load(server, device_id)
+            server.timers().call_later(delay, server.submit_work, device_id, server.send_connect_setup, device_id)
+        try:
+            published = transport.publish_count
+            start = time.perf_counter()
+            for device_id in device_ids:
+                server.submit_work(device_id, timer_connect if timers else sleeping_connect, device_id)
+            # a config and a subscription per robot
+            deadline = time.monotonic() + 60 + delay * len(device_ids)
+            while transport.publish_count - published < 2 * len(device_ids) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            print_result(out, 'timer queue' if timers else 'sleeping lanes', len(device_ids), time.perf_counter() - start)
+        finally:
+            server.stop()
+            server.timers().stop()
+            server.publisher().stop()
+            server.dispatcher().shutdown()
+            server.robot_data().shutdown()
+            MoxieDevice.objects.filter(device_id__in=device_ids).delete()
+
+def bench_mbh(options, out):
+    from ...models import MoxieDevice, MentorBehavior
+    from ...mqtt.moxie_server import MoxieServer
+    from ...mqtt.robot_credentials import RobotCredentials
+    from ...mqtt.robot_data import RobotData
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    device_id = 'd_bench_mbh'
+    device = MoxieDevice.objects.create(device_id=device_id)
+    now = int(time.time() * 1000) - options['records'] * 1000
+    MentorBehavior.objects.bulk_create([ MentorBehavior(device=device, module_id='DM', content_id=f'cid_{i % 100}', content_day='1', timestamp=now + i * 1000,
+                                                        action='COMPLETED', instance_id=i, ended_reason='') for i in range(options['records']) ])
+    server = MoxieServer(RobotCredentials(True), RobotData(), 'openmoxie', 'localhost', 1883, transport=InMemoryTransport())
+    robot_data = server.robot_data()
+    try:
+        queries = options['queries']
+        # the query path before the index, a query and model_to_dict per row every time
+        start = time.perf_counter()
+        for i in range(queries):
+            old = codec.dumps({ 'command': 'query_result', 'query': 'mentor_behaviors', 'request_id': str(i),
+                                'mentor_behaviors': robot_data.get_mbh(device_id) })
+        print_result(out, f'query per request ({options["records"]} records)', queries, time.perf_counter() - start)
+        start = time.perf_counter()
+        robot_data.db_connect(device_id)
+        print_result(out, 'index load at connect', 1, time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(queries):
+            count, payload = robot_data.get_mbh_payload(device_id)
+            new = server.mentor_behaviors_result(str(i), payload)
+        print_result(out, 'cached index payload', queries, time.perf_counter() - start)
+        out.write(f'Same payload: {codec.loads(old) == codec.loads(new)}')
+        start = time.perf_counter()
+        for i in range(queries):
+            robot_data.add_mbh(device_id, { 'module_id': 'DM', 'content_id': 'new', 'content_day': '1', 'timestamp': now + (options['records'] + i) * 1000,
+                                            'action': 'COMPLETED', 'instance_id': options['records'] + i, 'ended_reason': '' })
+            count, payload = robot_data.get_mbh_payload(device_id)
+        print_result(out, 'ingest then query', queries, time.perf_counter() - start)
+    finally:
+        server.publisher().stop()
+        server.dispatcher().shutdown()
+        robot_data.shutdown()
+        device.delete()
+
+def bench_mbh_ingest(options, out):
+    from ...models import MoxieDevice, MentorBehavior
+    from ...mqtt.robot_data import RobotData
+    from ...mqtt.util import run_db_atomic
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    device_ids = [ f'd_bench_mbh_ingest_{i}' for i in range(options['devices']) ]
+    count = options['records']
+    def sample(i):
+        return { 'module_id': 'DM', 'content_id': f'cid_{i % 100}', 'content_day': '1', 'timestamp': 1700000000000 + i,
+                 'action': 'COMPLETED', 'instance_id': i, 'ended_reason': '' }
+    # the ingest before buffering, a device lookup and a single row insert per report
+    def insert_one(device_id, mbh):
+        rec = MentorBehavior(device=MoxieDevice.objects.get(device_id=device_id))
+        rec.__dict__.update(mbh)
+        rec.save()
+    robot_data = RobotData()
+    try:
+        for device_id in device_ids:
+            robot_data.db_connect(device_id)
+        start = time.perf_counter()
+        for i in range(count):
+            run_db_atomic(insert_one, device_ids[i % len(device_ids)], sample(i))
+        print_result(out, 'insert per report', count, time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(count):
+            robot_data.add_mbh(device_ids[i % len(device_ids)], sample(i))
+        # until all are in the database
+        robot_data.shutdown()
+        print_result(out, 'buffered bulk_create', count, time.perf_counter() - start)
+        written = MentorBehavior.objects.filter(device__device_id__in=device_ids).count()
+        out.write(f'Rows written: {written} of {2 * count}')
+    finally:
+        MoxieDevice.objects.filter(device_id__in=device_ids).delete()
+
+# Resident set size of this process in bytes, Linux only
+def resident_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+def bench_memory(options, out):
+    from django.utils import timezone
+    from ...models import MoxieDevice, MoxieSchedule
+    from ...mqtt.robot_data import RobotData
+    logging.getLogger('hive').setLevel(logging.WARNING)
+    schedule = MoxieSchedule.objects.filter(name='default').first()
+    state = { 'battery_level': 80, 'charging': False, 'wifi_strength': -52, 'volume': 0.6, 'brightness': 1.0,
+              'sleep_state': 'awake', 'os_version': '24.10.1', 'app_version': '1.2.3', 'face_detected': True }
+    for count in [ int(c) for c in options['devices'].split(',') ]:
+        device_ids = [ f'd_bench_memory_{i}' for i in range(count) ]
+        # a few robots have their own config, most use the hive config
+        MoxieDevice.objects.bulk_create([ MoxieDevice(device_id=d, schedule=schedule, last_connect=timezone.now(),
+                                                      robot_config={ 'audio_volume': '0.3' } if i % 10 == 0 else None)
+                                          for i, d in enumerate(device_ids) ], batch_size=500)
+        try:
+            gc.collect()
+            robot_data = RobotData()
+            rss_before = resident_bytes()
+            tracemalloc.start()
+            start = time.perf_counter()
+            robot_data.warm_start()
+            for i, device_id in enumerate(device_ids):
+                robot_data.db_connect(device_id)
+                robot_data.put_state(device_id, dict(state, battery_level=i % 100))
+            elapsed = time.perf_counter() - start
+            gc.collect()
+            heap, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rss = resident_bytes() - rss_before
+            out.write(f'{count:>6} devices  heap {heap / 1e6:8.1f} MB ({heap / count:7.0f} B/device)  '
+                      f'rss +{rss / 1e6:8.1f} MB ({rss / count:7.0f} B/device)  connect {elapsed:.2f}s')
+            for device_id in device_ids:
+                robot_data.db_release(device_id)
+            robot_data.shutdown()
+            del robot_data
+        finally:
+            MoxieDevice.objects.filter(device_id__in=device_ids).delete()
+
+'''
+SCHEDULE - Module selection for generated schedules, shuffle and score vs the direct generator
+'''
+# the selection before the generator, best of 20 scored shuffles
+def _ransac_select(modules, count):
+    import random
+    count = len(modules) if count > len(modules) else count
+    best_list = []
+    best_score = 100
+    for i in range(20):
+        random_list = random.sample(modules, len(modules))
+        cat_map = {}
+        last_cat = None
+        score = 0
+        for m in range(count):
+            cat = random_list[m].get('category', 'User')
+            if cat == last_cat:
+                score += 5
+            if cat in cat_map:
+                cat_map[cat] += 1
+                score += 1
+            else:
+                cat_map[cat] = 1
+            last_cat = cat
+        if score < best_score:
+            best_score = score
+            best_list = random_list[:count]
+    return best_list
+
+def bench_schedule(options, out):
+    import random
+    from ...content.data import RECOMMENDABLE_MODULES
+    from ...mqtt.mbh_index import MbhIndex
+    from ...mqtt.scheduler import select_modules, recency_penalties
+    count = options['count']
+    iterations = options['iterations']
+    rng = random.Random(1)
+    for name, select in [ ('shuffle and score', _ransac_select),
+                          ('generator', lambda modules, count: select_modules(modules, count, rng=rng)) ]:
+        adjacent = repeats = 0
+        start = time.perf_counter()
+        for _ in range(iterations):
+            modules = select(RECOMMENDABLE_MODULES, count)
+            cats = [ m.get('category', 'User') for m in modules ]
+            adjacent += sum(1 for a, b in zip(cats, cats[1:]) if a == b)
+            repeats += len(cats) - len(set(cats))
+        print_result(out, name, iterations, time.perf_counter() - start)
+        out.write(f'{"":32} adjacent categories {adjacent / iterations:.3f}/schedule, repeated categories {repeats / iterations:.3f}/schedule')
+    # recency penalties from a long history, once per schedule
+    history = options['history']
+    day = 24 * 3600 * 1000
+    mbh = MbhIndex((RECOMMENDABLE_MODULES[i % len(RECOMMENDABLE_MODULES)]['module_id'], f'cid_{i}', None, 1700000000000 + i * day // 10,
+                    'COMPLETED', i, None) for i in range(history))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        select_modules(RECOMMENDABLE_MODULES, count, rng=rng, recency=recency_penalties(mbh))
+    print_result(out, f'generator + recency ({history} MBH)', iterations, time.perf_counter() - start)
+
+'''
+STT - Accumulating utterance audio and framing it as WAV for upload, bytearray and soundfile vs
+the audio buffer with its WAV header written in place.  Uploads read the file in 64 KB blocks.
+'''
+def bench_stt(options, out):
+    import io
+    from ...mqtt.wav import AudioBuffer, SAMPLE_RATE, SAMPLE_WIDTH
+    try:
+        import numpy as np
+        import soundfile as sf
+    except ImportError:
+        np = sf = None
+    frame = os.urandom(SAMPLE_RATE * SAMPLE_WIDTH * options['frame_ms'] // 1000)
+    # the session path before the audio buffer, one growing buffer, an array and an encoder
+    def legacy(frames):
+        stream = bytearray()
+        for _ in range(frames):
+            stream += frame
+        buffer = io.BytesIO()
+        sf.write(buffer, np.frombuffer(stream, dtype=np.int16), SAMPLE_RATE, format='WAV', subtype='PCM_16')
+        upload = io.BytesIO(buffer.getvalue())
+        while upload.read(65536):
+            pass
+    def buffered(frames):
+        audio = AudioBuffer()
+        for _ in range(frames):
+            audio.append(frame)
+        upload = audio.wav_reader()
+        while upload.read(65536):
+            pass
+    variants = [ ('audio buffer + wav header', buffered) ]
+    if sf:
+        variants.insert(0, ('bytearray + soundfile', legacy))
+    else:
+        out.write('numpy/soundfile not installed, skipping the previous path')
+    for seconds in [ int(s) for s in options['seconds'].split(',') ]:
+        frames = seconds * 1000 // options['frame_ms']
+        for name, run in variants:
+            start = time.perf_counter()
+            for _ in range(options['iterations']):
+                run(frames)
+            elapsed = time.perf_counter() - start
+            # peak memory from one more run, tracing would skew the timing
+            tracemalloc.start()
+            run(frames)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            out.write(f'{seconds:>3}s {name:26} {elapsed / options["iterations"] * 1e3:8.2f} ms/utterance  peak {peak / 1e6:6.2f} MB')
+
+BENCHMARKS = {
+    'ingress': (bench_ingress, 'Volley throughput, threaded lanes vs asyncio engine', [
+        ('--devices', int, 500), ('--messages', int, 5000), ('--latency', float, 0.05),
+        ('--lanes', int, 8), ('--ai-workers', int, 32) ]),
+    'admission': (bench_admission, 'Volley latency during a state and log storm, with and without shedding', [
+        ('--devices', int, 200), ('--messages', int, 20000), ('--ingest-ms', float, 1.0),
+        ('--rate', int, 10000), ('--volley-every', int, 100), ('--lanes', int, 8),
+        ('--background-high', int, 2000) ]),
+    'dispatch': (bench_dispatch, 'MoxieServer.on_message hot path over the in-memory transport', [
+        ('--devices', int, 1000), ('--messages', int, 200000),
+        ('--kinds', str, 'notify,device-logs,telehealth,sys-log,sys-log-other,sys-clients') ]),
+    'cluster': (bench_cluster, 'Hash ring ownership and broker fan-out overhead over N processes, against a local mosquitto', [
+        ('--host', str, 'localhost'), ('--port', int, 1883), ('--workers', str, '1,2,4'),
+        ('--devices', int, 500), ('--messages', int, 5000), ('--work-ms', float, 1.0) ]),
+    'codec': (bench_codec, 'JSON codec backends on config, schedule, MBH list and volley payloads', [
+        ('--mbh', int, 500), ('--iterations', int, 20000) ]),
+    'state': (bench_state, 'State report ingest, per-message save vs write-behind store (writes to the database)', [
+        ('--devices', int, 200), ('--messages', int, 5000), ('--interval', float, 5.0), ('--flush-size', int, 500) ]),
+    'config': (bench_config, 'Config for page views and pushes, rebuilt each time vs cached (writes to the database)', [
+        ('--devices', int, 500), ('--rounds', int, 10) ]),
+    'reconnect': (bench_reconnect, 'Reconnect storm after a restart, per-device loading vs warm start (writes to the database)', [
+        ('--devices', int, 500) ]),
+    'connect': (bench_connect, 'Connect storm until config is sent, sleeping lanes vs timer queue (writes to the database)', [
+        ('--devices', int, 200), ('--delay', float, 1.0) ]),
+    'mbh': (bench_mbh, 'Mentor behavior queries, database every time vs connected index (writes to the database)', [
+        ('--records', int, 3000), ('--queries', int, 50) ]),
+    'schedule': (bench_schedule, 'Generated schedule module selection, shuffle and score vs the direct generator', [
+        ('--count', int, 6), ('--iterations', int, 20000), ('--history', int, 20000) ]),
+    'stt': (bench_stt, 'STT utterance accumulation and WAV framing, bytearray and soundfile vs the audio buffer', [
+        ('--seconds', str, '5,10,30'), ('--frame-ms', int, 20), ('--iterations', int, 50) ]),
+    'memory': (bench_memory, 'Memory held per connected robot, at each fleet size (writes to the database)', [
+        ('--devices', str, '1000,10000') ]),
+    'mbh-ingest': (bench_mbh_ingest, 'Mentor behavior ingest, insert per report vs buffered bulk_create (writes to the database)', [
+        ('--devices', int, 50), ('--records', int, 2000) ]),
+}
+
+class Command(BaseCommand):
+    help = 'Run OpenMoxie performance benchmarks.'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+        for name, (_, bench_help, args) in BENCHMARKS.items():
+            sub = subparsers.add_parser(name, help=bench_help)
+            for arg, arg_type, default in args:
+                sub.add_argument(arg, type=arg_type, default=default)
+
+    def handle(self, *args, **options):
+        functor = BENCHMARKS[options['benchmark']][0]
+        functor(options, self.stdout)
@@ -0,0 +1,37 @@
+from time import sleep
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from hive.mqtt.moxie_server import create_service_instance, cleanup_instance
+from hive.mqtt.metrics import start_http_server
+
+class Command(BaseCommand):
+    help = 'Run a clustered MQTT worker, without the web server.  Start one per process wanted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-id', help='Unique id of this worker, defaults to host-pid')
+        parser.add_argument('--group', help='Cluster group to join, defaults to MOXIE_CLUSTER group')
+        parser.add_argument('--metrics-interval', type=int, default=60, help='Seconds between metrics logs')
+        parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics over HTTP on this port')
+
+    def handle(self, *args, **options):
+        cluster = dict(getattr(settings, 'MOXIE_CLUSTER', {}))
+        cluster['enabled'] = True
+        if options['worker_id']:
+            cluster['worker_id'] = options['worker_id']
+        if options['group']:
+            cluster['group'] = options['group']
+        settings.MOXIE_CLUSTER = cluster
+
+        self.stdout.write('Starting clustered MQTT worker...')
+        if options['metrics_port']:
+            start_http_server(options['metrics_port'])
+        ep = settings.MQTT_ENDPOINT
+        instance = create_service_instance(project_id=ep['project'], host=ep['host'], port=ep['port'], cert_required=ep.get('cert_required', True), use_tls=ep.get('tls', True))
+        try:
+            while True:
+                sleep(options['metrics_interval'])
+                instance.print_metrics()
+        except KeyboardInterrupt:
+            self.stdout.write('Leaving cluster...')
+        finally:
+            cleanup_instance()
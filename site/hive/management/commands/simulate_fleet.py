@@ -0,0 +1,231 @@
+# simulate_fleet.py
+import json
+import random
+import threading
+import time
+import uuid
+import paho.mqtt.client as mqtt
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from ...mqtt.protos.embodied.perception.audio.zmqSTT_pb2 import zmqSTTRequest, zmqSTTResponse
+from .benchmark import percentile
+
+_STT_REQUEST = 'embodied.perception.audio.zmqSTTRequest'
+_STT_RESPONSE = 'embodied.perception.audio.zmqSTTResponse'
+# 100ms of 16kHz 16 bit audio
+_AUDIO_FRAME = bytes(3200)
+
+'''
+Latency samples and timeouts for each request type, shared by all simulated robots
+'''
+class FleetStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._timeouts = {}
+        self._sent = {}
+
+    def sent(self, rtype):
+        with self._lock:
+            self._sent[rtype] = self._sent.get(rtype, 0) + 1
+
+    def record(self, rtype, latency):
+        with self._lock:
+            self._latencies.setdefault(rtype, []).append(latency)
+
+    def timeout(self, rtype):
+        with self._lock:
+            self._timeouts[rtype] = self._timeouts.get(rtype, 0) + 1
+
+    def report(self, out, elapsed):
+        out.write(f'{"request":16} {"sent":>7} {"done":>7} {"timeout":>7} {"per sec":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+        with self._lock:
+            for rtype in sorted(self._sent.keys()):
+                lat = [ l * 1000 for l in self._latencies.get(rtype, []) ]
+                out.write(f'{rtype:16} {self._sent[rtype]:7} {len(lat):7} {self._timeouts.get(rtype, 0):7} {self._sent[rtype] / elapsed:8.1f} '
+                          f'{percentile(lat, 50):8.1f} {percentile(lat, 95):8.1f} {percentile(lat, 99):8.1f} {max(lat, default=0):8.1f}')
+
+'''
+One simulated Moxie.  Speaks the same topics and payloads a robot does, and times every
+request that gets a response.  Requests are waited on one at a time, like a conversation.
+'''
+class SimulatedMoxie:
+    def __init__(self, stats, options):
+        self.device_id = f'd_{uuid.uuid4()}'
+        self._stats = stats
+        self._options = options
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._config_event = threading.Event()
+        self._client = mqtt.Client(client_id=self.device_id, transport='tcp')
+        if options['tls']:
+            self._client.tls_set()
+        self._client.on_connect = self.on_connect
+        self._client.on_message = self.on_message
+
+    def topic(self, name):
+        return f'/devices/{self.device_id}/{name}'
+
+    def start(self):
+        self._connect_ts = time.perf_counter()
+        self._stats.sent('config')
+        self._client.connect(self._options['host'], self._options['port'], 60)
+        self._client.loop_start()
+
+    def stop(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.topic('commands/#'))
+        client.subscribe(self.topic('config'))
+
+    def on_message(self, client, userdata, msg):
+        kind = msg.topic.split('/')[-1]
+        if kind == 'config':
+            if not self._config_event.is_set():
+                self._stats.record('config', time.perf_counter() - self._connect_ts)
+                self._config_event.set()
+            return
+        if kind == 'zmq':
+            protoname, _, data = msg.payload.partition(b':')
+            if protoname.decode('utf-8') != _STT_RESPONSE:
+                return
+            resp = zmqSTTResponse()
+            resp.ParseFromString(data)
+            self.complete(resp.uuid, resp.speech)
+        elif kind in ('query_result', 'remote_chat'):
+            payload = json.loads(msg.payload)
+            self.complete(payload.get('request_id') or payload.get('event_id'), payload)
+
+    def complete(self, request_id, result):
+        with self._lock:
+            pending = self._pending.get(request_id)
+        if pending:
+            pending['result'] = result
+            pending['done'].set()
+
+    # Send a request and block until its response arrives or times out
+    def request(self, rtype, request_id, send):
+        pending = { 'done': threading.Event(), 'result': None }
+        with self._lock:
+            self._pending[request_id] = pending
+        self._stats.sent(rtype)
+        start = time.perf_counter()
+        send()
+        if pending['done'].wait(self._options['timeout']):
+            self._stats.record(rtype, time.perf_counter() - start)
+        else:
+            self._stats.timeout(rtype)
+        with self._lock:
+            del self._pending[request_id]
+        return pending['result']
+
+    def send_event(self, event, payload):
+        self._client.publish(self.topic(f'events/{event}'), payload)
+
+    def send_state(self):
+        self._stats.sent('state')
+        self._client.publish(self.topic('state'), json.dumps({ 'battery_level': random.randint(10, 100), 'charging': False,
+                                                               'wifi_strength': random.randint(30, 90) }))
+
+    def query(self, query):
+        request_id = str(uuid.uuid4())
+        return self.request(query, request_id, lambda: self.send_event('client-service-activity-log',
+                            json.dumps({ 'subtopic': 'query', 'query': query, 'request_id': request_id })))
+
+    def remote_chat(self, command, speech=None):
+        event_id = str(uuid.uuid4())
+        rcr = { 'command': command, 'backend': 'router', 'event_id': event_id,
+                'module_id': self._options['module'], 'content_id': self._options['content'] }
+        if speech:
+            rcr['speech'] = speech
+        if command == 'notify':
+            self._stats.sent('notify')
+            self.send_event('remote-chat', json.dumps(rcr))
+            return None
+        return self.request(command, event_id, lambda: self.send_event('remote-chat', json.dumps(rcr)))
+
+    # Stream an utterance to STT over the ZMQ bridge, then wait for the transcript
+    def speak(self):
+        session_id = str(uuid.uuid4())
+        def send():
+            frames = self._options['stt_frames']
+            for i in range(frames):
+                req = zmqSTTRequest()
+                req.timestamp = time.time_ns() // 1_000_000
+                req.uuid = session_id
+                req.audio_content = _AUDIO_FRAME
+                req.vad = req.VADState.END_OF_SPEECH if i == frames - 1 else (req.VADState.START_OF_SPEECH if i == 0 else req.VADState.SPEECH)
+                self.send_event('zmq', (_STT_REQUEST + ':').encode('utf-8') + req.SerializeToString())
+        return self.request('stt', session_id, send)
+
+    # A session like a real one: startup queries, then conversation turns until the end time
+    def run(self, end_ts):
+        # robots report state right away, which also gets the attention of a server that missed the connect
+        self.send_state()
+        self._config_event.wait(self._options['timeout'])
+        self.query('schedule')
+        self.query('mentor_behaviors')
+        resp = self.remote_chat('prompt')
+        if resp:
+            self.remote_chat('notify', resp.get('output', {}).get('text'))
+        while time.perf_counter() < end_ts:
+            time.sleep(random.uniform(0.5, 1.5) * self._options['think'])
+            speech = self.speak() or 'tell me more'
+            resp = self.remote_chat('continue', speech)
+            if resp:
+                self.remote_chat('notify', resp.get('output', {}).get('text'))
+            if random.random() < 0.3:
+                self.send_state()
+
+class Command(BaseCommand):
+    help = 'Load test the MQTT services with a fleet of simulated Moxies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost', help='MQTT broker host')
+        parser.add_argument('--port', type=int, default=1883, help='MQTT broker port')
+        parser.add_argument('--tls', action='store_true', help='Connect robots using TLS')
+        parser.add_argument('--robots', type=int, default=20, help='Number of simulated robots')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds of conversation per robot')
+        parser.add_argument('--ramp', type=float, default=5.0, help='Seconds over which robots connect')
+        parser.add_argument('--think', type=float, default=2.0, help='Average seconds between conversation turns')
+        parser.add_argument('--timeout', type=float, default=15.0, help='Seconds to wait for any response')
+        parser.add_argument('--stt-frames', type=int, default=15, help='100ms audio frames per utterance')
+        parser.add_argument('--module', default='OPENMOXIE_CHAT', help='Remote chat module to talk to')
+        parser.add_argument('--content', default='default', help='Remote chat content id to talk to')
+        parser.add_argument('--in-process', action='store_true', help='Also run the MQTT services in this process, with stub AI')
+        parser.add_argument('--llm-ms', type=float, default=800, help='Stub chat latency, with --in-process')
+        parser.add_argument('--stt-ms', type=float, default=400, help='Stub speech latency, with --in-process')
+
+    def handle(self, *args, **options):
+        if options['in_process']:
+            from ...mqtt.moxie_server import create_service_instance, cleanup_instance
+            settings.MOXIE_AI = { 'backend': 'stub', 'llm_latency': options['llm_ms'] / 1000, 'stt_latency': options['stt_ms'] / 1000 }
+            server = create_service_instance(project_id=settings.MQTT_ENDPOINT['project'], host=options['host'], port=options['port'],
+                                             cert_required=False, use_tls=options['tls'])
+            time.sleep(1.0)
+        else:
+            self.stdout.write('Using the running MQTT services, set MOXIE_AI backend to stub there to avoid real AI requests')
+
+        stats = FleetStats()
+        robots = [ SimulatedMoxie(stats, options) for _ in range(options['robots']) ]
+        start = time.perf_counter()
+        threads = []
+        for robot in robots:
+            robot.start()
+            thread = threading.Thread(target=robot.run, args=(time.perf_counter() + options['duration'],), daemon=True)
+            thread.start()
+            threads.append(thread)
+            time.sleep(options['ramp'] / len(robots))
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for robot in robots:
+            robot.stop()
+
+        self.stdout.write(f'{len(robots)} robots for {elapsed:.1f}s')
+        stats.report(self.stdout, elapsed)
+        if options['in_process']:
+            server.print_metrics()
+            cleanup_instance()
@@ -0,0 +1,48 @@
+from django.db import migrations
+from django.db.models import Count
+
+# Filled on the kept row when it has no value, from the newest duplicate with one
+_FILLED_FIELDS = ('email', 'name', 'schedule_id', 'state', 'robot_config', 'robot_settings')
+# The latest of all the duplicates
+_LATEST_FIELDS = ('last_connect', 'last_disconnect', 'state_updated')
+
+# MoxieDevice.device_id becomes unique in the next migration.  Rows sharing a device_id are
+# merged into the oldest first: mentor behaviors and logs move to it, and it takes the newest
+# duplicate's persistent data if it has none of its own.
+def merge_duplicate_devices(apps, schema_editor):
+    MoxieDevice = apps.get_model('hive', 'MoxieDevice')
+    MentorBehavior = apps.get_model('hive', 'MentorBehavior')
+    MoxieLogs = apps.get_model('hive', 'MoxieLogs')
+    PersistentData = apps.get_model('hive', 'PersistentData')
+    duplicated = MoxieDevice.objects.values('device_id').annotate(rows=Count('id')).filter(rows__gt=1)
+    for device_id in [ d['device_id'] for d in duplicated ]:
+        kept, *others = MoxieDevice.objects.filter(device_id=device_id).order_by('pk')
+        other_pks = [ d.pk for d in others ]
+        MentorBehavior.objects.filter(device_id__in=other_pks).update(device=kept)
+        MoxieLogs.objects.filter(device_id__in=other_pks).update(device=kept)
+        if not PersistentData.objects.filter(device=kept).exists():
+            persist = PersistentData.objects.filter(device_id__in=other_pks).order_by('-device_id').first()
+            if persist:
+                persist.device = kept
+                persist.save(update_fields=['device'])
+        for other in reversed(others):
+            for field in _FILLED_FIELDS:
+                if getattr(kept, field) is None:
+                    setattr(kept, field, getattr(other, field))
+            for field in _LATEST_FIELDS:
+                value = getattr(other, field)
+                if value is not None and (getattr(kept, field) is None or value > getattr(kept, field)):
+                    setattr(kept, field, value)
+        kept.save()
+        MoxieDevice.objects.filter(pk__in=other_pks).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hive', '0016_globalresponse_source_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_devices, migrations.RunPython.noop),
+    ]
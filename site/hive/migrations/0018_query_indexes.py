@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hive', '0017_merge_duplicate_devices'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='hiveconfiguration',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='moxiedevice',
+            name='device_id',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='moxieschedule',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='globalresponse',
+            index=models.Index(fields=['name'], name='global_response_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='singlepromptchat',
+            index=models.Index(fields=['module_id', 'content_id'], name='chat_module_content_idx'),
+        ),
+    ]
@@ -20,12 +20,17 @@ class SinglePromptChat(models.Model):
     temperature = models.FloatField(default=0.5)
     code = models.TextField(null=True, blank=True) # Python code for filter methods
     source_version = models.IntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['module_id', 'content_id'], name='chat_module_content_idx'),
+        ]
     
     def __str__(self):
         return self.name
     
 class MoxieSchedule(models.Model):
-    name = models.CharField(max_length=200)
+    name = models.CharField(max_length=200, db_index=True)
     schedule = models.JSONField()
     source_version = models.IntegerField(default=1)
     
@@ -38,7 +43,7 @@ class DevicePermit(Enum):
     ALLOWED = 3
 
 class MoxieDevice(models.Model):
-    device_id = models.CharField(max_length=200)
+    device_id = models.CharField(max_length=200, unique=True)
     email = models.EmailField(null=True, blank=True)
     permit = models.IntegerField(choices=[(tag.value, tag.name) for tag in DevicePermit],default=DevicePermit.UNKNOWN.value)
     schedule = models.ForeignKey(MoxieSchedule, on_delete=models.SET_NULL, null=True)
@@ -66,7 +71,7 @@ class MoxieLogs(models.Model):
     message = models.TextField()
 
 class HiveConfiguration(models.Model):
-    name = models.CharField(max_length=200)
+    name = models.CharField(max_length=200, db_index=True)
     openai_api_key = models.TextField(null=True, blank=True, default='')
     external_host = models.CharField(max_length=255, null=True, blank=True, default='')
     allow_unverified_bots = models.BooleanField(default=False)
@@ -116,6 +121,11 @@ class GlobalResponse(models.Model):
     sort_key = models.IntegerField(default=1) # in case ordering matters, they order desc so high goes first
     source_version = models.IntegerField(default=1)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['name'], name='global_response_name_idx'),
+        ]
+
     # Ensure we have all we need
     def clean(self):
         if self.action == GlobalAction.METHOD.value and not self.code:
@@ -0,0 +1,144 @@
+'''
+ADMISSION - Load shedding for low value messages when MoxieServer is overloaded
+
+Every incoming message kind has a shedding policy:
+- never: always handled, e.g. remote-chat volleys and queries a robot waits on
+- drop: handled normally, but dropped while degraded (e.g. broker client metrics)
+- sample: handled normally, but only one in N is kept while degraded (e.g. device logs)
+- latest: only the newest unhandled message per device is kept (e.g. state reports).  It
+  is decoded when its turn comes, so a flood of state costs one decode per device.
+
+MoxieServer is degraded when the queued work for a class passes its high watermark, and
+recovers once it falls back under the low watermark.  Latest-only work is also refused once
+its class is past the high watermark, and the dispatcher refuses background work once a
+lane is full (see DeviceDispatcher).  Counters are kept for every shed
+message and each time degraded mode is entered.
+
+Settings come from settings.MOXIE_ADMISSION.
+'''
+import collections
+import logging
+import threading
+import time
+from .dispatcher import INTERACTIVE, BACKGROUND, WorkShed
+
+logger = logging.getLogger(__name__)
+
+POLICY_NEVER = 'never'
+POLICY_DROP = 'drop'
+POLICY_SAMPLE = 'sample'
+POLICY_LATEST = 'latest'
+
+# Policies by message kind, event names or topic route names.  Unknown kinds are never shed.
+DEFAULT_POLICIES = {
+    'device-logs': POLICY_SAMPLE,
+    'state': POLICY_LATEST,
+    'sys/clients': POLICY_DROP,
+}
+
+# Queued work per class that enters (high) and leaves (low) degraded mode
+DEFAULT_WATERMARKS = {
+    INTERACTIVE: (200, 50),
+    BACKGROUND: (2000, 500),
+}
+_DEFAULT_SAMPLE_RATE = 20
+# Queue depths are only rechecked this often, they are sampled from every lane
+_DEPTH_CHECK_INTERVAL = 0.05
+
+'''
+AdmissionController decides which incoming messages are handled, and owns the latest-only
+pending work.  dispatcher is the DeviceDispatcher or AsyncioEngine work is submitted to.
+'''
+class AdmissionController:
+    def __init__(self, dispatcher, admission_settings=None):
+        admission_settings = admission_settings or {}
+        self._dispatcher = dispatcher
+        self._policies = DEFAULT_POLICIES.copy()
+        self._policies.update(admission_settings.get('policies', {}))
+        self._watermarks = DEFAULT_WATERMARKS.copy()
+        for work_class in DEFAULT_WATERMARKS.keys():
+            high = admission_settings.get(f'{work_class}_high', self._watermarks[work_class][0])
+            low = admission_settings.get(f'{work_class}_low', self._watermarks[work_class][1])
+            self._watermarks[work_class] = (high, min(low, high))
+        self._sample_rate = max(1, admission_settings.get('sample_rate', _DEFAULT_SAMPLE_RATE))
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._sampled = collections.Counter()
+        self._shed = collections.Counter()
+        self._depths = {}
+        self._depths_ts = 0
+        self._degraded = False
+        self._degraded_count = 0
+
+    def policy(self, kind):
+        return self._policies.get(kind, POLICY_NEVER)
+
+    # Refresh queue depths and the degraded state, at most every _DEPTH_CHECK_INTERVAL
+    def _check_load(self):
+        now = time.monotonic()
+        if now - self._depths_ts < _DEPTH_CHECK_INTERVAL:
+            return
+        self._depths_ts = now
+        self._depths = self._dispatcher.class_depths()
+        if self._degraded:
+            if all(self._depths.get(wc, 0) <= low for wc, (high, low) in self._watermarks.items()):
+                self._degraded = False
+                logger.warning(f'Leaving degraded mode, queues {self._depths} shed {dict(self._shed)}')
+        elif any(self._depths.get(wc, 0) >= high for wc, (high, low) in self._watermarks.items()):
+            self._degraded = True
+            self._degraded_count += 1
+            logger.warning(f'Entering degraded mode, queues {self._depths}')
+
+    # True while overloaded and shedding low value messages
+    def degraded(self):
+        self._check_load()
+        return self._degraded
+
+    def _shed_one(self, kind):
+        self._shed[kind] += 1
+        return False
+
+    # Check if a message of this kind should be handled, call before decoding it
+    def admit(self, kind):
+        policy = self._policies.get(kind, POLICY_NEVER)
+        if policy == POLICY_NEVER or not self.degraded():
+            return True
+        if policy == POLICY_SAMPLE:
+            self._sampled[kind] += 1
+            if self._sampled[kind] % self._sample_rate == 0:
+                return True
+        return self._shed_one(kind)
+
+    # Queue a message for a device, keeping only the newest one not yet handled.  The payload
+    # is decoded with decoder right before functor(device_id, payload) is called.
+    def submit_latest(self, kind, device_id, functor, payload, decoder=None, work_class=BACKGROUND):
+        key = (kind, device_id)
+        with self._lock:
+            if key in self._pending:
+                # replaces the older message, which is never handled
+                self._pending[key] = payload
+                return self._shed_one(kind)
+            self._check_load()
+            if self._depths.get(work_class, 0) >= self._watermarks[work_class][0]:
+                return self._shed_one(kind)
+            self._pending[key] = payload
+        future = self._dispatcher.submit(device_id, self.run_latest, key, functor, decoder, work_class=work_class)
+        if future.done() and isinstance(future.exception(), WorkShed):
+            # refused by a full lane, the next message for the device is queued again
+            with self._lock:
+                self._pending.pop(key, None)
+                return self._shed_one(kind)
+        return True
+
+    # NOTE: Called from a dispatcher lane
+    def run_latest(self, key, functor, decoder):
+        with self._lock:
+            payload = self._pending.pop(key)
+        functor(key[1], decoder(payload) if decoder else payload)
+
+    def metrics(self):
+        self._check_load()
+        return { 'degraded': self._degraded,
+                 'degraded_count': self._degraded_count,
+                 'pending_latest': len(self._pending),
+                 'shed': dict(self._shed) }
@@ -1,4 +1,6 @@
 from openai import OpenAI
+from django.conf import settings
+from .ai_stub import StubOpenAI
 import logging
 
 logger = logging.getLogger(__name__)
@@ -9,6 +11,10 @@ def set_openai_key(key):
     global _OPENAPI_KEY
     _OPENAPI_KEY = key
 
+# Backend is picked by settings.MOXIE_AI, 'openai' (default) or 'stub' for load testing
 def create_openai():
     global _OPENAPI_KEY
+    ai_settings = getattr(settings, 'MOXIE_AI', {})
+    if ai_settings.get('backend') == 'stub':
+        return StubOpenAI(ai_settings)
     return OpenAI(api_key=_OPENAPI_KEY)
@@ -0,0 +1,41 @@
+'''
+AI STUB - Stand-in for the OpenAI client, for load tests without real inference
+
+Provides only the calls OpenMoxie makes, chat completions and audio transcriptions, which
+sleep for a configured latency and return canned results.  Selected with
+settings.MOXIE_AI = { 'backend': 'stub', 'llm_latency': 0.8, 'stt_latency': 0.4 }
+'''
+import time
+from types import SimpleNamespace
+
+_DEFAULT_LLM_LATENCY = 0.8
+_DEFAULT_STT_LATENCY = 0.4
+STUB_RESPONSE = 'That is a great question.  Octopuses have three hearts and blue blood.'
+STUB_TRANSCRIPT = 'tell me something interesting about octopuses'
+
+class _StubCompletions:
+    def __init__(self, latency):
+        self._latency = latency
+
+    def create(self, model=None, messages=None, **kwargs):
+        time.sleep(self._latency)
+        message = SimpleNamespace(role='assistant', content=STUB_RESPONSE)
+        return SimpleNamespace(model=model, choices=[ SimpleNamespace(index=0, message=message, finish_reason='stop') ])
+
+class _StubTranscriptions:
+    def __init__(self, latency):
+        self._latency = latency
+
+    def create(self, file=None, model=None, **kwargs):
+        time.sleep(self._latency)
+        words = [ SimpleNamespace(word=w, start=i * 0.3, end=i * 0.3 + 0.25) for i, w in enumerate(STUB_TRANSCRIPT.split()) ]
+        return SimpleNamespace(text=STUB_TRANSCRIPT, words=words)
+
+'''
+Matches the parts of the OpenAI client interface that OpenMoxie uses
+'''
+class StubOpenAI:
+    def __init__(self, ai_settings=None):
+        ai_settings = ai_settings or {}
+        self.chat = SimpleNamespace(completions=_StubCompletions(ai_settings.get('llm_latency', _DEFAULT_LLM_LATENCY)))
+        self.audio = SimpleNamespace(transcriptions=_StubTranscriptions(ai_settings.get('stt_latency', _DEFAULT_STT_LATENCY)))
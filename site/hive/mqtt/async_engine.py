@@ -0,0 +1,249 @@
+'''
+ASYNC ENGINE - asyncio-native MQTT ingress for MoxieServer
+
+An optional alternative to paho's loop_start() network thread and the per-device worker
+lanes.  The paho client socket is driven directly from an asyncio event loop running in
+one thread, so message decoding and routing happen on the loop, and device work becomes
+tasks instead of queued thread work.  Blocking work (Django ORM, OpenAI) is pushed to two
+small bounded executors, so thousands of volleys can be in flight waiting on those without
+an OS thread each.
+
+Handlers submitted through the engine follow one convention: if the object owning the
+handler also has a coroutine named <handler>_async, that coroutine is awaited on the loop.
+Anything else runs whole on the bounded executor for its work class.  Work for one device
+stays in order within a work class, just like the dispatcher lanes, and work in flight per
+class is limited the same way (interactive_max_queue, background_max_queue).
+
+Enabled with settings.MOXIE_ENGINE = { 'mode': 'asyncio', ... }
+'''
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from .dispatcher import INTERACTIVE, BACKGROUND, DEFAULT_MAX_QUEUE, QueueLimits, WorkShed
+from .metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+ENGINE_THREADED = 'threaded'
+ENGINE_ASYNCIO = 'asyncio'
+
+_DEFAULT_DB_WORKERS = 4
+_DEFAULT_AI_WORKERS = 32
+_MISC_LOOP_INTERVAL = 1.0
+_RECONNECT_MIN_DELAY = 1.0
+_RECONNECT_MAX_DELAY = 30.0
+
+'''
+Binds the paho client socket to an event loop using the paho external loop callbacks.
+paho may ask to register for writing from any thread that publishes, so every loop
+change is marshalled onto the loop thread.
+'''
+class PahoAsyncioBridge:
+    def __init__(self, loop, client):
+        self._loop = loop
+        self._client = client
+        self._misc_task = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _on_loop(self, functor, *args):
+        self._loop.call_soon_threadsafe(functor, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._on_loop(self._open, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self._close, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self._loop.remove_writer, sock)
+
+    def _open(self, sock):
+        self._loop.add_reader(sock, self._client.loop_read)
+        if not self._misc_task:
+            self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _close(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        while True:
+            self._client.loop_misc()
+            await asyncio.sleep(_MISC_LOOP_INTERVAL)
+
+'''
+AsyncioEngine owns the event loop thread, the bounded executors and the per-device
+ordering.  MoxieServer delegates submit_work and publishing to it when enabled.
+'''
+class AsyncioEngine:
+    def __init__(self, client, engine_settings=None):
+        engine_settings = engine_settings or {}
+        self._client = client
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='moxie-asyncio', daemon=True)
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=engine_settings.get('db_workers', _DEFAULT_DB_WORKERS), thread_name_prefix='moxie-db')
+        self._ai_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=engine_settings.get('ai_workers', _DEFAULT_AI_WORKERS), thread_name_prefix='moxie-ai')
+        # Blocking handlers without an async variant run on the executor for their class
+        self._class_executors = { INTERACTIVE: self._ai_executor, BACKGROUND: self._db_executor }
+        self._device_locks = {}
+        self._in_flight = { INTERACTIVE: 0, BACKGROUND: 0 }
+        self._limits = QueueLimits({ wc: engine_settings.get(f'{wc}_max_queue', n) for wc, n in DEFAULT_MAX_QUEUE.items() })
+        # submit() runs on any thread
+        self._count_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._reconnect_delay = _RECONNECT_MIN_DELAY
+        self._running = False
+        if client:
+            self._bridge = PahoAsyncioBridge(self._loop, client)
+            client.on_disconnect = self.on_disconnect
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    # Start the loop thread, safe to call more than once
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._thread.start()
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._db_executor.shutdown(wait=False)
+        self._ai_executor.shutdown(wait=False)
+
+    # Same contract as DeviceDispatcher.shutdown
+    def shutdown(self, wait=True):
+        self.stop()
+
+    # Run on the loop thread, blocking the caller until complete
+    def call_on_loop(self, functor, *args):
+        if threading.current_thread() is self._thread:
+            return functor(*args)
+        async def _call():
+            return functor(*args)
+        return asyncio.run_coroutine_threadsafe(_call(), self._loop).result()
+
+    # Broker connect happens on the loop so socket callbacks bind to it
+    def connect(self, host, port, keepalive=60):
+        self.start()
+        self.call_on_loop(self._client.connect, host, port, keepalive)
+
+    # Unlike loop_start(), nothing reconnects for us.  Back off and retry until connected.
+    def on_disconnect(self, client, userdata, rc):
+        if rc != 0 and self._running:
+            logger.warning(f'MQTT connection lost ({rc}), reconnecting in {self._reconnect_delay}s')
+            self._loop.call_soon_threadsafe(self._loop.create_task, self._reconnect())
+
+    async def _reconnect(self):
+        await asyncio.sleep(self._reconnect_delay)
+        try:
+            self._client.reconnect()
+            self._reconnect_delay = _RECONNECT_MIN_DELAY
+        except Exception as e:
+            self._reconnect_delay = min(self._reconnect_delay * 2, _RECONNECT_MAX_DELAY)
+            logger.warning(f'MQTT reconnect failed: {e}, retry in {self._reconnect_delay}s')
+            self._loop.create_task(self._reconnect())
+
+    # Blocking Django ORM work, bounded to a few threads
+    async def run_db(self, functor, *args):
+        return await self._loop.run_in_executor(self._db_executor, functor, *args)
+
+    # Blocking inference / network work, bounded separately from the database
+    async def run_ai(self, functor, *args):
+        return await self._loop.run_in_executor(self._ai_executor, functor, *args)
+
+    # Publish from the loop, paho queues the packet and the bridge flushes it
+    async def publish(self, topic, payload, qos=0):
+        return self._client.publish(topic, payload=payload, qos=qos)
+
+    # Same contract as DeviceDispatcher.submit, callable from any thread, returns a Future
+    def submit(self, device_id, functor, *args, work_class=INTERACTIVE, sheddable=None):
+        if self._limits.refuse(work_class, self._in_flight[work_class], self._limits.max_queue(work_class), functor, sheddable):
+            future = concurrent.futures.Future()
+            future.set_exception(WorkShed(f'{work_class} queue full'))
+            return future
+        with self._count_lock:
+            self._submitted += 1
+            self._in_flight[work_class] += 1
+        owner = getattr(functor, '__self__', None)
+        async_functor = getattr(owner, functor.__name__ + '_async', None) if owner is not None else None
+        coro = self._run_ordered(device_id, work_class, functor, async_functor, args, time.perf_counter())
+        if threading.current_thread() is self._thread:
+            task = self._loop.create_task(coro)
+            future = concurrent.futures.Future()
+            task.add_done_callback(lambda t: self._copy_result(t, future))
+            return future
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    @staticmethod
+    def _copy_result(task, future):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception():
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    # Per device/class FIFO lock, removed again once nobody holds or waits on it.  Queue wait
+    # is until the device lock is held, run time includes any wait for an executor thread.
+    async def _run_ordered(self, device_id, work_class, functor, async_functor, args, queued_ts):
+        work = functor.__name__
+        wait_hist = histogram('moxie_work_queue_seconds', 'Time work waits in the dispatcher', work_class=work_class, work=work)
+        run_hist = histogram('moxie_work_run_seconds', 'Time running dispatched work', work_class=work_class, work=work)
+        key = (device_id, work_class)
+        entry = self._device_locks.get(key)
+        if not entry:
+            entry = [ asyncio.Lock(), 0 ]
+            self._device_locks[key] = entry
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                start = time.perf_counter()
+                wait_hist.observe(start - queued_ts)
+                try:
+                    if async_functor:
+                        return await async_functor(*args)
+                    return await self._loop.run_in_executor(self._class_executors[work_class], functor, *args)
+                finally:
+                    run_hist.observe(time.perf_counter() - start)
+        except Exception:
+            logger.exception(f'Error running {work_class} work for {device_id}:')
+            raise
+        finally:
+            with self._count_lock:
+                self._completed += 1
+                self._in_flight[work_class] -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._device_locks[key]
+
+    # Work submitted and not yet finished per work class, the engine's queue depth
+    def class_depths(self):
+        return dict(self._in_flight)
+
+    def metrics(self):
+        return { 'in_flight': dict(self._in_flight),
+                 'shed': { wc: self._limits.shed(wc) for wc in self._in_flight },
+                 'overflow': { wc: self._limits.overflow(wc) for wc in self._in_flight },
+                 'devices_active': len(self._device_locks),
+                 'submitted': self._submitted,
+                 'completed': self._completed }
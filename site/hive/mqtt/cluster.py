@@ -0,0 +1,147 @@
+'''
+CLUSTER - Run many MoxieServer worker processes with device affinity
+
+In clustered mode each worker process joins a group, announcing itself with a retained
+membership message (cleared by its last will if it dies).  Every worker builds the same
+consistent hash ring from the membership, so all agree which worker owns a device without
+talking to each other.  A worker only handles the messages of devices it owns, which keeps
+each device's sessions, RobotData record and ordering on one process.
+
+Membership changes move only the devices whose ring position changed owner.  The old owner
+releases them (saving persistent data), and the new owner adopts them on their next message
+through the normal missed-connect path.  See doc/Cluster.md for details.
+
+Enabled with settings.MOXIE_CLUSTER = { 'enabled': True, 'group': 'openmoxie', ... }
+'''
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_GROUP = 'openmoxie'
+_DEFAULT_VNODES = 128
+_CLUSTER_TOPIC_ROOT = 'openmoxie/cluster'
+
+# A worker id unique to this process when not set in settings
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+'''
+Consistent hash ring over worker ids, with virtual nodes to spread devices evenly.
+'''
+class HashRing:
+    def __init__(self, vnodes=_DEFAULT_VNODES):
+        self._vnodes = vnodes
+        self._members = set()
+        self._keys = []
+        self._owners = []
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def _rebuild(self):
+        points = sorted((self._hash(f'{m}#{v}'), m) for m in self._members for v in range(self._vnodes))
+        self._keys = [ p[0] for p in points ]
+        self._owners = [ p[1] for p in points ]
+
+    def add(self, member):
+        if member not in self._members:
+            self._members.add(member)
+            self._rebuild()
+            return True
+        return False
+
+    def remove(self, member):
+        if member in self._members:
+            self._members.discard(member)
+            self._rebuild()
+            return True
+        return False
+
+    def members(self):
+        return sorted(self._members)
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._owners[index]
+
+'''
+Cluster membership for one worker.  Owns the ring and answers ownership for a device,
+calling on_change(members) after the ring changes.
+'''
+class ClusterMembership:
+    def __init__(self, client, cluster_settings, worker_id=None, on_change=None):
+        self._client = client
+        self._group = cluster_settings.get('group', _DEFAULT_GROUP)
+        self._worker_id = worker_id or cluster_settings.get('worker_id') or default_worker_id()
+        self._ring = HashRing(cluster_settings.get('vnodes', _DEFAULT_VNODES))
+        self._ring.add(self._worker_id)
+        self._owner_cache = {}
+        self._lock = threading.Lock()
+        self._on_change = on_change
+        # If we vanish, the broker clears our retained membership for us
+        client.will_set(self.member_topic(self._worker_id), payload=b'', qos=1, retain=True)
+
+    @property
+    def worker_id(self):
+        return self._worker_id
+
+    @property
+    def group(self):
+        return self._group
+
+    def member_topic(self, worker_id):
+        return f'{_CLUSTER_TOPIC_ROOT}/{self._group}/members/{worker_id}'
+
+    def members_filter(self):
+        return f'{_CLUSTER_TOPIC_ROOT}/{self._group}/members/+'
+
+    # Topic other workers use to send this worker requests for devices it owns
+    def control_topic(self, worker_id=None):
+        return f'{_CLUSTER_TOPIC_ROOT}/{self._group}/control/{worker_id or self._worker_id}'
+
+    # Called from on_connect, announce ourselves and learn the other members
+    def join(self):
+        self._client.subscribe(self.members_filter(), qos=1)
+        self._client.subscribe(self.control_topic(), qos=1)
+        self._client.publish(self.member_topic(self._worker_id), payload=codec.dumps({ 'worker_id': self._worker_id }), qos=1, retain=True)
+        logger.info(f'Joined cluster group {self._group} as {self._worker_id}')
+
+    # Graceful shutdown, clear our membership so others take over right away
+    def leave(self):
+        self._client.publish(self.member_topic(self._worker_id), payload=b'', qos=1, retain=True)
+
+    # Retained membership message, empty payload means the worker left
+    def on_member_message(self, worker_id, payload):
+        if worker_id == self._worker_id:
+            return
+        with self._lock:
+            changed = self._ring.add(worker_id) if payload else self._ring.remove(worker_id)
+            if changed:
+                self._owner_cache = {}
+        if changed:
+            logger.info(f'Cluster {self._group} members now {self._ring.members()}')
+            if self._on_change:
+                self._on_change(self._ring.members())
+
+    def owner(self, device_id):
+        owner = self._owner_cache.get(device_id)
+        if owner is None:
+            with self._lock:
+                owner = self._ring.owner(device_id)
+                self._owner_cache[device_id] = owner
+        return owner
+
+    def owns(self, device_id):
+        return self.owner(device_id) == self._worker_id
+
+    def members(self):
+        return self._ring.members()
@@ -0,0 +1,44 @@
+'''
+CODEC - JSON encoding for MQTT payloads
+
+All JSON payloads to and from robots go through loads/dumps here.  Decoding reads the raw
+payload bytes directly and encoding produces bytes, so nothing goes through an extra str
+that paho would encode again.  When orjson is installed it is used, otherwise the standard
+library.  Both produce compact UTF-8 JSON.
+
+BACKENDS holds every available backend by name, for benchmarks and comparison.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # things orjson refuses (e.g. ints over 64 bits) that the standard library accepts
+        return _json_dumps(obj)
+
+BACKENDS = { 'json': (json.loads, _json_dumps) }
+if orjson:
+    BACKENDS['orjson'] = (orjson.loads, _orjson_dumps)
+
+BACKEND = 'orjson' if orjson else 'json'
+
+# loads decodes JSON from bytes (or str), dumps encodes to JSON bytes
+loads, dumps = BACKENDS[BACKEND]
+
+# dumps for bytes kept long term.  orjson can leave its output buffer over-allocated (about
+# 1KB for even tiny output), a copy holds only the bytes.
+def dumps_compact(obj):
+    return bytes(memoryview(dumps(obj)))
+
+# Deep copy of JSON data, faster than copy.deepcopy for plain dicts and lists
+def clone(obj):
+    return loads(dumps(obj))
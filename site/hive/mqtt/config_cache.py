@@ -0,0 +1,133 @@
+'''
+CONFIG CACHE - Merged robot configurations, built once per version
+
+A robot's config is the hive common config and settings deep merged with the robot's own.
+Building one takes a HiveConfiguration query and a deep merge, and it was rebuilt for every
+page view and config push.  The cache keeps the merged config (and its JSON bytes, for
+sending) per device, keyed by (device pk, device version, hive version).  Most robots have
+no config of their own, so equal configs are interned and share one dict and one payload.
+
+Versions are counters in memory, bumped by model save/delete signals in this process and by
+invalidate calls (MoxieServer.update_from_database, and device and hive config updates
+forwarded from other cluster workers).  A changed key rebuilds on the next request.  Cached
+configs are shared, callers must treat them as read-only.
+'''
+import threading
+from django.db.models.signals import post_save, post_delete
+from ..models import HiveConfiguration, MoxieDevice
+from . import codec
+
+# Device fields the merged config is built from, saves touching only others keep the cache
+_CONFIG_FIELDS = frozenset([ 'robot_config', 'robot_settings' ])
+# Distinct configs kept for interning before starting over
+_MAX_SHARED = 1024
+
+class _Entry:
+    __slots__ = ('key', 'config', 'payload')
+    def __init__(self, key, config, payload):
+        self.key = key
+        self.config = config
+        self.payload = payload
+
+'''
+ConfigCache holds the merged config entry per device, and the default hive config record.
+builder(device, hive_cfg) makes a merged config.
+'''
+class ConfigCache:
+    def __init__(self, builder):
+        self._builder = builder
+        self._lock = threading.Lock()
+        self._hive_version = 0
+        self._hive_cfg = None
+        self._hive_cfg_version = None
+        self._device_versions = {}
+        self._entries = {}
+        # (config, payload) by payload, for configs equal across devices
+        self._shared = {}
+        self._metrics = { 'hits': 0, 'builds': 0, 'invalidations': 0 }
+
+    # The default HiveConfiguration, queried once per hive version
+    def hive_config(self):
+        version = self._hive_version
+        if self._hive_cfg_version != version:
+            hive_cfg = HiveConfiguration.objects.filter(name='default').first()
+            with self._lock:
+                # unless it changed again while querying
+                if self._hive_version == version:
+                    self._hive_cfg = hive_cfg
+                    self._hive_cfg_version = version
+            return hive_cfg
+        return self._hive_cfg
+
+    def _entry(self, device):
+        key = (device.pk, self._device_versions.get(device.pk, 0), self._hive_version)
+        entry = self._entries.get(device.pk)
+        if entry and entry.key == key:
+            self._metrics['hits'] += 1
+            return entry
+        config = self._builder(device, self.hive_config())
+        payload = codec.dumps_compact(config)
+        if len(self._shared) > _MAX_SHARED:
+            # configs replaced by edits, entries keep their own references
+            self._shared.clear()
+        config, payload = self._shared.setdefault(payload, (config, payload))
+        entry = _Entry(key, config, payload)
+        self._metrics['builds'] += 1
+        if device.pk is not None:
+            self._entries[device.pk] = entry
+        return entry
+
+    # Merged config for a device
+    def get(self, device):
+        return self._entry(device).config
+
+    # Merged config for a device as JSON bytes
+    def get_payload(self, device):
+        return self._entry(device).payload
+
+    def device_changed(self, pk):
+        with self._lock:
+            self._device_versions[pk] = self._device_versions.get(pk, 0) + 1
+            self._metrics['invalidations'] += 1
+
+    def device_deleted(self, pk):
+        with self._lock:
+            self._device_versions.pop(pk, None)
+            self._entries.pop(pk, None)
+
+    def hive_changed(self):
+        with self._lock:
+            self._hive_version += 1
+            self._shared.clear()
+            self._metrics['invalidations'] += 1
+
+    # Rebuild everything on next use
+    def invalidate_all(self):
+        with self._lock:
+            self._hive_version += 1
+            self._entries.clear()
+            self._shared.clear()
+            self._metrics['invalidations'] += 1
+
+    # Invalidate on model changes saved in this process
+    def connect_signals(self):
+        post_save.connect(self._device_saved, sender=MoxieDevice, dispatch_uid='config_cache_device_saved')
+        post_delete.connect(self._device_deleted, sender=MoxieDevice, dispatch_uid='config_cache_device_deleted')
+        post_save.connect(self._hive_saved, sender=HiveConfiguration, dispatch_uid='config_cache_hive_saved')
+        post_delete.connect(self._hive_saved, sender=HiveConfiguration, dispatch_uid='config_cache_hive_deleted')
+
+    def _device_saved(self, sender, instance, update_fields=None, **kwargs):
+        if update_fields is None or _CONFIG_FIELDS.intersection(update_fields):
+            self.device_changed(instance.pk)
+
+    def _device_deleted(self, sender, instance, **kwargs):
+        self.device_deleted(instance.pk)
+
+    def _hive_saved(self, sender, instance, **kwargs):
+        self.hive_changed()
+
+    def metrics(self):
+        m = dict(self._metrics)
+        m['entries'] = len(self._entries)
+        m['shared'] = len(self._shared)
+        return m
@@ -10,9 +10,13 @@ from django.template import Template, Context
 from .ai_factory import create_openai
 from ..models import SinglePromptChat
 from .volley import Volley
+from .metrics import histogram
 
 logger = logging.getLogger(__name__)
 
+_CHAT_SECONDS = histogram('moxie_inference_seconds', 'OpenAI request latency', kind='chat')
+_SUMMARY_SECONDS = histogram('moxie_inference_seconds', 'OpenAI request latency', kind='summary')
+
 _DEFAULT_SUMMARY_PROMPT = "Summarize the following conversation between the friendly robot Moxie, and the user.  Keep the summary brief, but include any important details."
 
 '''
@@ -197,12 +201,13 @@ class SingleContextChatSession(ChatSession):
             self.add_history('user', speech, history)
         try:
             client = create_openai()
-            resp = client.chat.completions.create(
-                        model=self._model,
-                        messages=context + history,
-                        max_tokens=self._max_tokens,
-                        temperature=self._temperature
-                    ).choices[0].message.content
+            with _CHAT_SECONDS.time():
+                resp = client.chat.completions.create(
+                            model=self._model,
+                            messages=context + history,
+                            max_tokens=self._max_tokens,
+                            temperature=self._temperature
+                        ).choices[0].message.content
         except Exception as e:
             logger.warning(f'Exception attempting inference: {e}')
             resp = "Oh no.  I have run into a bug"
@@ -237,12 +242,13 @@ class SingleContextChatSession(ChatSession):
             msgs = [ { "role": "user", 
                 "content": prompt
                 } ]
-            resp = client.chat.completions.create(
-                    model=model,
-                    messages=msgs,
-                    max_tokens=max_tokens,
-                    temperature=self._temperature
-                    ).choices[0].message.content
+            with _SUMMARY_SECONDS.time():
+                resp = client.chat.completions.create(
+                        model=model,
+                        messages=msgs,
+                        max_tokens=max_tokens,
+                        temperature=self._temperature
+                        ).choices[0].message.content
             return resp
         except Exception as e:
             stack = traceback.format_exc()
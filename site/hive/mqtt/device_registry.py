@@ -0,0 +1,189 @@
+'''
+DEVICE REGISTRY - Live device records for RobotData
+
+Each connected robot has one DeviceRecord, moving through explicit states:
+- connecting: created when the robot is first seen, its database records are loading
+- loaded: schedule, config and persistent data are ready
+- releasing: the robot left, its records are being written back
+
+Records are kept in lock stripes (by the same stable hash as the dispatcher lanes), so
+lifecycle changes for different robots don't contend on one lock, and the paho thread,
+worker lanes and web views can all use the registry safely.  Work that arrives while a
+robot is connecting can wait for (or be run after) the load instead of seeing default
+data, through a Future made only when something waits.
+
+Records are compact, one per robot for a whole fleet.  Schedules and configs are shared
+between robots with the same ones, not copied.
+'''
+import concurrent.futures
+import logging
+import threading
+from .dispatcher import lane_index
+
+logger = logging.getLogger(__name__)
+
+CONNECTING = 'connecting'
+LOADED = 'loaded'
+RELEASING = 'releasing'
+
+_DEFAULT_STRIPES = 64
+
+'''
+Everything kept in memory for one live robot.  Fields are set by RobotData, single field
+updates need no lock.  schedule, config and config_payload may be shared with other robots
+and must not be changed in place, schedule_id is the pk schedule was loaded from.  persist is the PersistentData data for the row persist_pk.
+next_schedule is (schedule it was expanded from, JSON bytes) for the robot's next session.
+'''
+class DeviceRecord:
+    __slots__ = ('device_id', 'pk', 'status', 'loaded', 'schedule_id', 'schedule', 'config', 'config_payload',
+                 'persist_pk', 'persist', 'mbh', 'next_schedule', 'state', 'puppet_state')
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.pk = None
+        self.status = CONNECTING
+        self.loaded = None
+        self.schedule_id = None
+        self.schedule = None
+        self.config = None
+        self.config_payload = None
+        self.persist_pk = None
+        self.persist = None
+        self.mbh = None
+        self.next_schedule = None
+        self.state = None
+        self.puppet_state = None
+
+    @property
+    def is_loaded(self):
+        return self.status == LOADED
+
+'''
+DeviceRegistry holds the records, and makes every state change under the device's stripe lock.
+'''
+class DeviceRegistry:
+    def __init__(self, stripes=_DEFAULT_STRIPES):
+        self._stripes = [ (threading.Lock(), {}) for _ in range(max(1, stripes)) ]
+
+    def _stripe(self, device_id):
+        return self._stripes[lane_index(device_id, len(self._stripes))]
+
+    # The live record for a device, or None
+    def get(self, device_id):
+        return self._stripe(device_id)[1].get(device_id)
+
+    # Start connecting a device, returns (record, True) when it is new.  A device still
+    # releasing from an earlier connection gets a new record.
+    def begin_connect(self, device_id):
+        lock, records = self._stripe(device_id)
+        with lock:
+            rec = records.get(device_id)
+            if rec and rec.status != RELEASING:
+                return rec, False
+            rec = DeviceRecord(device_id)
+            records[device_id] = rec
+            return rec, True
+
+    # The record's Future, made when first needed.  None once the device isn't connecting.
+    def _waitable(self, rec):
+        lock, _ = self._stripe(rec.device_id)
+        with lock:
+            if rec.status != CONNECTING:
+                return None
+            if rec.loaded is None:
+                rec.loaded = concurrent.futures.Future()
+            return rec.loaded
+
+    # Loading finished, wakes anything waiting on the record.  The device stays connecting
+    # until all deferred work has been handed off, so new work can't run ahead of it.
+    def mark_loaded(self, rec):
+        lock, _ = self._stripe(rec.device_id)
+        while True:
+            with lock:
+                loaded, rec.loaded = rec.loaded, None
+                if loaded is None:
+                    if rec.status == CONNECTING:
+                        rec.status = LOADED
+                    return
+            # deferred while these callbacks ran, a new Future holds them for the next pass
+            if not loaded.done():
+                loaded.set_result(rec)
+
+    # Loading failed, the record is dropped so the next message from the robot retries
+    def mark_failed(self, rec, exc):
+        lock, records = self._stripe(rec.device_id)
+        with lock:
+            if records.get(rec.device_id) is rec:
+                del records[rec.device_id]
+            # no longer connecting, nothing new waits on it
+            rec.status = RELEASING
+            loaded, rec.loaded = rec.loaded, None
+        if loaded and not loaded.done():
+            loaded.set_exception(exc)
+
+    # Start releasing a device, returns its record or None if it has none
+    def begin_release(self, device_id):
+        lock, records = self._stripe(device_id)
+        with lock:
+            rec = records.get(device_id)
+            if rec is None or rec.status == RELEASING:
+                return None
+            rec.status = RELEASING
+            return rec
+
+    # Remove a record, unless it has already been replaced by a newer connection
+    def remove(self, rec):
+        lock, records = self._stripe(rec.device_id)
+        with lock:
+            if records.get(rec.device_id) is rec:
+                del records[rec.device_id]
+
+    # Devices connecting or loaded
+    def device_ids(self):
+        result = []
+        for lock, records in self._stripes:
+            with lock:
+                result.extend(d for d, rec in records.items() if rec.status != RELEASING)
+        return result
+
+    def is_online(self, device_id):
+        rec = self.get(device_id)
+        return rec is not None and rec.status != RELEASING
+
+    # Call functor(*args) once the device is loaded, right away if it isn't loading.  Deferred
+    # calls run on the thread finishing the load, so they should only hand work off (e.g. to
+    # the device's lane), and the device is still connecting, so they must not defer again.
+    # Returns True if the call was deferred.
+    def when_loaded(self, device_id, functor, *args):
+        rec = self.get(device_id)
+        loaded = self._waitable(rec) if rec else None
+        if loaded is None:
+            functor(*args)
+            return False
+        def _call(future):
+            try:
+                functor(*args)
+            except Exception:
+                logger.exception(f'Error running work deferred until {device_id} loaded:')
+        loaded.add_done_callback(_call)
+        return True
+
+    # Block until the device is loaded, True if it is (or has no live record)
+    def wait_loaded(self, device_id, timeout=None):
+        rec = self.get(device_id)
+        loaded = self._waitable(rec) if rec else None
+        if loaded is None:
+            return True
+        try:
+            loaded.result(timeout)
+            return True
+        except Exception:
+            return False
+
+    # Record count per status
+    def counts(self):
+        result = { CONNECTING: 0, LOADED: 0, RELEASING: 0 }
+        for lock, records in self._stripes:
+            with lock:
+                for rec in records.values():
+                    result[rec.status] += 1
+        return result
@@ -0,0 +1,232 @@
+'''
+DISPATCHER - Ordered, per-device work lanes for the Moxie services
+
+All background work from MoxieServer and its plugins (RemoteChat, STT) is submitted
+here instead of to private thread pools.  Work is hashed by device_id onto a fixed
+lane (one thread + one FIFO queue), so everything for a single robot runs in the order
+it arrived while different robots run in parallel on other lanes.
+
+Work is split into classes, each with its own set of lanes, so slow background work
+(state saves, completion hooks) never queues in front of interactive work (volleys,
+schedule queries, STT) for the same device.  Ordering is guaranteed per device within
+a class, not across classes.
+
+Each class has a maximum queue depth, split evenly over its lanes.  Work submitted to a full
+lane is refused if it may be shed (background work, unless the caller says it must run),
+its Future fails with WorkShed.  Work that must run, like every interactive volley, is
+still queued and counted as overflow, since blocking would stall the MQTT network thread
+that submits it.
+'''
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+import zlib
+from .metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+# Work classes
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# Lanes per work class when not provided in settings
+DEFAULT_LANE_COUNTS = { INTERACTIVE: 8, BACKGROUND: 2 }
+# Most queued work per work class, above the admission high watermarks
+DEFAULT_MAX_QUEUE = { INTERACTIVE: 4000, BACKGROUND: 10000 }
+
+# Stable hash of a device onto a lane index, identical across processes and restarts
+def lane_index(device_id, lane_count):
+    if not device_id:
+        return 0
+    return zlib.crc32(device_id.encode('utf-8')) % lane_count
+
+# Set on the Future of work refused because its queue was full
+class WorkShed(Exception):
+    pass
+
+'''
+Queue limits per work class, shared by the dispatcher and the asyncio engine.  Counts work
+refused (shed) and work queued past the limit because it must run (overflow).
+'''
+class QueueLimits:
+    def __init__(self, max_queue):
+        self._max_queue = max_queue
+        self._lock = threading.Lock()
+        self._shed = { wc: 0 for wc in max_queue }
+        self._overflow = { wc: 0 for wc in max_queue }
+
+    # True if work should be refused at this depth.  sheddable defaults to True for background work.
+    def refuse(self, work_class, depth, limit, functor, sheddable=None):
+        if depth < limit:
+            return False
+        if sheddable is None:
+            sheddable = work_class == BACKGROUND
+        work = getattr(functor, '__name__', None) or type(functor).__name__
+        with self._lock:
+            if sheddable:
+                self._shed[work_class] += 1
+            else:
+                self._overflow[work_class] += 1
+        if sheddable:
+            logger.warning(f'{work_class} queue full, shed {work}')
+        else:
+            logger.warning(f'{work_class} queue past its limit of {limit}, queued {work} anyway')
+        return sheddable
+
+    def max_queue(self, work_class):
+        return self._max_queue[work_class]
+
+    def shed(self, work_class):
+        return self._shed[work_class]
+
+    def overflow(self, work_class):
+        return self._overflow[work_class]
+
+'''
+A single ordered lane, one worker thread pulling work from one FIFO queue.  Queue wait
+and run time are recorded per work class and work function.
+'''
+class WorkLane:
+    def __init__(self, name, work_class=INTERACTIVE):
+        self._name = name
+        self._work_class = work_class
+        # bounded by DeviceDispatcher.submit, work that must run can't be refused here
+        self._queue = queue.SimpleQueue()
+        # put() runs on any thread, the lane thread alone counts completions
+        self._count_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._histograms = {}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, future, functor, args):
+        with self._count_lock:
+            self._submitted += 1
+        self._queue.put((future, functor, args, time.perf_counter()))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    @property
+    def submitted(self):
+        return self._submitted
+
+    @property
+    def completed(self):
+        return self._completed
+
+    # Queue the stop marker, the lane drains everything queued before it
+    def stop(self):
+        self._queue.put(None)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    # Queue wait and run histograms for a work function, by name so sessions aren't kept alive
+    def _histograms_for(self, functor):
+        work = getattr(functor, '__name__', None) or type(functor).__name__
+        hists = self._histograms.get(work)
+        if hists is None:
+            hists = (histogram('moxie_work_queue_seconds', 'Time work waits in the dispatcher', work_class=self._work_class, work=work),
+                     histogram('moxie_work_run_seconds', 'Time running dispatched work', work_class=self._work_class, work=work))
+            self._histograms[work] = hists
+        return hists
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, functor, args, queued_ts = item
+            wait_hist, run_hist = self._histograms_for(functor)
+            start = time.perf_counter()
+            wait_hist.observe(start - queued_ts)
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(functor(*args))
+                except Exception as e:
+                    logger.exception(f'Error running work on lane {self._name}:')
+                    future.set_exception(e)
+            run_hist.observe(time.perf_counter() - start)
+            self._completed += 1
+
+'''
+DeviceDispatcher owns the lanes for every work class and routes submitted work by
+device_id.  Lane counts and queue limits come from settings.MOXIE_DISPATCHER, e.g.
+{ 'interactive_lanes': 8, 'background_lanes': 2, 'background_max_queue': 10000 }
+'''
+class DeviceDispatcher:
+    def __init__(self, lane_counts=None, max_queue=None):
+        counts = DEFAULT_LANE_COUNTS.copy()
+        if lane_counts:
+            counts.update(lane_counts)
+        limits = DEFAULT_MAX_QUEUE.copy()
+        if max_queue:
+            limits.update(max_queue)
+        self._limits = QueueLimits(limits)
+        self._lanes = {}
+        self._lane_limits = {}
+        for work_class, count in counts.items():
+            self._lanes[work_class] = [ WorkLane(f'{work_class}-{i}', work_class) for i in range(max(1, int(count))) ]
+            self._lane_limits[work_class] = max(1, limits[work_class] // len(self._lanes[work_class]))
+        logger.info(f'Dispatcher lanes: { {wc: len(lanes) for wc, lanes in self._lanes.items()} }')
+
+    @staticmethod
+    def from_settings(dispatcher_settings):
+        dispatcher_settings = dispatcher_settings or {}
+        counts = {}
+        max_queue = {}
+        for work_class in DEFAULT_LANE_COUNTS.keys():
+            if f'{work_class}_lanes' in dispatcher_settings:
+                counts[work_class] = dispatcher_settings[f'{work_class}_lanes']
+            if f'{work_class}_max_queue' in dispatcher_settings:
+                max_queue[work_class] = dispatcher_settings[f'{work_class}_max_queue']
+        return DeviceDispatcher(counts, max_queue)
+
+    # Queue work for a device, returns a Future for the result.  sheddable says if the work may
+    # be refused when its lane is full, by default only background work may.
+    def submit(self, device_id, functor, *args, work_class=INTERACTIVE, sheddable=None):
+        lanes = self._lanes[work_class]
+        lane = lanes[lane_index(device_id, len(lanes))]
+        future = concurrent.futures.Future()
+        if self._limits.refuse(work_class, lane.depth(), self._lane_limits[work_class], functor, sheddable):
+            future.set_exception(WorkShed(f'{work_class} queue full'))
+            return future
+        lane.put(future, functor, args)
+        return future
+
+    # Current queued work per lane, by work class
+    def queue_depths(self):
+        return { wc: [lane.depth() for lane in lanes] for wc, lanes in self._lanes.items() }
+
+    # Total queued work per work class
+    def class_depths(self):
+        return { wc: sum(lane.depth() for lane in lanes) for wc, lanes in self._lanes.items() }
+
+    # Summary metrics per work class
+    def metrics(self):
+        result = {}
+        for wc, lanes in self._lanes.items():
+            depths = [lane.depth() for lane in lanes]
+            result[wc] = { 'lanes': len(lanes),
+                           'queued': sum(depths),
+                           'max_depth': max(depths),
+                           'submitted': sum(lane.submitted for lane in lanes),
+                           'completed': sum(lane.completed for lane in lanes),
+                           'max_queue': self._limits.max_queue(wc),
+                           'shed': self._limits.shed(wc),
+                           'overflow': self._limits.overflow(wc) }
+        return result
+
+    # Stop all lanes, optionally waiting for queued work to finish
+    def shutdown(self, wait=True):
+        for lanes in self._lanes.values():
+            for lane in lanes:
+                lane.stop()
+        if wait:
+            for lanes in self._lanes.values():
+                for lane in lanes:
+                    lane.join()
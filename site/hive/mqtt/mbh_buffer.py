@@ -0,0 +1,172 @@
+'''
+MBH BUFFER - Batched writes of ingested mentor behaviors
+
+Robots report each mentor behavior (MBH) as it happens, and each used to cost a device
+query and a single row insert in its own transaction.  Reports are now buffered per device
+and written with bulk_create by a background thread, every flush_interval seconds or sooner
+once flush_size records are waiting.  Device primary keys come from the live device
+records, so a flush is one insert per batch and a lookup only for robots not loaded.
+
+Connected robots read their history from the MBH index, which has buffered records right
+away.  Anything reading MBH from the database flushes the device first, and departing
+robots and shutdown flush too.
+
+Records missing a required field are refused by put().  If a batch still fails, each device
+and then each record is written on its own, so one bad record can't hold back the rest.
+Records the database rejects are logged, counted and dropped, the rest are kept for the
+next flush when the database itself is failing (e.g. locked).
+
+Settings come from settings.MOXIE_MBH_BUFFER.
+'''
+import logging
+import threading
+import time
+from django.db import DataError, IntegrityError
+from ..models import MoxieDevice, MentorBehavior
+from .metrics import histogram
+from .util import run_db_atomic
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_FLUSH_INTERVAL = 1.0
+_DEFAULT_FLUSH_SIZE = 200
+# Rows per INSERT statement
+_INSERT_BATCH = 200
+# NOT NULL columns without a default, a record missing one can never be written
+_REQUIRED_FIELDS = ('timestamp', 'instance_id')
+# Errors from the record itself, retrying won't help
+_BAD_RECORD_ERRORS = (IntegrityError, DataError, ValueError, TypeError)
+
+'''
+MbhBuffer holds unwritten records per device as (device pk or None, mbh dict).  put() only
+touches memory and is safe from any thread.
+'''
+class MbhBuffer:
+    def __init__(self, buffer_settings=None):
+        buffer_settings = buffer_settings or {}
+        self._flush_interval = buffer_settings.get('flush_interval', _DEFAULT_FLUSH_INTERVAL)
+        self._flush_size = buffer_settings.get('flush_size', _DEFAULT_FLUSH_SIZE)
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._count = 0
+        self._flush_lock = threading.Lock()
+        self._flush_hist = histogram('moxie_mbh_flush_seconds', 'Time writing a batch of mentor behaviors')
+        self._metrics = { 'puts': 0, 'flushes': 0, 'written': 0, 'missing': 0, 'rejected': 0, 'errors': 0 }
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='moxie-mbh-buffer', daemon=True)
+        self._thread.start()
+
+    # Buffer a record for a device, device_pk may be None if unknown.  Returns False if the
+    # record was refused.
+    def put(self, device_id, device_pk, mbh):
+        missing = [ field for field in _REQUIRED_FIELDS if mbh.get(field) is None ]
+        if missing:
+            self._metrics['rejected'] += 1
+            logger.warning(f'Dropped mentor behavior for {device_id} without {", ".join(missing)}: {mbh}')
+            return False
+        with self._cond:
+            self._pending.setdefault(device_id, []).append((device_pk, mbh))
+            self._count += 1
+            self._metrics['puts'] += 1
+            if self._count >= self._flush_size:
+                self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._count >= self._flush_size or not self._running, self._flush_interval)
+                if not self._running:
+                    return
+            self.flush()
+
+    # Write buffered records, for every device or just those listed.  Returns the rows written.
+    def flush(self, device_ids=None):
+        with self._flush_lock:
+            with self._cond:
+                if device_ids is None:
+                    batch = self._pending
+                    self._pending = {}
+                else:
+                    batch = { d: self._pending.pop(d) for d in device_ids if d in self._pending }
+                self._count -= sum(len(recs) for recs in batch.values())
+            if not batch:
+                return 0
+            start = time.perf_counter()
+            try:
+                written = run_db_atomic(self._write, batch)
+            except Exception:
+                self._metrics['errors'] += 1
+                logger.exception(f'Error writing mentor behaviors for {len(batch)} devices, writing them apart:')
+                written, retry = self._write_apart(batch)
+                # keep them for the next flush, ahead of anything newer
+                with self._cond:
+                    for device_id, recs in retry.items():
+                        self._pending[device_id] = recs + self._pending.get(device_id, [])
+                        self._count += len(recs)
+            self._flush_hist.observe(time.perf_counter() - start)
+            self._metrics['flushes'] += 1
+            self._metrics['written'] += written
+            return written
+
+    # Write each device, and each record of a failing device, in its own transaction.  Returns
+    # (rows written, records to retry by device).  Any other error means the database itself is
+    # failing, everything not yet written is retried.
+    def _write_apart(self, batch):
+        written = 0
+        retry = {}
+        for device_id, recs in batch.items():
+            if retry:
+                retry[device_id] = recs
+                continue
+            try:
+                written += run_db_atomic(self._write, { device_id: recs })
+                continue
+            except _BAD_RECORD_ERRORS:
+                pass
+            except Exception:
+                retry[device_id] = recs
+                continue
+            for i, rec in enumerate(recs):
+                try:
+                    written += run_db_atomic(self._write, { device_id: [ rec ] })
+                except _BAD_RECORD_ERRORS:
+                    self._metrics['rejected'] += 1
+                    logger.exception(f'Dropped mentor behavior for {device_id}: {rec[1]}')
+                except Exception:
+                    retry[device_id] = recs[i:]
+                    break
+        return written, retry
+
+    # Runs inside a transaction
+    def _write(self, batch):
+        unknown = [ device_id for device_id, recs in batch.items() if any(pk is None for pk, _ in recs) ]
+        pks = dict(MoxieDevice.objects.filter(device_id__in=unknown).values_list('device_id', 'id')) if unknown else {}
+        rows = []
+        missing = 0
+        for device_id, recs in batch.items():
+            for device_pk, mbh in recs:
+                device_pk = device_pk or pks.get(device_id)
+                if device_pk is None:
+                    missing += 1
+                    continue
+                row = MentorBehavior(device_id=device_pk)
+                row.__dict__.update(mbh)
+                rows.append(row)
+        MentorBehavior.objects.bulk_create(rows, batch_size=_INSERT_BATCH)
+        # only once written, a failed batch is written again
+        self._metrics['missing'] += missing
+        return len(rows)
+
+    def metrics(self):
+        m = dict(self._metrics)
+        m['pending'] = self._count
+        return m
+
+    # Stop the flush thread and write everything buffered
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
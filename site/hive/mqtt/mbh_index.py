@@ -0,0 +1,95 @@
+'''
+MBH INDEX - In memory mentor behavior history for a connected robot
+
+Robots ask for their full mentor behavior (MBH) history at the start of every session, and
+long time users have thousands of records.  Rather than a query and a model_to_dict per
+row each time, the history is loaded once when the robot connects and kept here as a time
+sorted list of compact tuples, with counts by module, content and action (and by module and
+action alone, for the FTUE completion checks in schedule expansion), and the time each module
+was last completed, for schedule recency.  Ingested records are added in place.  The JSON
+array sent to the robot is encoded once and reused until the history changes.
+'''
+import bisect
+import threading
+from . import codec
+
+# MentorBehavior fields sent to the robot, in model order
+MBH_FIELDS = ('module_id', 'content_id', 'content_day', 'timestamp', 'action', 'instance_id', 'ended_reason')
+_TIMESTAMP = MBH_FIELDS.index('timestamp')
+_MODULE_ID = MBH_FIELDS.index('module_id')
+_CONTENT_ID = MBH_FIELDS.index('content_id')
+_ACTION = MBH_FIELDS.index('action')
+_COMPLETED = 'COMPLETED'
+
+'''
+MbhIndex holds one robot's history, oldest first.  Rows are tuples in MBH_FIELDS order.
+'''
+class MbhIndex:
+    __slots__ = ('_lock', '_rows', '_timestamps', '_counts', '_module_actions', '_completed', '_payload')
+    def __init__(self, rows=()):
+        self._lock = threading.Lock()
+        self._rows = sorted(rows, key=lambda row: row[_TIMESTAMP])
+        self._timestamps = [ row[_TIMESTAMP] for row in self._rows ]
+        self._counts = {}
+        self._module_actions = {}
+        self._completed = {}
+        for row in self._rows:
+            self._count(row)
+        self._payload = None
+
+    def _count(self, row):
+        key = (row[_MODULE_ID], row[_CONTENT_ID], row[_ACTION])
+        self._counts[key] = self._counts.get(key, 0) + 1
+        key = (row[_MODULE_ID], row[_ACTION])
+        self._module_actions[key] = self._module_actions.get(key, 0) + 1
+        if row[_ACTION] == _COMPLETED:
+            module_id = row[_MODULE_ID]
+            last = self._completed.get(module_id)
+            if last is None or (row[_TIMESTAMP] or 0) > last:
+                self._completed[module_id] = row[_TIMESTAMP] or 0
+
+    # Add a record, from a dict of MBH fields.  Records without a timestamp are never written
+    # (the column is NOT NULL), so they aren't indexed either.
+    def add(self, mbh):
+        row = tuple(mbh.get(field) for field in MBH_FIELDS)
+        if row[_TIMESTAMP] is None:
+            return
+        with self._lock:
+            index = bisect.bisect_right(self._timestamps, row[_TIMESTAMP])
+            self._timestamps.insert(index, row[_TIMESTAMP])
+            self._rows.insert(index, row)
+            self._count(row)
+            self._payload = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Records as dicts, most recent first
+    def records(self):
+        return [ dict(zip(MBH_FIELDS, row)) for row in reversed(self._rows) ]
+
+    # JSON array of records() as bytes, encoded once per change
+    def payload(self):
+        payload = self._payload
+        if payload is None:
+            with self._lock:
+                payload = self._payload = codec.dumps_compact(self.records())
+        return payload
+
+    # Completions of a module as (count, last completed timestamp or None)
+    def completions(self, module_id):
+        return self._module_actions.get((module_id, _COMPLETED), 0), self._completed.get(module_id)
+
+    # Count records matching any of module, content and action
+    def count(self, module_id=None, content_id=None, action=None):
+        if content_id is None:
+            if module_id is not None and action is not None:
+                return self._module_actions.get((module_id, action), 0)
+            # far fewer (module, action) totals than (module, content, action) ones
+            return sum(n for (m, a), n in list(self._module_actions.items())
+                       if (module_id is None or m == module_id) and (action is None or a == action))
+        total = 0
+        for (m, c, a), n in list(self._counts.items()):
+            if (module_id is None or m == module_id) and c == content_id and (action is None or a == action):
+                total += n
+        return total
@@ -0,0 +1,180 @@
+'''
+METRICS - Low overhead latency histograms for the MQTT services
+
+Histograms use fixed buckets, so recording a value is a bisect and a few increments.  They
+are kept in one registry by name and labels, and rendered as Prometheus text for the
+/metrics endpoint (or a small standalone HTTP server for mqtt_worker processes), and as a
+percentile summary for the dashboard.
+
+Timed stages:
+- moxie_route_decode_seconds / moxie_route_handler_seconds: per event and message route
+- moxie_work_queue_seconds / moxie_work_run_seconds: dispatcher wait and run, per work item
+- moxie_inference_seconds: OpenAI chat requests
+- moxie_markup_seconds: automarkup of responses
+- moxie_stt_seconds: STT audio encode and transcribe
+- moxie_publish_queue_seconds / moxie_publish_ack_seconds: outbound queue wait and broker ack
+'''
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from 100us to 30s, roughly 2.5x apart
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+'''
+A histogram of values (seconds) in fixed buckets, with the count and sum.  Observing is
+not locked, it is on every message path.  Racing threads can rarely lose an increment,
+which is fine for metrics.
+'''
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Context manager timing the block into this histogram
+    def time(self):
+        return _Timer(self)
+
+    # Estimate a quantile by interpolating inside its bucket
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= target and bucket_count:
+                low = self.buckets[index - 1] if index > 0 else 0.0
+                high = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (target - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _label_text(key, extra=None):
+    items = list(key) + ([ extra ] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+'''
+All metrics by name and labels.  Gauges are functions called when rendering, returning a
+value or a dict of { label dict tuple: value }.
+'''
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+    def histogram(self, name, help='', **labels):
+        key = (name, _label_key(labels))
+        hist = self._histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(key, Histogram())
+                self._help.setdefault(name, help)
+        return hist
+
+    # Register (or replace) a gauge computed when rendered
+    def gauge(self, name, functor, help=''):
+        with self._lock:
+            self._gauges[name] = functor
+            self._help[name] = help
+
+    def _sorted(self, metrics):
+        with self._lock:
+            return sorted(metrics.items())
+
+    # Prometheus text exposition format
+    def render_prometheus(self):
+        lines = []
+        last_name = None
+        for (name, key), hist in self._sorted(self._histograms):
+            if name != last_name:
+                lines.append(f'# HELP {name} {self._help.get(name, "")}')
+                lines.append(f'# TYPE {name} histogram')
+                last_name = name
+            cumulative = 0
+            for bucket, bucket_count in zip(hist.buckets, hist.counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_label_text(key, ("le", bucket))} {cumulative}')
+            lines.append(f'{name}_bucket{_label_text(key, ("le", "+Inf"))} {hist.count}')
+            lines.append(f'{name}_sum{_label_text(key)} {hist.sum}')
+            lines.append(f'{name}_count{_label_text(key)} {hist.count}')
+        for name, functor in self._sorted(self._gauges):
+            try:
+                values = functor()
+            except Exception:
+                logger.exception(f'Error reading gauge {name}:')
+                continue
+            lines.append(f'# HELP {name} {self._help.get(name, "")}')
+            lines.append(f'# TYPE {name} gauge')
+            if isinstance(values, dict):
+                for labels, value in values.items():
+                    lines.append(f'{name}{_label_text(labels)} {value}')
+            else:
+                lines.append(f'{name} {values}')
+        return '\n'.join(lines) + '\n'
+
+    # Percentile summary of every histogram with data, for the dashboard
+    def summary(self):
+        result = []
+        for (name, key), hist in self._sorted(self._histograms):
+            if hist.count:
+                result.append({ 'name': name, 'labels': ' '.join(f'{k}={v}' for k, v in key), 'count': hist.count,
+                                'avg_ms': hist.sum / hist.count * 1000, 'p50_ms': hist.quantile(0.5) * 1000,
+                                'p95_ms': hist.quantile(0.95) * 1000, 'p99_ms': hist.quantile(0.99) * 1000 })
+        return result
+
+REGISTRY = MetricsRegistry()
+
+def histogram(name, help='', **labels):
+    return REGISTRY.histogram(name, help, **labels)
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics from a background thread, for processes without the web server
+def start_http_server(port, host='0.0.0.0'):
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='moxie-metrics', daemon=True).start()
+    logger.info(f'Serving metrics on {host}:{port}')
+    return server
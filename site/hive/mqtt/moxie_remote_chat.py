@@ -10,7 +10,6 @@ the remote service everytime it says something.  This data is used to accumulate
 history of the conversation and provides mostly seemless conversation context for the AI,
 even when the user provides input in multiple speech windows before hearing a response.
 '''
-import concurrent.futures
 from ..models import SinglePromptChat
 from ..automarkup import process as automarkup_process
 from ..automarkup import initialize_rules as automarkup_initialize_rules
@@ -19,15 +18,18 @@ from datetime import datetime
 from .global_responses import GlobalResponses
 from .conversations import ChatSession, SinglePromptDBChatSession
 from .volley import Volley
+from .dispatcher import BACKGROUND
+from .metrics import histogram
 
 # Turn on to enable global commands in the cloud
 _ENABLE_GLOBAL_COMMANDS = True
 _LOG_ALL_RCR = False
 _LOG_NOTIFY_RCR = True
-_MAX_WORKER_THREADS = 5
 
 logger = logging.getLogger(__name__)
 
+_MARKUP_SECONDS = histogram('moxie_markup_seconds', 'Automarkup time per response')
+
 '''
 RemoteChat is the plugin to the MoxieServer that handles all remote module requests.  It
 keeps track of the active remote module, creates new ones as needed, and ignores all data
@@ -41,7 +43,6 @@ class RemoteChat:
         self._device_sessions = {}
         self._modules = { }
         self._modules_info = { "modules": [], "version": "openmoxie_v1" }
-        self._worker_queue = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKER_THREADS)
         self._automarkup_rules = automarkup_initialize_rules()
         self._global_responses = GlobalResponses()
 
@@ -87,7 +88,7 @@ class RemoteChat:
         if session.has_complete_hook():
             # make a data-only Volley for the completion hook
             volley = Volley({}, device_id=device_id, data_only=True, robot_data=self._server.robot_data().get_volley_data(device_id), local_data=session.local_data)
-            self._worker_queue.submit(session.complete_hook, volley)
+            self._server.submit_work(device_id, session.complete_hook, volley, work_class=BACKGROUND, sheddable=False)
 
     # Get the current or a new session for this device for this module/content ID pair
     def active_session_data(self, device_id):
@@ -109,6 +110,14 @@ class RemoteChat:
         self._device_sessions[device_id] = new_session
         return new_session['session']
 
+    # End any active session for this device, returns True if there was one
+    def end_session(self, device_id):
+        session = self._device_sessions.pop(device_id, None)
+        if session:
+            self.on_chat_complete(device_id, session['id'], session['session'])
+            return True
+        return False
+
     # Get's a chat session object for use in the web chat
     def get_web_session_for_module(self, device_id, module_id, content_id):
         id = module_id + '/' + content_id
@@ -127,10 +136,21 @@ class RemoteChat:
 
     # Markup text      
     def make_markup(self, text, mood_and_intensity = None):
-        return automarkup_process(text, self._automarkup_rules, mood_and_intensity=mood_and_intensity)
+        with _MARKUP_SECONDS.time():
+            return automarkup_process(text, self._automarkup_rules, mood_and_intensity=mood_and_intensity)
 
     # Get the next response to a chat
     def create_session_response(self, device_id, sess:ChatSession, volley: Volley):
+        self.render_session_response(sess, volley)
+        self._server.send_command_to_bot_json(device_id, 'remote_chat', volley.response)
+
+    # asyncio engine variant, inference and markup run on the bounded AI executor
+    async def create_session_response_async(self, device_id, sess:ChatSession, volley: Volley):
+        await self._server.engine().run_ai(self.render_session_response, sess, volley)
+        await self._server.send_command_to_bot_json_async(device_id, 'remote_chat', volley.response)
+
+    # Run the session inference for a volley, and markup the result
+    def render_session_response(self, sess:ChatSession, volley: Volley):
         sess.handle_volley(volley)
         if 'markup' not in volley.response['output']:
             # if we don't have markup, create it
@@ -139,17 +159,24 @@ class RemoteChat:
 
         if _LOG_ALL_RCR:
             logger.info(f"RemoteChatResponse\n{volley.response}")
-        self._server.send_command_to_bot_json(device_id, 'remote_chat', volley.response)
     
     # Produce / execute a global response
     def global_response(self, device_id, functor):
+        self._server.send_command_to_bot_json(device_id, 'remote_chat', self.render_global_response(functor))
+
+    # asyncio engine variant, global methods may run user code so they stay off the loop
+    async def global_response_async(self, device_id, functor):
+        resp = await self._server.engine().run_ai(self.render_global_response, functor)
+        await self._server.send_command_to_bot_json_async(device_id, 'remote_chat', resp)
+
+    # Execute a global response functor, and markup the result
+    def render_global_response(self, functor):
         resp = functor()
         output = resp.get('output')
         if output.get('text') and not output.get('markup'):
             # Run automarkup on any text-only responses
             output['markup'] = self.make_markup(output['text'])
-        self._server.send_command_to_bot_json(device_id, 'remote_chat', resp)
-        pass
+        return resp
 
     def log_notify(self, rcr):
         moxie_speech = rcr.get('speech')
@@ -179,14 +206,10 @@ class RemoteChat:
             else:
                 volley = Volley(rcr, device_id=device_id, robot_data=volley_data, local_data=sess.local_data)
                 if not self.handled_global(device_id, volley):
-                    self._worker_queue.submit(self.create_session_response, device_id, sess, volley)
+                    self._server.submit_work(device_id, self.create_session_response, device_id, sess, volley)
         else:
             # THIS IS THE PATH FOR MOXIE ON-BOARD CONTENT
-            session_reset = False
-            if device_id in self._device_sessions:
-                session = self._device_sessions.pop(device_id, None)
-                self.on_chat_complete(device_id, session['id'], session['session'])
-                session_reset = True
+            session_reset = self.end_session(device_id)
             if cmd != 'notify':
                 volley = Volley(rcr, device_id=device_id, robot_data=volley_data)
                 if not self.handled_global(device_id, volley):
@@ -200,6 +223,6 @@ class RemoteChat:
         global_functor = self.check_global(volley)
         if global_functor:
             logger.debug(f'Global response inside {id}')
-            self._worker_queue.submit(self.global_response, device_id, global_functor)
+            self._server.submit_work(device_id, self.global_response, device_id, global_functor)
             return True
         return False
@@ -1,14 +1,12 @@
 '''
 MOXIE SERVER - Primary service handler for Moxie
 '''
-import concurrent
-import paho.mqtt.client as mqtt
+import asyncio
 import json
 import time
 import re
 import logging
 import base64
-import ssl
 from .ai_factory import set_openai_key
 from .robot_credentials import RobotCredentials
 from .robot_data import RobotData
@@ -17,7 +15,19 @@ from .protos.embodied.logging.Log_pb2 import ProtoSubscribe
 from .protos.embodied.logging.Cloud2_pb2 import ServiceConfiguration2
 from .protos.embodied.wifiapp.QRCommands_pb2 import StartPairingQR
 from .zmq_stt_handler import STTHandler
-from ..models import HiveConfiguration
+from .routing import TopicRouter
+from .publisher import OutboundPublisher, encode_json, encode_zmq, no_wait
+from .dispatcher import DeviceDispatcher, INTERACTIVE, BACKGROUND
+from .async_engine import AsyncioEngine, ENGINE_ASYNCIO, ENGINE_THREADED
+from .cluster import ClusterMembership, default_worker_id
+from .transport import create_paho_transport
+from .admission import AdmissionController
+from .timers import TimerQueue
+from .metrics import REGISTRY as METRICS
+from . import codec
+from ..models import HiveConfiguration, MoxieDevice, MoxieSchedule
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
 
 _BASIC_FORMAT = '{1}'
 _MOXIE_SERVICE_INSTANCE = None
@@ -25,10 +35,35 @@ _MOXIE_SERVICE_INSTANCE = None
 _PROVIDE_HTTP_TOKENS=False
 # As this key is expressly shared and thus usably by any clients, this turns it off
 _SHARE_GOOGLE_KEY=True
+# Wait after a robot connects before sending config and subscriptions, so the client is ready
+_CONNECT_SETUP_DELAY = 1.0
+# Wait after joining a cluster for the retained membership before warm starting
+_CLUSTER_SETTLE_DELAY = 5.0
 
 def now_ms():
     return time.time_ns() // 1_000_000
 
+# Payload discriminator for remote-chat events, the backend and for data requests the query
+def remote_chat_key(rcr):
+    backend = rcr.get('backend')
+    if backend == "data":
+        return f"data/{rcr.get('query',{}).get('query')}"
+    return backend
+
+# Payload discriminator for activity log events, queries by query name, reports by subtopic
+def activity_log_key(csa):
+    subtopic = csa.get("subtopic")
+    if subtopic == "query":
+        return f"query/{csa.get('query')}"
+    if 'mentor_behavior' in csa:
+        return 'mentor_behavior'
+    return subtopic
+
+# ZMQ bridge payloads are <protoname>:<serialized proto>
+def split_zmq_payload(payload):
+    colon_index = payload.find(b':')
+    return payload[:colon_index].decode('utf-8'), payload[colon_index + 1:]
+
 logger = logging.getLogger(__name__)
 
 '''
@@ -51,12 +86,17 @@ class MoxieServer:
     _mqtt_project_id: str
     _cert_required: bool
     _topic_handlers: dict
-    _zmq_handlers: dict
+    _router: TopicRouter
+    _publisher: OutboundPublisher
     _client_metrics: dict
     _google_service_account: str
     _robot_data: RobotData
     _remote_chat: RemoteChat
-    def __init__(self, robot, rbdata, project_id, mqtt_host, mqtt_port, cert_required=True):
+    _dispatcher: DeviceDispatcher
+    _engine: AsyncioEngine
+    _cluster: ClusterMembership
+    _admission: AdmissionController
+    def __init__(self, robot, rbdata, project_id, mqtt_host, mqtt_port, cert_required=True, use_tls=True, transport=None):
         self._robot = robot
         self._robot_data = rbdata
         self._mqtt_project_id = project_id
@@ -64,40 +104,76 @@ class MoxieServer:
         self._port = mqtt_port
         self._cert_required = cert_required
         self._mqtt_client_id = _BASIC_FORMAT.format(self._mqtt_project_id, self._robot.device_id)
+        # Clustered workers share the robot credentials, but each needs its own client id
+        cluster_settings = getattr(settings, 'MOXIE_CLUSTER', {})
+        worker_id = None
+        if cluster_settings.get('enabled'):
+            worker_id = cluster_settings.get('worker_id') or default_worker_id()
+            self._mqtt_client_id = f'{self._mqtt_client_id}-{worker_id}'
         logger.info(f"Creating client with id: {self._mqtt_client_id}")
-        self._client = mqtt.Client(client_id=self._mqtt_client_id, transport="tcp")
-        if self._cert_required:
-            self._client.tls_set()
-        else:
-            self._client.tls_set(cert_reqs=ssl.CERT_NONE)
+        # Plain TCP is only for local test brokers, robots always use TLS
+        if not use_tls:
+            logger.warning("Connecting to broker without TLS")
+        # Tests and benchmarks may provide their own transport, like InMemoryTransport
+        self._client = transport or create_paho_transport(self._mqtt_client_id, use_tls, self._cert_required)
         self._client.on_connect = self.on_connect
         self._client.on_message = self.on_message
+        self._cluster = ClusterMembership(self._client, cluster_settings, worker_id, self.on_cluster_change) if worker_id else None
+        # Threaded uses paho's network thread and dispatcher lanes, asyncio runs both from one event loop
+        engine_settings = getattr(settings, 'MOXIE_ENGINE', {})
+        if engine_settings.get('mode', ENGINE_THREADED) == ENGINE_ASYNCIO:
+            logger.info("Using asyncio engine")
+            self._engine = AsyncioEngine(self._client, engine_settings)
+            self._dispatcher = self._engine
+        else:
+            self._engine = None
+            self._dispatcher = DeviceDispatcher.from_settings(getattr(settings, 'MOXIE_DISPATCHER', None))
+        self._admission = AdmissionController(self._dispatcher, getattr(settings, 'MOXIE_ADMISSION', None))
         self._topic_handlers = None
         self._connect_handlers = []
         self._remote_chat = RemoteChat(self)
-        self._zmq_handlers = {}
         self._client_metrics = {}
-        self._connect_pattern = r"connected from (.*) as (d_[a-f0-9-]+)"
-        self._disconnect_pattern = r"Client (d_[a-f0-9-]+) (closed its connection|disconnected)"
-        self._worker_queue = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        self._publisher = OutboundPublisher(self._client, getattr(settings, 'MOXIE_PUBLISHER', None))
+        self._timers = TimerQueue()
+        self._connect_pattern = re.compile(r"connected from (.*) as (d_[a-f0-9-]+)")
+        self._disconnect_pattern = re.compile(r"Client (d_[a-f0-9-]+) (closed its connection|disconnected)")
+        self._router = self.build_routes()
+        self.register_gauges()
         self.update_from_database()
+        if self._cluster:
+            # other workers only see edits saved in this process through us
+            post_save.connect(self._hive_saved, sender=HiveConfiguration)
+            post_delete.connect(self._hive_saved, sender=HiveConfiguration)
+            post_save.connect(self._schedule_saved, sender=MoxieSchedule)
 
     # Connect to the broker - the jwt stuff left in place, but isn't required
     def connect(self, start = False):
         jwt_token = self._robot.create_jwt(self._mqtt_project_id)
         self._client.username_pw_set(username='unknown', password=jwt_token)
         logger.info(f"connecting to: {self._mqtt_endpoint}")
-        self._client.connect(self._mqtt_endpoint, self._port, 60)
+        if self._engine:
+            self._engine.connect(self._mqtt_endpoint, self._port, 60)
+        else:
+            self._client.connect(self._mqtt_endpoint, self._port, 60)
         if start:
             self.start()
 
+    # Queue work for a device onto its ordered dispatcher lane.  Background work is shed when
+    # its queue is full, unless sheddable=False.
+    def submit_work(self, device_id, functor, *args, work_class=INTERACTIVE, sheddable=None):
+        return self._dispatcher.submit(device_id, functor, *args, work_class=work_class, sheddable=sheddable)
+
     # For any external monitoring of connections to the broker
     def add_connect_handler(self, callback):
         self._connect_handlers.append(callback)
 
     # Bind a listener to a specific proto on the ZMQ topic
     def add_zmq_handler(self, protoname, callback):
-        self._zmq_handlers[protoname] = callback
+        self._router.add_event('zmq').add(protoname, lambda device_id, zmq: callback.handle_zmq(device_id, zmq[0], zmq[1]), name=f'zmq/{protoname}')
+
+    # Bind a handler to a device event, optionally to a single payload key of that event
+    def add_event_handler(self, eventname, callback, key=None, decoder=codec.loads, discriminator=None):
+        self._router.add_event(eventname, decoder=decoder, discriminator=discriminator).add(key, callback)
 
     # This is left-over client code, supervisor doesn't get a config
     def add_config_handler(self, callback):
@@ -122,192 +198,390 @@ class MoxieServer:
         # Subscriptions to monitor clients and broker logs
         client.subscribe('$SYS/broker/clients/#')
         client.subscribe('$SYS/broker/log/#')
+        if self._cluster:
+            self._cluster.join()
         for ch in self._connect_handlers:
             ch(self, rc) 
 
-    # Entry point for ALL incoming messages, extract params about source and route
+    # Entry point for ALL incoming messages, route by topic using the precompiled routes
     def on_message(self, client, userdata, msg):
         try:
-            dec = msg.topic.split('/')
-            fromdevice = dec[2]
-            basetype = dec[3]
-            if basetype == "events":
-                self.on_device_event(fromdevice, dec[4], msg)
-            elif basetype == "state":
-                self.on_device_state(fromdevice, msg)
-            elif fromdevice == "clients":
-                self.on_client_metrics(basetype, msg)
-            elif fromdevice == "log":
-                self.on_sys_log_message(basetype, msg)
-            else:
-                logger.debug(f"Rx UNK topic: {dec}")
+            # handlers here must never wait on a full outbound queue
+            with no_wait():
+                if not self._router.dispatch_topic(msg):
+                    logger.debug(f"Rx UNK topic: {msg.topic}")
         except Exception as e:
             logging.exception("Error handling mqtt messsage:")
-    
+
+    # Build the routing table for all topics, events and event payloads we handle
+    def build_routes(self):
+        router = TopicRouter()
+        # events may have deeper levels, the event name is always the fifth
+        router.add_topic('/devices/+/events/+/#', lambda dec, msg: self.on_device_event(dec[2], dec[4], msg), name='events')
+        router.add_topic('/devices/+/state', lambda dec, msg: self.on_device_state(dec[2], msg), name='state')
+        router.add_topic('$SYS/broker/clients/+', lambda dec, msg: self.on_client_metrics(dec[3], msg), name='sys/clients')
+        router.add_topic('$SYS/broker/log/+', lambda dec, msg: self.on_sys_log_message(dec[3], msg), name='sys/log')
+        if self._cluster:
+            router.add_topic(self._cluster.members_filter(), lambda dec, msg: self._cluster.on_member_message(dec[-1], msg.payload), name='cluster/members')
+            router.add_topic(self._cluster.control_topic(), lambda dec, msg: self.on_cluster_control(codec.loads(msg.payload)), name='cluster/control')
+
+        # Remote chat, keyed by the backend, and the data backend by query
+        rc = router.add_event('remote-chat', decoder=codec.loads, discriminator=remote_chat_key)
+        rc.add('router', self.on_remote_chat)
+        rc.add('data/modules', self.on_remote_modules_query)
+        router.alias_event('remote-chat-staging', 'remote-chat')
+
+        # Topic originally for reporting activities, but extended with subtopics
+        csa = router.add_event('client-service-activity-log', decoder=codec.loads, discriminator=activity_log_key)
+        csa.add('query/schedule', self.on_schedule_query)
+        csa.add('query/mentor_behaviors', self.on_mentor_behaviors_query)
+        csa.add('query/license', self.on_license_query)
+        csa.add('mentor_behavior', self.on_mentor_behavior_report)
+        csa.add('telehealth', self.on_telehealth)
+
+        if _PROVIDE_HTTP_TOKENS:
+            router.add_event('client-service-http-token').add(None, self.on_http_token_request)
+
+        # ZMQ bridge, keyed by proto name, handlers are added with add_zmq_handler
+        router.add_event('zmq', decoder=split_zmq_payload, discriminator=lambda zmq: zmq[0])
+        router.add_event('device-logs', decoder=codec.loads).add(None, self.on_device_log)
+        return router
+
+    # Counters for every message route
+    def route_counters(self):
+        return self._router.counters()
 
     # Handle messages FROM mosquitto syslog topic, looking for connect/disconnects
     def on_sys_log_message(self, basetype, msg):
         if basetype == "N": # Notifications
             line = msg.payload.decode('utf-8')
-            match = re.search(self._connect_pattern, line)
-            match2 = None if match else re.search(self._disconnect_pattern, line)
+            match = self._connect_pattern.search(line)
+            match2 = None if match else self._disconnect_pattern.search(line)
             if match:
-                if self._robot_data.connect_init_needed(match.group(2)):
-                    self._worker_queue.submit(self.on_device_connect, match.group(2), True, match.group(1))
-            elif match2:
-                self._worker_queue.submit(self.on_device_connect, match2.group(1), False)
+                if self.owns_device(match.group(2)) and self._robot_data.connect_init_needed(match.group(2)):
+                    self.submit_work(match.group(2), self.on_device_connect, match.group(2), True, match.group(1))
+            elif match2 and self.owns_device(match2.group(1)):
+                self.submit_work(match2.group(1), self.on_device_connect, match2.group(1), False)
 
     # Handles metrics from mosquitto
     def on_client_metrics(self, basetype, msg):
+        if not self._admission.admit('sys/clients'):
+            return
         self._client_metrics[basetype] = int(msg.payload.decode('utf-8'))
 
     # ALL EVENTS FROM-DEVICE ARRIVE HERE
     def on_device_event(self, device_id, eventname, msg):
+        if not self.owns_device(device_id):
+            return
         # Check the connection in case we missed this device connecting
         self.check_device_connect(device_id, "Event")
-        if eventname == "remote-chat" or eventname == "remote-chat-staging":
-            rcr = json.loads(msg.payload)
-            if rcr.get('backend') == "data" and rcr.get('query',{}).get('query') == "modules":
-                # REMOTE MODULES REQUEST
-                req_id = rcr.get('event_id')
-                # Let the remote chat module provide the modules data
-                rc_modules = self._remote_chat.get_modules_info()
-                logger.debug(f"Tx modules to: remote_chat: {rc_modules}")
-                self.send_command_to_bot_json(device_id, 'remote_chat', { 'command': 'remote_chat', 'result': 0, 'event_id': req_id, 'query_data': rc_modules} )
-            elif rcr.get('backend') == "router":
-                # REMOTE CHAT CONVERSATION ENDPOINT
-                self._remote_chat.handle_request(device_id, rcr, self._robot_data.get_volley_data(device_id))
-        elif eventname == "client-service-activity-log":
-            # Topic originally for reporting activities, but extended with subtopics
-            csa = json.loads(msg.payload)
-            if csa.get("subtopic") == "query":
-                if csa.get("query") == "schedule":
-                    # SCHEDULE REQUEST - Robot asking what schedule to follow this session
-                    logger.debug("Rx Schedule request.")
-                    req_id = csa.get('request_id')
-                    self._worker_queue.submit(self.provide_schedule, req_id, device_id)
-                elif csa.get("query") == "mentor_behaviors":
-                    # MENTOR BEHAVIOR REQUEST - Robot asking what user has done before
-                    logger.debug("Rx MBH request.")
-                    req_id = csa.get('request_id')
-                    self._worker_queue.submit(self.provide_mentor_behaviors, req_id, device_id)
-                elif csa.get("query") == "license":
-                    # ROBOT IS ASKING FOR ANY LICENSES IT CAN USE (e.g. google speech)
-                    req_id = csa.get('request_id')
-                    if _SHARE_GOOGLE_KEY and self._google_service_account:
-                        logger.debug(f"Providing google speech credentials to {device_id}")
-                        self.send_command_to_bot_json(device_id, 'query_result', 
-                                                    { 'command': 'query_result', 'request_id': req_id, 'query': 'license',
-                                                    'license_values': [ 
-                                                        { 'id': 'google_speech', 'license': self._google_service_account}
-                                                        ]
-                                                        })
-            elif 'mentor_behavior' in csa:
-                # MENTOR BEHAVIOR REPORT - Robot informing what user has done
-                self._worker_queue.submit(self.ingest_mentor_behavior, device_id, csa['mentor_behavior'])
-            elif csa.get("subtopic") == "telehealth":
-                # ROBOT TELEHEALTH INTERFACE
-                logger.info(f'Rx TELEHEALTH: {csa.get("message")}')
-                th_state = csa["message"].get("state")
-                if th_state:
-                    self._robot_data.put_puppet_state(device_id, th_state)
-        elif _PROVIDE_HTTP_TOKENS and eventname=="client-service-http-token":
-            # There are no services to use them, but if enabled we respond with a 'notoken' access token
-            logger.info(f"Sending HTTP TOKEN to device {device_id}")
-            self.send_command_to_bot_json(device_id, 'http_token',
-                                            { 'command': 'http_token', 'http_token': 'notoken'})
-        elif eventname == "zmq":
-            # ZMQ BRIDGE INCOMING
-            colon_index = msg.payload.find(b':')
-            protoname = msg.payload[:colon_index].decode('utf-8')
-            protodata = msg.payload[colon_index + 1:]
-            handler = self._zmq_handlers.get(protoname)
-            if handler:
-                handler.handle_zmq(device_id, protoname, protodata)
-            # else:
-            #     logger.debug(f'Unhandled RX ProtoBuf {protoname} over ZMQ Bridge')
-        elif eventname == "device-logs":
-            # These are per-client log messages
-            logrec = json.loads(msg.payload)
-            logger.debug(f'{device_id}[{logrec.get("tag")}] - {logrec.get("message")}')
-
-    # NOTE: Called from worker thread pool
+        # Under load, low value events are shed before decoding
+        if not self._admission.admit(eventname):
+            return
+        self._router.dispatch_event(eventname, device_id, msg.payload)
+
+    # REMOTE MODULES REQUEST
+    def on_remote_modules_query(self, device_id, rcr):
+        req_id = rcr.get('event_id')
+        # Let the remote chat module provide the modules data
+        rc_modules = self._remote_chat.get_modules_info()
+        logger.debug(f"Tx modules to: remote_chat: {rc_modules}")
+        self.send_command_to_bot_json(device_id, 'remote_chat', { 'command': 'remote_chat', 'result': 0, 'event_id': req_id, 'query_data': rc_modules} )
+
+    # REMOTE CHAT CONVERSATION ENDPOINT
+    # Requests from a robot still loading are handled once its data is loaded, not with defaults.
+    # Sessions load from the database, so they are always handled as device work, never inline.
+    def on_remote_chat(self, device_id, rcr):
+        self._robot_data.when_loaded(device_id, self.submit_work, device_id, self.handle_remote_chat, device_id, rcr)
+
+    def handle_remote_chat(self, device_id, rcr):
+        self._remote_chat.handle_request(device_id, rcr, self._robot_data.get_volley_data(device_id))
+
+    # SCHEDULE REQUEST - Robot asking what schedule to follow this session
+    def on_schedule_query(self, device_id, csa):
+        logger.debug("Rx Schedule request.")
+        self.submit_work(device_id, self.provide_schedule, csa.get('request_id'), device_id)
+
+    # MENTOR BEHAVIOR REQUEST - Robot asking what user has done before
+    def on_mentor_behaviors_query(self, device_id, csa):
+        logger.debug("Rx MBH request.")
+        self.submit_work(device_id, self.provide_mentor_behaviors, csa.get('request_id'), device_id)
+
+    # ROBOT IS ASKING FOR ANY LICENSES IT CAN USE (e.g. google speech)
+    def on_license_query(self, device_id, csa):
+        req_id = csa.get('request_id')
+        if _SHARE_GOOGLE_KEY and self._google_service_account:
+            logger.debug(f"Providing google speech credentials to {device_id}")
+            self.send_command_to_bot_json(device_id, 'query_result', 
+                                        { 'command': 'query_result', 'request_id': req_id, 'query': 'license',
+                                        'license_values': [ 
+                                            { 'id': 'google_speech', 'license': self._google_service_account}
+                                            ]
+                                            })
+
+    # MENTOR BEHAVIOR REPORT - Robot informing what user has done
+    def on_mentor_behavior_report(self, device_id, csa):
+        self.submit_work(device_id, self.ingest_mentor_behavior, device_id, csa['mentor_behavior'], work_class=BACKGROUND, sheddable=False)
+
+    # ROBOT TELEHEALTH INTERFACE
+    def on_telehealth(self, device_id, csa):
+        logger.info(f'Rx TELEHEALTH: {csa.get("message")}')
+        th_state = csa["message"].get("state")
+        if th_state:
+            self._robot_data.put_puppet_state(device_id, th_state)
+
+    # There are no services to use them, but if enabled we respond with a 'notoken' access token
+    def on_http_token_request(self, device_id, payload):
+        logger.info(f"Sending HTTP TOKEN to device {device_id}")
+        self.send_command_to_bot_json(device_id, 'http_token',
+                                        { 'command': 'http_token', 'http_token': 'notoken'})
+
+    # These are per-client log messages
+    def on_device_log(self, device_id, logrec):
+        logger.debug(f'{device_id}[{logrec.get("tag")}] - {logrec.get("message")}')
+
+    # NOTE: Called from a dispatcher lane
     def provide_schedule(self, req_id, device_id):
-        schedule = self._robot_data.get_schedule(device_id)
-        self.send_command_to_bot_json(device_id, 'query_result', { 'command': 'query_result', 'query': 'schedule', 'request_id': req_id, 'schedule': schedule} )
-
-    # NOTE: Called from worker thread pool
+        schedule_payload = self._robot_data.take_schedule_payload(device_id)
+        self.send_command_to_bot_json(device_id, 'query_result', self.schedule_result(req_id, schedule_payload))
+        self.submit_work(device_id, self._robot_data.prepare_schedule, device_id, work_class=BACKGROUND)
+
+    # NOTE: Called on the asyncio engine loop
+    async def provide_schedule_async(self, req_id, device_id):
+        schedule_payload = await self._engine.run_db(self._robot_data.take_schedule_payload, device_id)
+        await self.send_command_to_bot_json_async(device_id, 'query_result', self.schedule_result(req_id, schedule_payload))
+        self.submit_work(device_id, self._robot_data.prepare_schedule, device_id, work_class=BACKGROUND)
+
+    # JSON bytes of the result, with the already encoded schedule spliced in
+    def schedule_result(self, req_id, schedule_payload):
+        return b''.join((b'{"command":"query_result","query":"schedule","request_id":', codec.dumps(req_id),
+                         b',"schedule":', schedule_payload, b'}'))
+
+    # NOTE: Called from a dispatcher lane
     def ingest_mentor_behavior(self, device_id, mbh):
         self._robot_data.add_mbh(device_id, mbh)
+        # completions can change the next schedule
+        self._robot_data.prepare_schedule(device_id)
 
-    # NOTE: Called from worker thread pool
+    # NOTE: Called from a dispatcher lane
     def ingest_robot_state(self, device_id, statedata):
         self._robot_data.put_state(device_id, statedata)
 
-    # NOTE: Called from worker thread pool
+    # NOTE: Called from a dispatcher lane
     def provide_mentor_behaviors(self, req_id, device_id):
-        mbh = self._robot_data.get_mbh(device_id)
-        logger.info(f'Providing {len(mbh)} MBH records to {device_id}')
-        self.send_command_to_bot_json(device_id, 'query_result', { 'command': 'query_result', 'query': 'mentor_behaviors', 'request_id': req_id, 'mentor_behaviors': mbh} )
-
-    # NOTE: Called from worker thread pool
+        count, mbh_payload = self._robot_data.get_mbh_payload(device_id)
+        logger.info(f'Providing {count} MBH records to {device_id}')
+        self.send_command_to_bot_json(device_id, 'query_result', self.mentor_behaviors_result(req_id, mbh_payload))
+
+    # NOTE: Called on the asyncio engine loop
+    async def provide_mentor_behaviors_async(self, req_id, device_id):
+        count, mbh_payload = await self._engine.run_db(self._robot_data.get_mbh_payload, device_id)
+        logger.info(f'Providing {count} MBH records to {device_id}')
+        await self.send_command_to_bot_json_async(device_id, 'query_result', self.mentor_behaviors_result(req_id, mbh_payload))
+
+    # JSON bytes of the result, the already encoded MBH array is spliced in rather than encoded again
+    def mentor_behaviors_result(self, req_id, mbh_payload):
+        return b''.join((b'{"command":"query_result","query":"mentor_behaviors","request_id":', codec.dumps(req_id),
+                         b',"mentor_behaviors":', mbh_payload, b'}'))
+
+    # NOTE: Called from a dispatcher lane
     def on_device_connect(self, device_id, connected, ip_addr=None):
         if connected:
             logger.info(f'Moxie CONNECTED {device_id} from {ip_addr}')
             self._robot_data.db_connect(device_id)
-            # Sleep to avoid sending sub/config before client is ready
-            time.sleep(1.0)
-            self.send_config_to_bot_json(device_id, self._robot_data.get_config(device_id))
-            # subscripe to ZMQ STT
-            sub = ProtoSubscribe()
-            sub.protos.append('embodied.perception.audio.zmqSTTRequest')
-            sub.timestamp = now_ms()
-            logger.debug(f'Subscribed to ZMQ STT')
-            self.send_zmq_to_bot(device_id, sub)
+            self.submit_work(device_id, self._robot_data.prepare_schedule, device_id, work_class=BACKGROUND)
+            # Delay to avoid sending sub/config before client is ready, without holding this worker
+            self._timers.call_later(_CONNECT_SETUP_DELAY, self.submit_work, device_id, self.send_connect_setup, device_id)
         else:
             self._robot_data.db_release(device_id)
             logger.info(f'Moxie DISCONNECTED {device_id}')
 
+    # NOTE: Called on the asyncio engine loop
+    async def on_device_connect_async(self, device_id, connected, ip_addr=None):
+        if connected:
+            logger.info(f'Moxie CONNECTED {device_id} from {ip_addr}')
+            await self._engine.run_db(self._robot_data.db_connect, device_id)
+            self.submit_work(device_id, self._robot_data.prepare_schedule, device_id, work_class=BACKGROUND)
+            # Sleep to avoid sending sub/config before client is ready, without holding a thread
+            await asyncio.sleep(_CONNECT_SETUP_DELAY)
+            await self.send_config_to_bot_json_async(device_id, self._robot_data.get_config_payload(device_id))
+            logger.debug(f'Subscribed to ZMQ STT')
+            await self.send_zmq_to_bot_async(device_id, self.stt_subscription())
+        else:
+            await self._engine.run_db(self._robot_data.db_release, device_id)
+            logger.info(f'Moxie DISCONNECTED {device_id}')
+
+    # NOTE: Called from a dispatcher lane, once a connected robot is ready
+    def send_connect_setup(self, device_id):
+        if not self._robot_data.device_online(device_id):
+            logger.debug(f'Moxie {device_id} left before setup')
+            return
+        self.send_config_to_bot_json(device_id, self._robot_data.get_config_payload(device_id))
+        # subscripe to ZMQ STT
+        logger.debug(f'Subscribed to ZMQ STT')
+        self.send_zmq_to_bot(device_id, self.stt_subscription())
+
+    # Subscription for the robot to forward STT audio over the ZMQ bridge
+    def stt_subscription(self):
+        sub = ProtoSubscribe()
+        sub.protos.append('embodied.perception.audio.zmqSTTRequest')
+        sub.timestamp = now_ms()
+        return sub
+
     # Fallback, we missed the connect message but robot is connected
     def check_device_connect(self, device_id, info="Missing"):
         if self._robot_data.connect_init_needed(device_id):
             logger.info(f"Unconnected robot {device_id} location {info}.  Connecting now.")
-            self._worker_queue.submit(self.on_device_connect, device_id, True, info)
+            self.submit_work(device_id, self.on_device_connect, device_id, True, info)
 
     # Moxie reporting its own state information
     def on_device_state(self, device_id, msg):
+        if not self.owns_device(device_id):
+            return
         logger.debug(f"Rx STATE topic for device {device_id}")
         self.check_device_connect(device_id, "State")
-        self._worker_queue.submit(self.ingest_robot_state, device_id, json.loads(msg.payload))
+        # Only the newest state matters, older unhandled states are replaced
+        self._admission.submit_latest('state', device_id, self.ingest_robot_state, msg.payload, decoder=codec.loads)
 
     # Callback when a moxie config has changed and may need to be provided
     def handle_config_updated(self, device):
+        if not self.owns_device(device.device_id):
+            logger.info(f'Moxie device {device.device_id} updated, forwarding to its owner.')
+            self.send_cluster_control(device.device_id, 'config_updated')
+            return
         # Update if connected
         if self._robot_data.config_update_live(device):
             logger.info(f'Moxie device {device.device_id} updated, sending updated config.')
-            self.send_config_to_bot_json(device.device_id, self._robot_data.get_config(device.device_id))
+            self.send_config_to_bot_json(device.device_id, self._robot_data.get_config_payload(device.device_id))
         else:
             logger.info(f'Moxie device {device.device_id} updated, but device offline')
 
+    # Callback when a moxie's mentor behaviors were changed in the database
+    def handle_mbh_updated(self, device):
+        if not self.owns_device(device.device_id):
+            logger.info(f'Moxie device {device.device_id} mentor behaviors updated, forwarding to its owner.')
+            self.send_cluster_control(device.device_id, 'mbh_updated')
+            return
+        self.submit_work(device.device_id, self._robot_data.reload_mbh, device.device_id, work_class=BACKGROUND, sheddable=False)
+        self.submit_work(device.device_id, self._robot_data.prepare_schedule, device.device_id, work_class=BACKGROUND)
+
     # For Robots using wake_button_enabled, wake them from screen off
     def send_wakeup_to_bot(self, device_id):
+        if not self.owns_device(device_id):
+            # Only the owner knows if it is online, assume it is
+            self.send_cluster_control(device_id, 'wakeup')
+            return True
         if self._robot_data.device_online(device_id):
             self.send_command_to_bot_json(device_id, 'wakeup', {'command': 'wakeup'})
             return True
         return False
 
-    # Send Moxie its configuration data
+    # True if this worker handles the device, always True when not clustered
+    def owns_device(self, device_id):
+        return self._cluster is None or self._cluster.owns(device_id)
+
+    # Load recently seen robots ahead of their reconnecting.  A clustered worker first learns
+    # the membership, and only loads the robots it owns.
+    def warm_start(self):
+        if self._cluster:
+            self._timers.call_later(_CLUSTER_SETTLE_DELAY, self.submit_warm_start)
+        else:
+            self._robot_data.warm_start()
+
+    def submit_warm_start(self):
+        self.submit_work(None, self._robot_data.warm_start, self.owns_device, work_class=BACKGROUND, sheddable=False)
+
+    # Cluster membership changed, give up devices now owned by another worker
+    def on_cluster_change(self, members):
+        self._robot_data.drop_warm(self._cluster.owns)
+        for device_id in self._robot_data.connected_list():
+            if not self._cluster.owns(device_id):
+                self.submit_work(device_id, self.release_device, device_id, work_class=BACKGROUND, sheddable=False)
+
+    # NOTE: Called from a dispatcher lane
+    def release_device(self, device_id):
+        logger.info(f'Moxie {device_id} moved to worker {self._cluster.owner(device_id)}, releasing')
+        self._remote_chat.end_session(device_id)
+        self._robot_data.db_release(device_id)
+
+    # Ask the worker owning a device to act on it
+    def send_cluster_control(self, device_id, action):
+        self._publisher.publish(self._cluster.control_topic(self._cluster.owner(device_id)),
+                                { 'action': action, 'device_id': device_id }, qos=1)
+
+    # Tell every other worker about a change that isn't for one device
+    def broadcast_cluster_control(self, action, **fields):
+        for worker_id in self._cluster.members():
+            if worker_id != self._cluster.worker_id:
+                self._publisher.publish(self._cluster.control_topic(worker_id), dict(fields, action=action), qos=1)
+
+    # Hive configuration saved in this process
+    def _hive_saved(self, sender, instance, **kwargs):
+        logger.info('Hive configuration updated, forwarding to other workers.')
+        self.broadcast_cluster_control('hive_updated')
+
+    # Schedule saved in this process
+    def _schedule_saved(self, sender, instance, **kwargs):
+        logger.info(f'Schedule {instance.name} updated, forwarding to other workers.')
+        self.broadcast_cluster_control('schedule_updated', schedule_id=instance.pk)
+
+    # Request from another worker for a device we own, or for every worker
+    def on_cluster_control(self, request):
+        if request.get('action') == 'hive_updated':
+            # saved by another process, so no save signal reached our config cache
+            self.submit_work(None, self.update_from_database, work_class=BACKGROUND, sheddable=False)
+            return
+        if request.get('action') == 'schedule_updated':
+            self.submit_work(None, self._robot_data.schedule_changed, request.get('schedule_id'), work_class=BACKGROUND, sheddable=False)
+            return
+        device_id = request.get('device_id')
+        if not self.owns_device(device_id):
+            # ring changed while in flight, pass it along
+            self.send_cluster_control(device_id, request.get('action'))
+        elif request.get('action') == 'config_updated':
+            self.submit_work(device_id, self.reload_config, device_id, work_class=BACKGROUND, sheddable=False)
+        elif request.get('action') == 'mbh_updated':
+            self.submit_work(device_id, self._robot_data.reload_mbh, device_id, work_class=BACKGROUND, sheddable=False)
+        elif request.get('action') == 'wakeup':
+            self.send_wakeup_to_bot(device_id)
+
+    # NOTE: Called from a dispatcher lane
+    def reload_config(self, device_id):
+        device = MoxieDevice.objects.filter(device_id=device_id).first()
+        if device:
+            # saved by another process, so no save signal reached our config cache
+            self._robot_data.invalidate_config(device)
+            self.handle_config_updated(device)
+
+    # Accessor to cluster membership, None when not clustered
+    def cluster(self):
+        return self._cluster
+
+    # Send Moxie its configuration data, a dict or the cached JSON bytes
+    # NOTE: Only the newest unsent config for a device is delivered
     def send_config_to_bot_json(self, device_id, payload: dict):
-        self._client.publish(f"/devices/{device_id}/config", payload=json.dumps(payload))
+        self._publisher.publish(f"/devices/{device_id}/config", payload, coalesce=True)
 
     # Send a Command (JSON) to Moxie
     def send_command_to_bot_json(self, device_id, command, payload: dict):
-        self._client.publish(f"/devices/{device_id}/commands/{command}", payload=json.dumps(payload))
+        self._publisher.publish(f"/devices/{device_id}/commands/{command}", payload)
 
     # Send a binary ZMQ message to Moxie
     def send_zmq_to_bot(self, device_id, msgobject):
-        payload = (msgobject.DESCRIPTOR.full_name + ":").encode('utf-8') + msgobject.SerializeToString()
-        self._client.publish(f"/devices/{device_id}/commands/zmq", payload=payload)
+        self._publisher.publish(f"/devices/{device_id}/commands/zmq", msgobject, encoder=encode_zmq)
+
+    # Async publish API, for handlers running on the asyncio engine
+    async def publish_async(self, topic, payload, qos=0):
+        return await self._engine.publish(topic, payload, qos)
+
+    async def send_config_to_bot_json_async(self, device_id, payload: dict):
+        await self.publish_async(f"/devices/{device_id}/config", encode_json(payload))
+
+    async def send_command_to_bot_json_async(self, device_id, command, payload: dict):
+        await self.publish_async(f"/devices/{device_id}/commands/{command}", encode_json(payload))
+
+    async def send_zmq_to_bot_async(self, device_id, msgobject):
+        await self.publish_async(f"/devices/{device_id}/commands/zmq", encode_zmq(msgobject))
 
     # Send Telehealth message to Moxie
     def send_telehealth(self, device_id, msg):
@@ -328,7 +602,7 @@ class MoxieServer:
         return "/devices/" + self._robot.device_id + "/events/" + topic_name
 
     def publish_as_json(self, topic, payload: dict):
-        self._client.publish(self.long_topic(topic), payload=json.dumps(payload))
+        self._publisher.publish(self.long_topic(topic), payload)
 
     def publish_canned(self, canned_data):
         if "topic" in canned_data:
@@ -341,14 +615,44 @@ class MoxieServer:
     # Print out client metrics, called periodically in the background
     def print_metrics(self):
         logger.info(f"Client Metrics: {self._client_metrics}")
+        logger.info(f"Route Metrics: {self._router.counters()}")
+        logger.info(f"Publish Metrics: {self._publisher.metrics()}")
+        logger.info(f"{'Engine' if self._engine else 'Dispatcher'} Metrics: {self._dispatcher.metrics()}")
+        logger.info(f"Admission Metrics: {self._admission.metrics()}")
+        logger.info(f"Timer Metrics: {self._timers.metrics()}")
+        logger.info(f"State Store Metrics: {self._robot_data.state_metrics()}")
+        logger.info(f"MBH Buffer Metrics: {self._robot_data.mbh_metrics()}")
+        logger.info(f"Persist Checkpoint Metrics: {self._robot_data.persist_metrics()}")
+        logger.info(f"Config Cache Metrics: {self._robot_data.config_metrics()}")
+        logger.info(f"Device Registry: {self._robot_data.registry_metrics()}")
+        logger.info(f"Warm Start Metrics: {self._robot_data.warm_metrics()}")
+        logger.info(f"Schedule Metrics: {self._robot_data.schedule_metrics()}")
+        if self._cluster:
+            logger.info(f"Cluster {self._cluster.worker_id} Members: {self._cluster.members()} Devices: {len(self._robot_data.connected_list())}")
+
+    # Queue depths and connected devices, read whenever metrics are rendered
+    def register_gauges(self):
+        METRICS.gauge('moxie_work_queued', lambda: { (('work_class', wc),): n for wc, n in self._dispatcher.class_depths().items() },
+                      'Work queued or running per work class')
+        METRICS.gauge('moxie_publish_queued', self._publisher.queue_depth, 'Outbound messages waiting to publish')
+        METRICS.gauge('moxie_timers_pending', self._timers.pending, 'Delayed calls waiting to run')
+        METRICS.gauge('moxie_state_pending', lambda: self._robot_data.state_metrics()['pending'], 'Devices with state not yet written')
+        METRICS.gauge('moxie_connected_devices', lambda: len(self._robot_data.connected_list()), 'Devices connected to this server')
+        METRICS.gauge('moxie_degraded', lambda: int(self.degraded()), '1 while shedding load')
 
     # Start client connection loop
     def start(self):
-        self._client.loop_start()
+        if self._engine:
+            self._engine.start()
+        else:
+            self._client.loop_start()
 
     # Stop client connection loop
     def stop(self):
-        self._client.loop_stop()
+        if self._engine:
+            self._engine.stop()
+        else:
+            self._client.loop_stop()
 
     # Get's a chat session object for use in the web chat
     def get_web_session_for_module(self, device_id, module_id, content_id):
@@ -364,6 +668,34 @@ class MoxieServer:
     def remote_chat(self):
         return self._remote_chat
 
+    # Accessor to the work dispatcher (the asyncio engine when enabled)
+    def dispatcher(self):
+        return self._dispatcher
+
+    # Accessor to the outbound publisher
+    def publisher(self):
+        return self._publisher
+
+    # Accessor to delayed work, for retries, timeouts and alarms
+    def timers(self):
+        return self._timers
+
+    # Accessor to the MQTT transport, normally the paho client
+    def transport(self):
+        return self._client
+
+    # Accessor to admission control
+    def admission(self):
+        return self._admission
+
+    # True while overloaded and shedding low value messages
+    def degraded(self):
+        return self._admission.degraded()
+
+    # Accessor to the asyncio engine, None when running threaded
+    def engine(self):
+        return self._engine
+
     # Accessor to robot data
     def robot_data(self):
         return self._robot_data
@@ -374,6 +706,7 @@ class MoxieServer:
         set_openai_key(hive_config.openai_api_key if hive_config else None)
         self._google_service_account = hive_config.google_api_key if hive_config else None
         self._remote_chat.update_from_database()
+        self._robot_data.invalidate_configs()
 
     # Get the endppint / moxie relocate QR code to move a Moxie to this service
     def get_endpoint_qr_data(self):
@@ -405,7 +738,13 @@ class MoxieServer:
 def cleanup_instance():
     global _MOXIE_SERVICE_INSTANCE
     if _MOXIE_SERVICE_INSTANCE:
+        if _MOXIE_SERVICE_INSTANCE.cluster():
+            _MOXIE_SERVICE_INSTANCE.cluster().leave()
+        _MOXIE_SERVICE_INSTANCE.timers().stop()
+        _MOXIE_SERVICE_INSTANCE.publisher().stop()
         _MOXIE_SERVICE_INSTANCE._client.disconnect()
+        _MOXIE_SERVICE_INSTANCE.dispatcher().shutdown(wait=False)
+        _MOXIE_SERVICE_INSTANCE.robot_data().shutdown()
         _MOXIE_SERVICE_INSTANCE = None
 
 # Instance method, accessor
@@ -414,12 +753,14 @@ def get_instance():
     return _MOXIE_SERVICE_INSTANCE
 
 # Instance method, create singleton service
-def create_service_instance(project_id, host, port, cert_required=True):
+def create_service_instance(project_id, host, port, cert_required=True, use_tls=True):
     global _MOXIE_SERVICE_INSTANCE
     if not _MOXIE_SERVICE_INSTANCE:
         creds = RobotCredentials(True)
         rbdata = RobotData()
-        _MOXIE_SERVICE_INSTANCE = MoxieServer(creds, rbdata, project_id, host, port, cert_required)
+        _MOXIE_SERVICE_INSTANCE = MoxieServer(creds, rbdata, project_id, host, port, cert_required, use_tls)
+        # before connecting, so reconnecting robots find their data ready
+        _MOXIE_SERVICE_INSTANCE.warm_start()
         _MOXIE_SERVICE_INSTANCE.add_zmq_handler('embodied.perception.audio.zmqSTTRequest', STTHandler(_MOXIE_SERVICE_INSTANCE))
         _MOXIE_SERVICE_INSTANCE.connect(start=True)
     
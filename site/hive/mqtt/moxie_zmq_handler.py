@@ -12,3 +12,9 @@ class ZMQHandler:
 
     def zmq_reply(self, device_id, proto):
         self._server.send_zmq_to_bot(device_id, proto)
+
+    async def zmq_reply_async(self, device_id, proto):
+        await self._server.send_zmq_to_bot_async(device_id, proto)
+
+    def server(self):
+        return self._server
@@ -0,0 +1,151 @@
+'''
+PERSIST CHECKPOINT - Periodic saving of changed robot PersistentData
+
+A robot's PersistentData is loaded when it connects and used by global responses through
+volley.persist_data, which changes it freely (including nested values).  It used to be
+saved only on disconnect, so a crash or restart lost everything since the robot connected.
+
+Records are tracked for dirtiness: handing a record's data to a volley touches it, and a
+background thread checks touched records every interval seconds.  A touched record stays a
+candidate for linger seconds after its last touch, since responses change data after the
+volley is built (sometimes after a slow inference).  Candidates whose JSON differs from the
+last saved copy are written together in one transaction.  Untouched records cost nothing,
+and unchanged ones cost only an encode.  Departing robots are saved if changed, and every
+changed record is saved at shutdown.
+
+Settings come from settings.MOXIE_PERSIST_CHECKPOINT.
+'''
+import logging
+import threading
+import time
+from ..models import PersistentData
+from .metrics import histogram
+from .util import run_db_atomic
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_INTERVAL = 10.0
+_DEFAULT_LINGER = 60.0
+# Rows per UPDATE statement
+_UPDATE_BATCH = 200
+
+'''
+PersistCheckpointer tracks the live DeviceRecords with persistent data, and the JSON of
+each as last saved.
+'''
+class PersistCheckpointer:
+    def __init__(self, checkpoint_settings=None):
+        checkpoint_settings = checkpoint_settings or {}
+        self._interval = checkpoint_settings.get('interval', _DEFAULT_INTERVAL)
+        self._linger = checkpoint_settings.get('linger', _DEFAULT_LINGER)
+        self._cond = threading.Condition()
+        self._tracked = {}
+        self._saved = {}
+        self._touched = {}
+        self._save_lock = threading.Lock()
+        self._save_hist = histogram('moxie_persist_checkpoint_seconds', 'Time saving a batch of changed persistent data')
+        self._metrics = { 'checkpoints': 0, 'checked': 0, 'written': 0, 'errors': 0 }
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='moxie-persist-checkpoint', daemon=True)
+        self._thread.start()
+
+    # Start tracking a loaded record, its data as loaded is the saved copy
+    def track(self, rec):
+        saved = codec.dumps_compact(rec.persist)
+        with self._cond:
+            self._tracked[rec.device_id] = rec
+            self._saved[rec.device_id] = saved
+
+    # The record's data may change soon
+    def touch(self, rec):
+        with self._cond:
+            if self._tracked.get(rec.device_id) is rec:
+                self._touched[rec.device_id] = time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running, self._interval)
+                if not self._running:
+                    return
+            self.checkpoint()
+
+    # Collect changed records, from touched candidates or only the given records
+    def _changed(self, recs=None):
+        now = time.monotonic()
+        with self._cond:
+            if recs is None:
+                candidates = [ self._tracked[device_id] for device_id in self._touched ]
+                # past their linger, this is the last check
+                for device_id, touched in list(self._touched.items()):
+                    if now - touched > self._linger:
+                        del self._touched[device_id]
+            else:
+                candidates = recs
+        changed = []
+        for rec in candidates:
+            self._metrics['checked'] += 1
+            try:
+                data = codec.dumps_compact(rec.persist)
+            except Exception:
+                # changing under us, check again next time
+                logger.debug(f'Persistent data for {rec.device_id} changed while encoding')
+                self.touch(rec)
+                continue
+            if data != self._saved.get(rec.device_id):
+                changed.append((rec, data))
+        return changed
+
+    # Save changed records, touched candidates or only those given.  Returns the rows written.
+    def checkpoint(self, recs=None):
+        with self._save_lock:
+            changed = self._changed(recs)
+            if not changed:
+                return 0
+            start = time.perf_counter()
+            try:
+                run_db_atomic(PersistentData.objects.bulk_update, [ PersistentData(pk=rec.persist_pk, data=rec.persist) for rec, _ in changed ],
+                              ['data'], batch_size=_UPDATE_BATCH)
+            except Exception:
+                self._metrics['errors'] += 1
+                logger.exception(f'Error saving persistent data for {len(changed)} devices:')
+                for rec, _ in changed:
+                    self.touch(rec)
+                return 0
+            with self._cond:
+                for rec, data in changed:
+                    if self._tracked.get(rec.device_id) is rec:
+                        self._saved[rec.device_id] = data
+            self._save_hist.observe(time.perf_counter() - start)
+            self._metrics['checkpoints'] += 1
+            self._metrics['written'] += len(changed)
+            return len(changed)
+
+    # Save a departing record if changed, and stop tracking it
+    def release(self, rec):
+        if rec.persist is None:
+            return
+        self.checkpoint([ rec ])
+        with self._cond:
+            if self._tracked.get(rec.device_id) is rec:
+                del self._tracked[rec.device_id]
+                self._saved.pop(rec.device_id, None)
+                self._touched.pop(rec.device_id, None)
+
+    def metrics(self):
+        m = dict(self._metrics)
+        m['tracked'] = len(self._tracked)
+        m['touched'] = len(self._touched)
+        return m
+
+    # Stop the checkpoint thread and save everything changed
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            recs = list(self._tracked.values())
+            self._touched.clear()
+        self.checkpoint(recs)
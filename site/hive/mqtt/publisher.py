@@ -0,0 +1,221 @@
+'''
+PUBLISHER - Outbound message pipeline for MoxieServer
+
+Everything sent to robots goes through one bounded queue and a single publisher thread,
+which serializes payloads and hands them to paho.  Worker lanes no longer serialize JSON
+or contend on the paho client lock, they only queue a message.
+
+Messages marked coalesce replace any not-yet-sent message on the same topic (e.g. config
+pushes, where only the newest matters), keeping the original place in the queue.  With
+QoS 1 enabled, publishes are tracked until the broker acks them.  Queue wait, encode and
+send, and broker ack time are recorded as histograms.  An ack can arrive before publish()
+returns the message id, so early acks are kept until their publish is recorded, and
+entries never acked are expired after ack_timeout.
+
+A full queue makes lane threads wait for room (up to enqueue_timeout), but the MQTT network
+thread or event loop never waits, its message is dropped instead so it keeps reading.
+'''
+import asyncio
+import collections
+import contextlib
+import logging
+import threading
+import time
+from .metrics import histogram
+from . import codec
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_MAX_QUEUE = 10000
+_DEFAULT_QOS = 0
+_DEFAULT_ENQUEUE_TIMEOUT = 5.0
+_DEFAULT_ACK_TIMEOUT = 60.0
+
+# Set while handling a message that must never wait on a full queue
+_no_wait = threading.local()
+
+# Publishes inside never wait for queue space, for handlers called by the MQTT network thread
+@contextlib.contextmanager
+def no_wait():
+    previous = getattr(_no_wait, 'active', False)
+    _no_wait.active = True
+    try:
+        yield
+    finally:
+        _no_wait.active = previous
+
+def _may_wait():
+    if getattr(_no_wait, 'active', False):
+        return False
+    # nor does an asyncio event loop
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return True
+    return False
+
+# Default serializer, dicts to compact JSON bytes, strings and bytes as-is
+def encode_json(payload):
+    if isinstance(payload, (bytes, bytearray, str)):
+        return payload
+    return codec.dumps(payload)
+
+# Serializer for proto messages sent over the ZMQ bridge
+def encode_zmq(msgobject):
+    return (msgobject.DESCRIPTOR.full_name + ":").encode('utf-8') + msgobject.SerializeToString()
+
+class _Outbound:
+    __slots__ = ('topic', 'payload', 'encoder', 'qos', 'coalesce', 'queued_ts')
+    def __init__(self, topic, payload, encoder, qos, coalesce):
+        self.topic = topic
+        self.payload = payload
+        self.encoder = encoder
+        self.qos = qos
+        self.coalesce = coalesce
+        self.queued_ts = time.perf_counter()
+
+'''
+OutboundPublisher owns the queue and thread.  Settings come from settings.MOXIE_PUBLISHER,
+e.g. { 'max_queue': 10000, 'qos': 0 }
+'''
+class OutboundPublisher:
+    def __init__(self, client, publisher_settings=None):
+        publisher_settings = publisher_settings or {}
+        self._client = client
+        self._max_queue = publisher_settings.get('max_queue', _DEFAULT_MAX_QUEUE)
+        self._qos = publisher_settings.get('qos', _DEFAULT_QOS)
+        self._enqueue_timeout = publisher_settings.get('enqueue_timeout', _DEFAULT_ENQUEUE_TIMEOUT)
+        self._ack_timeout = publisher_settings.get('ack_timeout', _DEFAULT_ACK_TIMEOUT)
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._coalescable = {}
+        # mid -> sent time, and acks that arrived before their mid was recorded
+        self._ack_lock = threading.Lock()
+        self._unacked = {}
+        self._early_acks = {}
+        self._metrics = { 'queued': 0, 'published': 0, 'coalesced': 0, 'dropped': 0, 'errors': 0,
+                          'acked': 0, 'ack_expired': 0, 'queue_wait_total': 0.0, 'queue_wait_max': 0.0,
+                          'ack_total': 0.0, 'ack_max': 0.0 }
+        self._wait_hist = histogram('moxie_publish_queue_seconds', 'Time outbound messages wait to be published')
+        self._send_hist = histogram('moxie_publish_send_seconds', 'Time encoding and handing messages to the MQTT client')
+        self._ack_hist = histogram('moxie_publish_ack_seconds', 'Time from publish to broker ack, QoS 1 only')
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='moxie-publisher', daemon=True)
+        self._thread.start()
+        if self._qos > 0:
+            client.on_publish = self.on_publish
+
+    # Queue a message, payload is serialized on the publisher thread by encoder
+    def publish(self, topic, payload, encoder=encode_json, qos=None, coalesce=False):
+        with self._cond:
+            if coalesce:
+                pending = self._coalescable.get(topic)
+                if pending:
+                    # newer message replaces the unsent one, in the same place in line
+                    pending.payload = payload
+                    pending.encoder = encoder
+                    self._metrics['coalesced'] += 1
+                    return True
+            if len(self._queue) >= self._max_queue:
+                timeout = self._enqueue_timeout if _may_wait() else 0
+                if not timeout or not self._cond.wait_for(lambda: len(self._queue) < self._max_queue, timeout):
+                    self._metrics['dropped'] += 1
+                    logger.warning(f'Outbound queue full, dropped message to {topic}')
+                    return False
+            entry = _Outbound(topic, payload, encoder, self._qos if qos is None else qos, coalesce)
+            if coalesce:
+                self._coalescable[topic] = entry
+            self._queue.append(entry)
+            self._metrics['queued'] += 1
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # wake up now and then to expire unacked publishes
+                self._cond.wait_for(lambda: self._queue or not self._running, self._ack_timeout if self._qos > 0 else None)
+                if not self._queue and not self._running:
+                    return
+                # take everything queued, and publish it as one batch outside the lock
+                batch = list(self._queue)
+                self._queue.clear()
+                for entry in batch:
+                    if entry.coalesce:
+                        self._coalescable.pop(entry.topic, None)
+                self._cond.notify_all()
+            for entry in batch:
+                self._send(entry)
+            if self._unacked or self._early_acks:
+                self._expire_acks()
+
+    def _send(self, entry):
+        try:
+            start = time.perf_counter()
+            payload = entry.encoder(entry.payload)
+            sent_ts = time.perf_counter()
+            info = self._client.publish(entry.topic, payload=payload, qos=entry.qos)
+            self._send_hist.observe(time.perf_counter() - start)
+            wait = start - entry.queued_ts
+            self._wait_hist.observe(wait)
+            self._metrics['published'] += 1
+            self._metrics['queue_wait_total'] += wait
+            self._metrics['queue_wait_max'] = max(self._metrics['queue_wait_max'], wait)
+            # acks are only delivered when QoS is enabled for the publisher
+            if entry.qos > 0 and self._qos > 0:
+                with self._ack_lock:
+                    acked_ts = self._early_acks.pop(info.mid, None)
+                    if acked_ts is None:
+                        self._unacked[info.mid] = sent_ts
+                if acked_ts is not None:
+                    self._observe_ack(max(0.0, acked_ts - sent_ts))
+        except Exception:
+            self._metrics['errors'] += 1
+            logger.exception(f'Error publishing to {entry.topic}:')
+
+    # paho callback when a QoS>0 publish completes
+    def on_publish(self, client, userdata, mid, *args):
+        now = time.perf_counter()
+        with self._ack_lock:
+            sent_ts = self._unacked.pop(mid, None)
+            if sent_ts is None:
+                # acked before _send recorded it
+                self._early_acks[mid] = now
+        if sent_ts is not None:
+            self._observe_ack(now - sent_ts)
+
+    def _observe_ack(self, ack):
+        self._ack_hist.observe(ack)
+        self._metrics['acked'] += 1
+        self._metrics['ack_total'] += ack
+        self._metrics['ack_max'] = max(self._metrics['ack_max'], ack)
+
+    # Forget publishes never acked, and early acks never matched, after ack_timeout
+    def _expire_acks(self):
+        cutoff = time.perf_counter() - self._ack_timeout
+        with self._ack_lock:
+            expired = [ mid for mid, ts in self._unacked.items() if ts < cutoff ]
+            for mid in expired:
+                del self._unacked[mid]
+            for mid in [ mid for mid, ts in self._early_acks.items() if ts < cutoff ]:
+                del self._early_acks[mid]
+        self._metrics['ack_expired'] += len(expired)
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def metrics(self):
+        m = dict(self._metrics)
+        m['depth'] = len(self._queue)
+        m['unacked'] = len(self._unacked)
+        m['early_acks'] = len(self._early_acks)
+        m['queue_wait_avg'] = m['queue_wait_total'] / m['published'] if m['published'] else 0.0
+        m['ack_avg'] = m['ack_total'] / m['acked'] if m['acked'] else 0.0
+        return m
+
+    # Stop after publishing anything already queued
+    def stop(self, timeout=5.0):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
@@ -4,19 +4,33 @@ ROBOT DATA - Manages data interfaces for Robots
 The general design is to store 'active' robots data in memory.  We load
 pertinent data from the database when robots connect, and unload them when
 they disconnect, and provide various APIs to access data like schedule, config,
-and state.
+and state.  Live robots are DeviceRecords in a DeviceRegistry, which tracks each
+through connecting, loaded and releasing.
+
+At startup, recently seen robots are warm started: their devices, schedules and persistent
+data are loaded in a few bulk queries and their configs built, so when they all reconnect
+after a restart, connecting is an in-memory promotion instead of a round of queries each.
+Their connect times are written later, in a batch.
 '''
-import json
+import datetime
 import logging
+import time
 import deepmerge
 from django.db import connections
 from django.db import transaction
-from ..models import HiveConfiguration, MoxieDevice, MoxieSchedule, MentorBehavior, PersistentData
+from django.db.models.signals import post_save
+from ..models import MoxieDevice, MoxieSchedule, MentorBehavior, PersistentData
 from django.conf import settings
-from django.forms.models import model_to_dict
 from django.utils import timezone
-from .scheduler import expand_schedule
+from .scheduler import expand_schedule, ftue_completions_index, ftue_completions_db, recency_penalties
 from .util import run_db_atomic, now_ms
+from . import codec
+from .state_store import StateStore
+from .persist_checkpoint import PersistCheckpointer
+from .config_cache import ConfigCache
+from .device_registry import DeviceRegistry, CONNECTING
+from .mbh_index import MbhIndex, MBH_FIELDS
+from .mbh_buffer import MbhBuffer
 
 logger = logging.getLogger(__name__)
 
@@ -62,10 +76,28 @@ DEFAULT_COMBINED_CONFIG["settings"] = DEFAULT_ROBOT_SETTINGS
 
 DEFAULT_SCHEDULE = {}
 
+# Warm start loads robots connected within recent_days, and keeps each loaded for ttl seconds
+_DEFAULT_WARM_DAYS = 30
+_DEFAULT_WARM_TTL = 600.0
+# Devices per PersistentData query, keeps SQLite statements a sane size
+_WARM_QUERY_BATCH = 500
+
 class RobotData:
     def __init__(self):
         global DEFAULT_SCHEDULE
-        self._robot_map = {}
+        self._registry = DeviceRegistry()
+        self._state_store = StateStore(getattr(settings, 'MOXIE_STATE_STORE', None))
+        self._checkpointer = PersistCheckpointer(getattr(settings, 'MOXIE_PERSIST_CHECKPOINT', None))
+        self._mbh_buffer = MbhBuffer(getattr(settings, 'MOXIE_MBH_BUFFER', None))
+        self._warm_settings = getattr(settings, 'MOXIE_WARM_START', None) or {}
+        self._warm = {}
+        # schedule JSON by schedule pk, shared by every robot using it
+        self._schedules = {}
+        self._warm_metrics = { 'loaded': 0, 'promoted': 0, 'expired': 0 }
+        self._schedule_metrics = { 'prepared': 0, 'hits': 0, 'misses': 0 }
+        # warm data goes stale when its device or schedule is edited
+        post_save.connect(self._warm_device_saved, sender=MoxieDevice)
+        post_save.connect(self._schedule_saved, sender=MoxieSchedule)
         db_default = MoxieSchedule.objects.filter(name="default").first()
         if db_default:
             logger.info("Using 'default' schedule from database as schedule fallback")
@@ -75,170 +107,372 @@ class RobotData:
 
     # Called when Robot connects to the MQTT network from a worker thread
     def db_connect(self, robot_id):
-        if robot_id in self._robot_map:
-            # Known only when cache record isnt empty
-            if self._robot_map[robot_id]:
-                logger.info(f'Device {robot_id} already known.')
-                return
-        logger.info(f'Device {robot_id} is LOADING.')
-        run_db_atomic(self.init_from_db, robot_id)
+        rec, _ = self._registry.begin_connect(robot_id)
+        if rec.is_loaded:
+            logger.info(f'Device {robot_id} already known.')
+            return
+        try:
+            if self.promote_warm(robot_id, rec):
+                logger.info(f'Device {robot_id} is LOADED from warm start.')
+            else:
+                logger.info(f'Device {robot_id} is LOADING.')
+                run_db_atomic(self.init_from_db, robot_id, rec)
+        except Exception as e:
+            self._registry.mark_failed(rec, e)
+            raise
+        self._checkpointer.track(rec)
+        self._registry.mark_loaded(rec)
 
     # Called when a Robot disconnects from the MQTT network from a worker thread
     def db_release(self, robot_id):
-        if robot_id in self._robot_map:
+        # warm data would be older than what is saved now
+        self._warm.pop(robot_id, None)
+        self._state_store.release(robot_id)
+        self._mbh_buffer.flush([ robot_id ])
+        rec = self._registry.begin_release(robot_id)
+        if rec:
             logger.info(f'Releasing device data for {robot_id}')
-            run_db_atomic(self.release_to_db, robot_id)
-            del self._robot_map[robot_id]
+            try:
+                run_db_atomic(self.release_to_db, robot_id, rec)
+            finally:
+                self._registry.remove(rec)
 
     # Check if init after connection for this bot is needed, and remember it so we only init once
     def connect_init_needed(self, robot_id):
-        needed = robot_id not in self._robot_map
-        if needed:
-            # set an empty record, so we don't try again
-            self._robot_map[robot_id] = {}
-        return needed
-    
+        return self._registry.begin_connect(robot_id)[1]
+
     # Check if a device is online
     def device_online(self, robot_id):
-        return robot_id in self._robot_map
-    
+        return self._registry.is_online(robot_id)
+
     # Get a list of online robots
     def connected_list(self):
-        return list(self._robot_map.keys())
+        return self._registry.device_ids()
+
+    # Run functor(*args) once the robot is loaded, right away unless it is connecting
+    def when_loaded(self, robot_id, functor, *args):
+        return self._registry.when_loaded(robot_id, functor, *args)
+
+    # Block until a connecting robot is loaded, False on timeout or failure
+    def wait_loaded(self, robot_id, timeout=None):
+        return self._registry.wait_loaded(robot_id, timeout)
+
+    def registry(self):
+        return self._registry
+
+    def registry_metrics(self):
+        return self._registry.counts()
     
     # Build a configuration record for a robot
-    def build_config(self, device, hive_cfg):
+    @staticmethod
+    def build_config(device, hive_cfg):
         # Robot config is base config and settings merged with robot config and settings
-        # NOTE: Uses copies of everything, to avoid altering db records when merging in settings
-        base_cfg = (hive_cfg.common_config if hive_cfg and hive_cfg.common_config else DEFAULT_ROBOT_CONFIG).copy()
-        base_cfg["settings"] = hive_cfg.common_settings if hive_cfg and hive_cfg.common_settings else DEFAULT_ROBOT_SETTINGS
-        robot_cfg = device.robot_config.copy() if device.robot_config else {}
+        # NOTE: Uses deep copies of everything, deepmerge merges into nested dicts of the base in place
+        # and the base must not alter db records or the defaults when merging in settings
+        base_cfg = codec.clone(hive_cfg.common_config if hive_cfg and hive_cfg.common_config else DEFAULT_ROBOT_CONFIG)
+        base_cfg["settings"] = codec.clone(hive_cfg.common_settings if hive_cfg and hive_cfg.common_settings else DEFAULT_ROBOT_SETTINGS)
+        robot_cfg = codec.clone(device.robot_config) if device.robot_config else {}
         robot_cfg["settings"] = device.robot_settings if device.robot_settings else {}
         return deepmerge.always_merger.merge(base_cfg, robot_cfg)
 
+    # Bulk load recently seen robots ahead of their reconnecting, returns the number loaded.
+    # owns(device_id) limits it to the robots this worker handles.
+    def warm_start(self, owns=None):
+        days = self._warm_settings.get('recent_days', _DEFAULT_WARM_DAYS)
+        ttl = self._warm_settings.get('ttl', _DEFAULT_WARM_TTL)
+        if not days or not ttl:
+            return 0
+        start = time.perf_counter()
+        since = timezone.now() - datetime.timedelta(days=days)
+        # only what loading needs, the same schedule isn't decoded once per device
+        devices = { d.pk: d for d in MoxieDevice.objects.filter(last_connect__gte=since).only(
+                        'id', 'device_id', 'schedule_id', 'robot_config', 'robot_settings') }
+        # robots already connected have their data, and other workers' robots aren't ours to load
+        devices = { pk: d for pk, d in devices.items()
+                    if self._registry.get(d.device_id) is None and (owns is None or owns(d.device_id)) }
+        schedule_ids = set(d.schedule_id for d in devices.values() if d.schedule_id)
+        for schedule in MoxieSchedule.objects.filter(pk__in=schedule_ids):
+            self._schedules[schedule.pk] = schedule.schedule
+        persist = {}
+        pks = list(devices)
+        for index in range(0, len(pks), _WARM_QUERY_BATCH):
+            for pd in PersistentData.objects.filter(device_id__in=pks[index:index+_WARM_QUERY_BATCH]):
+                persist[pd.device_id] = (pd.pk, pd.data)
+        missing = [ PersistentData(device_id=pk, data={}) for pk in pks if pk not in persist ]
+        if missing:
+            # SQLite returns the new primary keys, so these can be saved later
+            for pd in PersistentData.objects.bulk_create(missing):
+                persist[pd.device_id] = (pd.pk, pd.data)
+        mbh = { pk: [] for pk in pks }
+        for index in range(0, len(pks), _WARM_QUERY_BATCH):
+            for row in MentorBehavior.objects.filter(device_id__in=pks[index:index+_WARM_QUERY_BATCH]).values_list('device_id', *MBH_FIELDS):
+                mbh[row[0]].append(row[1:])
+        expires = time.monotonic() + ttl
+        for pk, device in devices.items():
+            # build and cache the config now
+            CONFIG_CACHE.get_payload(device)
+            self._warm[device.device_id] = (expires, device, persist[pk], mbh[pk])
+        self._warm_metrics['loaded'] += len(devices)
+        logger.info(f'Warm started {len(devices)} devices in {time.perf_counter() - start:.3f}s')
+        return len(devices)
+
+    # Fill a connecting robot's record from warm start data, False if there is none
+    def promote_warm(self, robot_id, rec):
+        entry = self._warm.pop(robot_id, None)
+        if not entry:
+            return False
+        expires, device, (persist_pk, persist), mbh_rows = entry
+        if time.monotonic() > expires:
+            self._warm_metrics['expired'] += 1
+            return False
+        rec.pk = device.pk
+        rec.schedule_id = device.schedule_id
+        rec.schedule = self._shared_schedule(device.schedule_id)
+        self.set_live_config(rec, device)
+        rec.persist_pk, rec.persist = persist_pk, persist
+        rec.mbh = MbhIndex(mbh_rows)
+        # written with the next state flush
+        self._state_store.put_connect(robot_id, timezone.now())
+        self._warm_metrics['promoted'] += 1
+        return True
+
+    # Forget warm robots now handled by another worker
+    def drop_warm(self, owns):
+        for device_id in list(self._warm):
+            if not owns(device_id):
+                self._warm.pop(device_id, None)
+
+    def _warm_device_saved(self, sender, instance, **kwargs):
+        self._warm.pop(instance.device_id, None)
+
+    def _schedule_saved(self, sender, instance, **kwargs):
+        self.schedule_changed(instance.pk)
+
+    # A schedule was edited, here or by another worker.  Connected robots using it get the new
+    # one from their next session, warm robots reload.
+    def schedule_changed(self, schedule_id):
+        if schedule_id is None:
+            return
+        self._schedules.pop(schedule_id, None)
+        for device_id, (_, device, _, _) in list(self._warm.items()):
+            if device.schedule_id == schedule_id:
+                self._warm.pop(device_id, None)
+        schedule = None
+        for device_id in self._registry.device_ids():
+            rec = self._registry.get(device_id)
+            # by pk, the copy they share may no longer be cached (e.g. after a reload)
+            if rec and rec.schedule_id == schedule_id:
+                if schedule is None:
+                    schedule = self._shared_schedule(schedule_id)
+                rec.schedule = schedule
+
+    # Schedule JSON for a schedule pk, one copy shared by all its robots
+    def _shared_schedule(self, schedule_id, schedule=None):
+        if schedule_id is None:
+            return DEFAULT_SCHEDULE
+        shared = self._schedules.get(schedule_id)
+        if shared is None:
+            if schedule is None:
+                schedule = MoxieSchedule.objects.filter(pk=schedule_id).first()
+            shared = self._schedules.setdefault(schedule_id, schedule.schedule if schedule else DEFAULT_SCHEDULE)
+        return shared
+
+    def warm_metrics(self):
+        m = dict(self._warm_metrics)
+        m['pending'] = len(self._warm)
+        return m
+
     # Load/create records for a Robot
-    def init_from_db(self, robot_id):
-        device, created = MoxieDevice.objects.get_or_create(device_id=robot_id)
-        curr_cfg = HiveConfiguration.objects.filter(name='default').first()
+    def init_from_db(self, robot_id, rec):
+        device, created = MoxieDevice.objects.select_related('schedule').get_or_create(device_id=robot_id)
         device.last_connect = timezone.now()
+        rec.pk = device.pk
         if created:
             logger.info(f'Created new model for this device {robot_id}')
             schedule = MoxieSchedule.objects.get(name='default')
             if schedule:
                 logger.info(f'Setting schedule to {schedule}')
                 device.schedule = schedule
-                self._robot_map[robot_id] = { "schedule": schedule.schedule }
+                rec.schedule_id = schedule.pk
+                rec.schedule = self._shared_schedule(schedule.pk, schedule)
             else:
                 logger.warning('Failed to locate default schedule.')
         else:
             logger.info(f'Existing model for this device {robot_id}')
-            self._robot_map[robot_id] = { "schedule": device.schedule.schedule if device.schedule else DEFAULT_SCHEDULE }
-        # build our config
-        self._robot_map[robot_id]["config"] = self.build_config(device, curr_cfg)
+            rec.schedule_id = device.schedule_id
+            rec.schedule = self._shared_schedule(device.schedule_id, device.schedule)
+        # our config
+        self.set_live_config(rec, device)
         # load our robot's persistent data
         persistent_data, persistent_data_created = PersistentData.objects.get_or_create(device=device, defaults={'data': {}})
-        self._robot_map[robot_id]["persistent_data"] = persistent_data
-        device.save()
+        rec.persist_pk, rec.persist = persistent_data.pk, persistent_data.data
+        # and mentor behavior history
+        rec.mbh = MbhIndex(MentorBehavior.objects.filter(device=device).values_list(*MBH_FIELDS))
+        # config fields untouched, keeps the cached config
+        device.save(update_fields=['last_connect', 'schedule'])
 
     # Finalize device record on disconnect
-    def release_to_db(self, robot_id):
+    def release_to_db(self, robot_id, rec):
         device = MoxieDevice.objects.get(device_id=robot_id)
         if device:
             device.last_disconnect = timezone.now()
-            device.save()
-        # save persistent data for the robot
-        pdata = self._robot_map.get(robot_id, {}).get("persistent_data")
-        if pdata:
-            pdata.save()
+            device.save(update_fields=['last_disconnect'])
+        # save persistent data for the robot, if changed since the last checkpoint
+        self._checkpointer.release(rec)
 
     # Get persist record, cached or from db
     def get_persist_for_device(self, device:MoxieDevice):
-        if device.device_id in self._robot_map:
-            prec = self._robot_map[device.device_id].get("persistent_data")
-            return prec.data if prec else {}
+        rec = self._registry.get(device.device_id)
+        if rec:
+            return rec.persist if rec.persist is not None else {}
         else:
             persistent_data, persistent_data_created = PersistentData.objects.get_or_create(device=device, defaults={'data': {}})
             return persistent_data.data
     
-    # Get the active configuration for a device from the database objects
+    # Get the active configuration for a device from the database objects, built once per change
     def get_config_for_device(self, device):
-        curr_cfg = HiveConfiguration.objects.filter(name='default').first()
-        return self.build_config(device, curr_cfg)
-    
+        return CONFIG_CACHE.get(device)
+
+    # Set the config of a connected robot, and the JSON bytes sent to it
+    def set_live_config(self, rec, device):
+        rec.config = CONFIG_CACHE.get(device)
+        rec.config_payload = CONFIG_CACHE.get_payload(device)
+
     # Update an active device config, and return if the device is connected and needs the config provided
     def config_update_live(self, device):
-        if self.device_online(device.device_id):
-            self._robot_map[device.device_id]["config"] = self.get_config_for_device(device)
+        rec = self._registry.get(device.device_id)
+        if rec and self.device_online(device.device_id):
+            self.set_live_config(rec, device)
             return True
         return False
-    
+
+    # Drop the cached config for a device changed outside this process
+    def invalidate_config(self, device):
+        CONFIG_CACHE.device_changed(device.pk)
+        self._warm.pop(device.device_id, None)
+
+    # Drop all cached configs and schedules, after a reload from the database
+    def invalidate_configs(self):
+        CONFIG_CACHE.invalidate_all()
+        self._schedules.clear()
+        self._warm.clear()
+
+    def config_metrics(self):
+        return CONFIG_CACHE.metrics()
+
     # Get the cached config record for a robot
     def get_config(self, robot_id):
-        robot_rec = self._robot_map.get(robot_id, {})
-        cfg = robot_rec.get("config", DEFAULT_COMBINED_CONFIG)
+        rec = self._registry.get(robot_id)
+        cfg = rec.config if rec and rec.config is not None else DEFAULT_COMBINED_CONFIG
         logger.debug(f'Providing config {cfg} to {robot_id}')
         return cfg
 
+    # Get the cached config for a robot as JSON bytes, ready to send
+    def get_config_payload(self, robot_id):
+        rec = self._registry.get(robot_id)
+        payload = rec.config_payload if rec else None
+        if payload is None:
+            return codec.dumps(self.get_config(robot_id))
+        logger.debug(f'Providing cached config to {robot_id}')
+        return payload
+
     # Create a data record to connect to a volley for processing
     def get_volley_data(self, robot_id):
-        robot_rec = self._robot_map.get(robot_id, {})
-        data = { "config": robot_rec.get("config", DEFAULT_COMBINED_CONFIG),
-                 "state": robot_rec.get("state", {})
+        rec = self._registry.get(robot_id)
+        data = { "config": rec.config if rec and rec.config is not None else DEFAULT_COMBINED_CONFIG,
+                 "state": rec.state if rec and rec.state is not None else {}
                 }
-        # persist is linked to the data record of our model object
-        prec = robot_rec.get("persistent_data")
-        data["persist"] = prec.data if prec else {}
+        # persist is linked to the data record of our model object, and may be changed by the volley
+        if rec and rec.persist is not None:
+            data["persist"] = rec.persist
+            self._checkpointer.touch(rec)
+        else:
+            data["persist"] = {}
         return data
 
-    # Save robot state data
+    # Save robot state data, written to the database in batches by the state store
     def put_state(self, robot_id, state):
-        run_db_atomic(self.update_state_atomic, robot_id, state)
-        rec = self._robot_map.get(robot_id)
+        state = self._state_store.put(robot_id, state)
+        rec = self._registry.get(robot_id)
         if rec:
-            # only add to a non-empty (initialized) record
-            rec["state"] = state
+            # only add to a live record, loading doesn't touch state
+            rec.state = state
 
     def put_puppet_state(self, robot_id, state):
-        rec = self._robot_map.get(robot_id)
+        rec = self._registry.get(robot_id)
         if rec:
             # only add to a live record
-            rec["puppet_state"] = state
+            rec.puppet_state = state
 
     def get_puppet_state(self, robot_id):
-        rec = self._robot_map.get(robot_id)
-        return rec.get("puppet_state") if rec else None
+        rec = self._registry.get(robot_id)
+        return rec.puppet_state if rec else None
     
-    # Update the device record with the state data
-    def update_state_atomic(self, robot_id, state):
-        device = MoxieDevice.objects.get(device_id=robot_id)
-        if "battery_level" not in state and "battery_level" in device.state:
-            # sometimes state is missing the battery key, use the previous one if it isnt included
-            state["battery_level"] = device.state["battery_level"]
-        device.state = state
-        device.state_updated = timezone.now()
-        device.save()
-
-    # Get all the mentor behaviors for a specific robot, in most recent first order
-    def extract_mbh_atomic(self, robot_id):
-        device = MoxieDevice.objects.get(device_id=robot_id)
-        mbh_list = []
-        for mbh in MentorBehavior.objects.filter(device=device).order_by('-timestamp'):
-            mbh_list.append(model_to_dict(mbh, exclude=['device', 'id']))
-        return mbh_list
+    # Write any buffered state and changed persistent data, and stop background writes
+    def shutdown(self):
+        self._state_store.stop()
+        self._mbh_buffer.stop()
+        self._checkpointer.stop()
 
-    # Add a new mentor behavior for a robot, called inside a lock
-    def insert_mbh_atomic(self, robot_id, mbh):
-        device = MoxieDevice.objects.get(device_id=robot_id)
-        rec = MentorBehavior(device=device)
-        rec.__dict__.update(mbh)
-        rec.save()
+    def state_metrics(self):
+        return self._state_store.metrics()
+
+    def persist_metrics(self):
+        return self._checkpointer.metrics()
 
-    # Add a new mentor behavior
+    # Get all the mentor behaviors for a specific robot from the database, in most recent first order
+    def extract_mbh_atomic(self, robot_id):
+        return list(MentorBehavior.objects.filter(device__device_id=robot_id).order_by('-timestamp').values(*MBH_FIELDS))
+
+    # Add a new mentor behavior, written to the database in batches by the MBH buffer.  While the
+    # robot loads, it is added after, as the history being loaded can't include it.
     def add_mbh(self, robot_id, mbh):
-        run_db_atomic(self.insert_mbh_atomic, robot_id, mbh)
+        rec = self._registry.get(robot_id)
+        if rec and rec.status == CONNECTING and self._registry.when_loaded(robot_id, self._put_mbh, robot_id, mbh):
+            return
+        self._put_mbh(robot_id, mbh)
+
+    def _put_mbh(self, robot_id, mbh):
+        rec = self._registry.get(robot_id)
+        if not self._mbh_buffer.put(robot_id, rec.pk if rec else None, mbh):
+            return
+        if rec and rec.mbh is not None:
+            rec.mbh.add(mbh)
+
+    # Write any buffered mentor behaviors for a robot, before reading or changing them in the database
+    def flush_mbh(self, robot_id):
+        self._mbh_buffer.flush([ robot_id ])
+
+    def mbh_metrics(self):
+        return self._mbh_buffer.metrics()
+
+    # Reload the history of a robot after it was changed directly in the database
+    def reload_mbh(self, robot_id):
+        self._warm.pop(robot_id, None)
+        rec = self._registry.get(robot_id)
+        self.flush_mbh(robot_id)
+        if rec and rec.mbh is not None:
+            rec.mbh = MbhIndex(MentorBehavior.objects.filter(device__device_id=robot_id).values_list(*MBH_FIELDS))
+            rec.next_schedule = None
+
+    # Check the FTUE completion counts of a connected robot against the database, reloading its
+    # history if they differ.  Returns True if they matched.
+    def check_ftue_counts(self, robot_id):
+        rec = self._registry.get(robot_id)
+        if not rec or rec.mbh is None:
+            return True
+        self.flush_mbh(robot_id)
+        live = ftue_completions_index(rec.mbh)
+        stored = run_db_atomic(ftue_completions_db, robot_id)
+        if live == stored:
+            return True
+        logger.warning(f'FTUE completions for {robot_id} were {live}, database has {stored}, reloading')
+        self.reload_mbh(robot_id)
+        return False
 
     # Add a set of completions for content IDs in a module
     def add_mbh_completion_bulk(self, robot_id, module_id, content_id_list):
+        self.flush_mbh(robot_id)
         device = MoxieDevice.objects.get(device_id=robot_id)
         last_mbh = MentorBehavior.objects.filter(device=device).order_by('-timestamp').first()
         inst_id = last_mbh.instance_id if last_mbh else 1
@@ -259,20 +493,68 @@ class RobotData:
             rec_ts += 1
         MentorBehavior.objects.bulk_create(recs)
 
-    # Get mentor behaviors
+    # Get mentor behaviors, most recent first
     def get_mbh(self, robot_id):
+        rec = self._registry.get(robot_id)
+        if rec and rec.mbh is not None:
+            return rec.mbh.records()
+        self.flush_mbh(robot_id)
         return run_db_atomic(self.extract_mbh_atomic, robot_id)
 
+    # Get mentor behaviors as (count, JSON array bytes), ready to send
+    def get_mbh_payload(self, robot_id):
+        rec = self._registry.get(robot_id)
+        if rec and rec.mbh is not None:
+            return len(rec.mbh), rec.mbh.payload()
+        self.flush_mbh(robot_id)
+        mbh = run_db_atomic(self.extract_mbh_atomic, robot_id)
+        return len(mbh), codec.dumps(mbh)
+
     # Get the current schedule for the robot, typically expanded when including a generate block
     def get_schedule(self, robot_id, expand=True):
-        robot_rec = self._robot_map.get(robot_id, {})
-        s = robot_rec.get("schedule", DEFAULT_SCHEDULE)
-        if expand:
+        rec = self._registry.get(robot_id)
+        s = rec.schedule if rec and rec.schedule is not None else DEFAULT_SCHEDULE
+        if expand and 'generate' in s:
+            if rec and rec.mbh is not None:
+                completions = ftue_completions_index(rec.mbh)
+                recency = recency_penalties(rec.mbh)
+            else:
+                # generation reads mentor behaviors from the database
+                self.flush_mbh(robot_id)
+                completions = recency = None
             # do any custom schedule automatic generation
-            s = expand_schedule(s, robot_id)
+            s = expand_schedule(s, robot_id, completions, recency)
         logger.debug(f'Providing schedule {s} to {robot_id}')
         return s
 
+    # Expand and encode the next session's schedule for a connected robot ahead of its request
+    def prepare_schedule(self, robot_id):
+        rec = self._registry.get(robot_id)
+        if not rec or not rec.is_loaded:
+            return
+        source = rec.schedule
+        rec.next_schedule = (source, codec.dumps_compact(self.get_schedule(robot_id)))
+        self._schedule_metrics['prepared'] += 1
+
+    # The schedule for a session starting now as JSON bytes, prepared ahead if possible.  Each
+    # prepared schedule is used once, as generated schedules differ every session.
+    def take_schedule_payload(self, robot_id):
+        rec = self._registry.get(robot_id)
+        if rec:
+            prepared, rec.next_schedule = rec.next_schedule, None
+            # unless the robot's schedule was replaced since
+            if prepared and prepared[0] is rec.schedule:
+                self._schedule_metrics['hits'] += 1
+                return prepared[1]
+        self._schedule_metrics['misses'] += 1
+        return codec.dumps_compact(self.get_schedule(robot_id))
+
+    def schedule_metrics(self):
+        return dict(self._schedule_metrics)
+
+# Merged configs for every device in this process
+CONFIG_CACHE = ConfigCache(RobotData.build_config)
+CONFIG_CACHE.connect_signals()
 
 if __name__ == "__main__":
     data = RobotData()
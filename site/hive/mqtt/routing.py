@@ -0,0 +1,181 @@
+'''
+ROUTING - Precompiled topic and event routing for MoxieServer
+
+Incoming messages are routed in three levels, each a dictionary lookup:
+- Topic pattern: MQTT style patterns (+ matches one level, a trailing # any number of levels
+  including none) compiled into a tree once at startup.  Matches are cached per topic
+  string, so a repeat topic costs one lookup.
+- Event name: the /devices/+/events/<event> name selects a set of payload routes.
+- Payload discriminator: each event may decode its payload and extract a key (e.g. the
+  remote-chat backend or activity-log query) that selects the final handler.
+
+Every route times its handler into a histogram (which also counts messages handled), and
+each event times its payload decode, for metrics.
+'''
+import logging
+import time
+from .metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+# Matches on topics are cached, this bounds the cache if topics are unexpectedly unique
+_MAX_TOPIC_CACHE = 100000
+_WILDCARD = '+'
+_MULTI_WILDCARD = '#'
+
+'''
+A single named handler and its handler time histogram
+'''
+class Route:
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        self._seconds = histogram('moxie_route_handler_seconds', 'Time in each route handler', route=name)
+
+    @property
+    def count(self):
+        return self._seconds.count
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.handler(*args)
+        finally:
+            self._seconds.observe(time.perf_counter() - start)
+
+'''
+The routes for one event name.  The decoder converts raw payload bytes once, and the
+discriminator pulls the key used to pick the handler from the decoded payload.  Events
+without a discriminator always use the default route.
+'''
+class EventRoutes:
+    def __init__(self, name, decoder=None, discriminator=None):
+        self.name = name
+        self._decoder = decoder
+        self._discriminator = discriminator
+        self._decode_seconds = histogram('moxie_route_decode_seconds', 'Time decoding event payloads', event=name) if decoder else None
+        self._routes = {}
+        self._default = None
+        self.unmatched = 0
+
+    def add(self, key, handler, name=None):
+        route = Route(name or (self.name if key is None else f'{self.name}/{key}'), handler)
+        if key is None:
+            self._default = route
+        else:
+            self._routes[key] = route
+        return route
+
+    def dispatch(self, device_id, raw):
+        if self._decoder:
+            start = time.perf_counter()
+            payload = self._decoder(raw)
+            self._decode_seconds.observe(time.perf_counter() - start)
+        else:
+            payload = raw
+        if self._discriminator:
+            route = self._routes.get(self._discriminator(payload), self._default)
+        else:
+            route = self._default
+        if route:
+            route(device_id, payload)
+            return True
+        self.unmatched += 1
+        return False
+
+    def routes(self):
+        return list(self._routes.values()) + ([ self._default ] if self._default else [])
+
+'''
+TopicRouter holds the compiled topic tree and the event routes for device events.
+'''
+class TopicRouter:
+    def __init__(self):
+        self._tree = {}
+        self._cache = {}
+        self._events = {}
+        self._topic_routes = []
+        self.unmatched_topics = 0
+        self.unmatched_events = 0
+
+    # Add a topic pattern like /devices/+/state, handler is called with (levels, msg)
+    def add_topic(self, pattern, handler, name=None):
+        node = self._tree
+        for level in pattern.split('/'):
+            node = node.setdefault(level, {})
+        route = Route(name or pattern, handler)
+        node[None] = route
+        self._topic_routes.append(route)
+        self._cache.clear()
+        return route
+
+    # Find the route for a topic, exact levels are preferred over wildcards
+    def match(self, topic):
+        hit = self._cache.get(topic)
+        if hit is None:
+            levels = topic.split('/')
+            route = self._match_levels(self._tree, levels, 0)
+            hit = (route, levels)
+            if len(self._cache) >= _MAX_TOPIC_CACHE:
+                self._cache.clear()
+            self._cache[topic] = hit
+        return hit
+
+    def _match_levels(self, node, levels, index):
+        if index == len(levels):
+            route = node.get(None)
+            if route:
+                return route
+        else:
+            for key in (levels[index], _WILDCARD):
+                child = node.get(key)
+                if child is not None:
+                    route = self._match_levels(child, levels, index + 1)
+                    if route:
+                        return route
+        # a trailing # matches whatever levels are left
+        rest = node.get(_MULTI_WILDCARD)
+        return rest.get(None) if rest is not None else None
+
+    # Route a message to its topic handler, returns False when no route matches
+    def dispatch_topic(self, msg):
+        route, levels = self.match(msg.topic)
+        if route:
+            route(levels, msg)
+            return True
+        self.unmatched_topics += 1
+        return False
+
+    # Add (or get) the routes for an event name
+    def add_event(self, eventname, decoder=None, discriminator=None):
+        if eventname not in self._events:
+            self._events[eventname] = EventRoutes(eventname, decoder, discriminator)
+        return self._events[eventname]
+
+    # Route the same event routes under another event name
+    def alias_event(self, alias, eventname):
+        self._events[alias] = self._events[eventname]
+
+    # Route a device event, returns False if no route handles it
+    def dispatch_event(self, eventname, device_id, raw):
+        routes = self._events.get(eventname)
+        if routes:
+            return routes.dispatch(device_id, raw)
+        self.unmatched_events += 1
+        return False
+
+    # Counters for every route, by route name
+    def counters(self):
+        result = { r.name: r.count for r in self._topic_routes }
+        seen = set()
+        for routes in self._events.values():
+            if id(routes) in seen:
+                continue
+            seen.add(id(routes))
+            for r in routes.routes():
+                result[r.name] = r.count
+            if routes.unmatched:
+                result[f'{routes.name}/unmatched'] = routes.unmatched
+        result['unmatched_topics'] = self.unmatched_topics
+        result['unmatched_events'] = self.unmatched_events
+        return result
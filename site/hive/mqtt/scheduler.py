@@ -1,42 +1,82 @@
 import random
 import logging
-import numpy
-from .util import run_db_atomic
+from django.db.models import Count, Q
+from .util import run_db_atomic, now_ms
 from ..models import MoxieDevice,MentorBehavior
 from ..content.data import RECOMMENDABLE_MODULES, TNT_CIDS, SYSTEMSCHECK_CIDS
 
 logger = logging.getLogger(__name__)
 
 '''
-Quick and dirty auto-scheduler; attempts to pick a random set of modules avoiding adjacencies
-and preferring a broad range of categories
+Auto-scheduler; builds a category balanced list of modules directly.  Each pick is from a
+category used the fewest times so far, never the category just picked while another has modules
+left.  Among those, the category whose best module scores highest goes first, a module's score
+being its weight (from weights, else its 'weight' key, default 1) less its recency penalty, and
+that module is picked.  Once every module left will be used, categories with more modules left go
+first instead, so the tail of the list still has alternatives.  Remaining ties are broken by rng,
+so a seeded random.Random gives a repeatable schedule.
 '''
-def ransac_select(modules, count):
-    count = len(modules) if count > len(modules) else count
-    best_list = []
-    best_score = 100
+def select_modules(modules, count, rng=None, weights=None, recency=None, excluded=()):
+    rng = rng or random
+    weights = weights or {}
+    recency = recency or {}
+    pools = {}
+    for module in modules:
+        module_id = module['module_id']
+        if module_id in excluded:
+            continue
+        score = weights.get(module_id, module.get('weight', 1.0)) - recency.get(module_id, 0.0)
+        pools.setdefault(module.get('category', 'User'), []).append((score, rng.random(), module))
+    # best last, to pop
+    for pool in pools.values():
+        pool.sort(key=lambda entry: entry[:2])
+    used = dict.fromkeys(pools, 0)
+    left = sum(len(pool) for pool in pools.values())
+    selected = []
+    last_cat = None
+    while len(selected) < count and pools:
+        candidates = [ cat for cat in pools if cat != last_cat ] or list(pools)
+        if count - len(selected) >= left:
+            # everything left will be used, so the fullest categories must go first to keep alternatives
+            key = lambda c: (used[c], -len(pools[c]), -pools[c][-1][0], pools[c][-1][1])
+        else:
+            key = lambda c: (used[c], -pools[c][-1][0], -len(pools[c]), pools[c][-1][1])
+        cat = min(candidates, key=key)
+        selected.append(pools[cat].pop()[2])
+        used[cat] += 1
+        left -= 1
+        if not pools[cat]:
+            del pools[cat]
+        last_cat = cat
+    return selected
 
-    for i in range(20):
-        random_list = random.sample(modules, len(modules))
-        cat_map = {}
-        last_cat = None
-        score = 0
-        for m in range(count):
-            cat = random_list[m].get('category', 'User')
-            if cat == last_cat:
-                score += 5 # penalty for two adjacent categories
-            if cat in cat_map:
-                cat_map[cat] += 1
-                score += 1 # penalty for dupe category
-            else:
-                cat_map[cat] = 1
-            last_cat = cat
-        #logger.info(f'Run {i} - Score {score} - Best {best_score}')
-        if score < best_score:
-            best_score = score
-            best_list = random_list[:count]
+'''
+Recency penalties from a robot's MBH index, so recently completed modules and categories played
+more than others sink in the schedule.  A completion's penalty halves every half life, and a
+category's penalty is its share of all completions.  Each module costs O(1) lookups, however
+long the history.
+'''
+RECENCY_WEIGHT = 1.0
+RECENCY_HALF_LIFE_DAYS = 2.0
+CATEGORY_WEIGHT = 0.5
 
-    return best_list
+def recency_penalties(mbh, modules=RECOMMENDABLE_MODULES, now=None):
+    now = now if now is not None else now_ms()
+    half_life = RECENCY_HALF_LIFE_DAYS * 24 * 3600 * 1000
+    stats = { m['module_id']: mbh.completions(m['module_id']) for m in modules }
+    total = sum(count for count, _ in stats.values())
+    played = {}
+    for module in modules:
+        cat = module.get('category', 'User')
+        played[cat] = played.get(cat, 0) + stats[module['module_id']][0]
+    penalties = {}
+    for module in modules:
+        count, last = stats[module['module_id']]
+        penalty = CATEGORY_WEIGHT * played[module.get('category', 'User')] / total if total else 0.0
+        if last is not None:
+            penalty += RECENCY_WEIGHT * 0.5 ** (max(0, now - last) / half_life)
+        penalties[module['module_id']] = penalty
+    return penalties
 
 # mix list2 elements into list1
 def distribute_elements(list2, list1):
@@ -56,26 +96,40 @@ A bit hokey, but these "training" (first time user experience) modules have cont
 the robot internal scheduler switches to a random cid once they exhaust, so they have to be removed
 or TNT and SYSTEMSCHECK will still be in every session.  WELCOME is also removed once you complete
 anything.
+
+Removal works from completion counts (TNT, SYSTEMSCHECK, anything), which connected robots keep
+up to date in their MBH index, so only offline robots need to count in the database.
 '''
-def ftue_remove(device_id):
+def ftue_remove(completions):
+    tnt, systemscheck, completed = completions
     purge_list = []
-    try:
-        if MentorBehavior.objects.filter(device__device_id=device_id, module_id="TNT", action="COMPLETED").count() >= TNT_CIDS:
-            purge_list.append("TNT")
-        if MentorBehavior.objects.filter(device__device_id=device_id, module_id="SYSTEMSCHECK", action="COMPLETED").count() >= SYSTEMSCHECK_CIDS:
-            purge_list.append("SYSTEMSCHECK")
-        if purge_list or MentorBehavior.objects.filter(device__device_id=device_id, action="COMPLETED").first():
-            purge_list.append("WELCOME")
-
-    except Exception as e:
-        logger.warning(f'Error checking FTUE completions {e}')
+    if tnt >= TNT_CIDS:
+        purge_list.append("TNT")
+    if systemscheck >= SYSTEMSCHECK_CIDS:
+        purge_list.append("SYSTEMSCHECK")
+    if purge_list or completed:
+        purge_list.append("WELCOME")
     return purge_list
 
+# Completion counts from an MbhIndex, as (TNT, SYSTEMSCHECK, any)
+def ftue_completions_index(mbh):
+    return (mbh.count(module_id="TNT", action="COMPLETED"), mbh.count(module_id="SYSTEMSCHECK", action="COMPLETED"),
+            mbh.count(action="COMPLETED"))
+
+# Completion counts from the database in one query, as (TNT, SYSTEMSCHECK, any)
+def ftue_completions_db(device_id):
+    counts = MentorBehavior.objects.filter(device__device_id=device_id, action="COMPLETED").aggregate(
+        tnt=Count('id', filter=Q(module_id="TNT")), systemscheck=Count('id', filter=Q(module_id="SYSTEMSCHECK")),
+        completed=Count('id'))
+    return (counts['tnt'], counts['systemscheck'], counts['completed'])
+
 '''
 Schedule Generation - generates a set of additional modules according to the generate key
-to make a random schedule for the session.
+to make a random schedule for the session.  completions are FTUE completion counts, read from
+the database when not provided, and recency maps module IDs to penalties for recent play.  The
+generate block may set a seed for a repeatable schedule, and weights by module ID.
 '''
-def expand_schedule(schedule, device_id):
+def expand_schedule(schedule, device_id, completions=None, recency=None):
     if 'generate' in schedule:
         logger.info("Using generative schedule")
         # Update schedule data with automatic stuff
@@ -84,21 +138,29 @@ def expand_schedule(schedule, device_id):
         chat_modules = schedule['generate'].get('chat_modules', [{'module_id': 'OPENMOXIE_CHAT', 'content_id': 'short'}])
         extra_modules = schedule['generate'].get('extra_modules', [])
         excluded_module_ids = schedule['generate'].get('excluded_module_ids', [])
+        weights = schedule['generate'].get('weights')
+        seed = schedule['generate'].get('seed')
+        rng = random.Random(seed) if seed is not None else random
         provided = schedule.get('provided_schedule', [])
 
         # TNT and SYSTEMSCHECK have to be removed manually, as robot will keep playing something
-        ftue_remove_list = run_db_atomic(ftue_remove, device_id)
+        try:
+            if completions is None:
+                completions = run_db_atomic(ftue_completions_db, device_id)
+            ftue_remove_list = ftue_remove(completions)
+        except Exception as e:
+            logger.warning(f'Error checking FTUE completions {e}')
+            ftue_remove_list = []
         if ftue_remove_list:
             provided = [item for item in provided if item.get('module_id') not in ftue_remove_list]
 
         # modules we can pick from, all recommmended unless excluded, plus any user defined extra modules
-        auto_modules = [item for item in RECOMMENDABLE_MODULES if item['module_id'] not in excluded_module_ids]
-        auto_modules.extend(extra_modules)
-        generated = ransac_select(auto_modules, module_count)
+        generated = select_modules(RECOMMENDABLE_MODULES + extra_modules, module_count, rng=rng, weights=weights,
+                                   recency=recency, excluded=set(excluded_module_ids))
 
         # insert some random chats
         if chat_count > 0 and len(chat_modules) > 0:
-            generated_chats = list(numpy.random.choice(chat_modules, size=chat_count, replace=True))
+            generated_chats = rng.choices(chat_modules, k=chat_count)
             generated = distribute_elements(generated, generated_chats)
 
         # make a copy, so we don't alter the original
@@ -0,0 +1,150 @@
+'''
+STATE STORE - Write-behind buffer for robot state reports
+
+Robots report state often, and only the newest report matters.  Rather than a transaction
+per /state message, the newest state per device is kept in memory and marked dirty, and a
+background thread writes every dirty device in one transaction.  It flushes every
+flush_interval seconds, or sooner once flush_size devices are dirty.  Database writes are
+O(devices per interval) instead of O(messages), and SQLite is locked far less often.
+
+Reports missing battery_level keep the last known level, from memory or else from the
+database row when flushed.  Connect times of warm started robots are buffered the same
+way.  A device is flushed on its own when it disconnects, and everything is flushed at
+shutdown.
+
+Settings come from settings.MOXIE_STATE_STORE.
+'''
+import logging
+import threading
+import time
+from django.utils import timezone
+from ..models import MoxieDevice
+from .metrics import histogram
+from .util import run_db_atomic
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_FLUSH_INTERVAL = 5.0
+_DEFAULT_FLUSH_SIZE = 500
+# Rows per UPDATE statement, keeps SQLite statements a sane size
+_UPDATE_BATCH = 200
+
+'''
+StateStore holds the newest state per device until it is written.  put() only touches
+memory and is safe from any thread.
+'''
+class StateStore:
+    def __init__(self, store_settings=None):
+        store_settings = store_settings or {}
+        self._flush_interval = store_settings.get('flush_interval', _DEFAULT_FLUSH_INTERVAL)
+        self._flush_size = store_settings.get('flush_size', _DEFAULT_FLUSH_SIZE)
+        self._cond = threading.Condition()
+        self._dirty = {}
+        self._connects = {}
+        self._battery = {}
+        self._flush_lock = threading.Lock()
+        self._flush_hist = histogram('moxie_state_flush_seconds', 'Time writing a batch of dirty robot state')
+        self._metrics = { 'puts': 0, 'coalesced': 0, 'flushes': 0, 'written': 0, 'missing': 0, 'errors': 0 }
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='moxie-state-store', daemon=True)
+        self._thread.start()
+
+    # Keep the newest state for a device, filling in a missing battery level if known
+    def put(self, device_id, state):
+        with self._cond:
+            if 'battery_level' in state:
+                self._battery[device_id] = state['battery_level']
+            elif device_id in self._battery:
+                state['battery_level'] = self._battery[device_id]
+            if device_id in self._dirty:
+                self._metrics['coalesced'] += 1
+            self._dirty[device_id] = state
+            self._metrics['puts'] += 1
+            if len(self._dirty) >= self._flush_size:
+                self._cond.notify_all()
+        return state
+
+    # Keep a device's connect time until the next flush
+    def put_connect(self, device_id, connected):
+        with self._cond:
+            self._connects[device_id] = connected
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._dirty) >= self._flush_size or not self._running, self._flush_interval)
+                if not self._running:
+                    return
+            self.flush()
+
+    # Write dirty state, for every device or just those listed.  Returns the rows written.
+    def flush(self, device_ids=None):
+        with self._flush_lock:
+            with self._cond:
+                if device_ids is None:
+                    batch, connects = self._dirty, self._connects
+                    self._dirty, self._connects = {}, {}
+                else:
+                    batch = { d: self._dirty.pop(d) for d in device_ids if d in self._dirty }
+                    connects = { d: self._connects.pop(d) for d in device_ids if d in self._connects }
+            if not batch and not connects:
+                return 0
+            start = time.perf_counter()
+            try:
+                written = run_db_atomic(self._write, batch, connects)
+            except Exception:
+                self._metrics['errors'] += 1
+                logger.exception(f'Error writing state for {len(batch)} devices:')
+                # keep them for the next flush, unless newer data arrived meanwhile
+                with self._cond:
+                    for device_id, state in batch.items():
+                        self._dirty.setdefault(device_id, state)
+                    for device_id, connected in connects.items():
+                        self._connects.setdefault(device_id, connected)
+                return 0
+            self._flush_hist.observe(time.perf_counter() - start)
+            self._metrics['flushes'] += 1
+            self._metrics['written'] += written
+            return written
+
+    # Write a departing device's state now, and forget its battery level
+    def release(self, device_id):
+        self.flush([ device_id ])
+        with self._cond:
+            self._battery.pop(device_id, None)
+
+    # Runs inside a transaction
+    def _write(self, batch, connects):
+        now = timezone.now()
+        devices = list(MoxieDevice.objects.filter(device_id__in=list(batch)).only('id', 'device_id', 'state'))
+        for device in devices:
+            state = batch[device.device_id]
+            if 'battery_level' not in state and device.state and 'battery_level' in device.state:
+                # sometimes state is missing the battery key, use the previous one if it isnt included
+                state['battery_level'] = device.state['battery_level']
+                with self._cond:
+                    self._battery.setdefault(device.device_id, state['battery_level'])
+            device.state = state
+            device.state_updated = now
+        self._metrics['missing'] += len(batch) - len(devices)
+        MoxieDevice.objects.bulk_update(devices, ['state', 'state_updated'], batch_size=_UPDATE_BATCH)
+        if connects:
+            connected = list(MoxieDevice.objects.filter(device_id__in=list(connects)).only('id', 'device_id'))
+            for device in connected:
+                device.last_connect = connects[device.device_id]
+            MoxieDevice.objects.bulk_update(connected, ['last_connect'], batch_size=_UPDATE_BATCH)
+        return len(devices)
+
+    def metrics(self):
+        m = dict(self._metrics)
+        m['pending'] = len(self._dirty)
+        m['pending_connects'] = len(self._connects)
+        return m
+
+    # Stop the flush thread and write everything still dirty
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,112 @@
+'''
+TIMERS - Delayed work without holding a thread
+
+TimerQueue runs functions after a delay, from a heap of due times served by one thread.
+Waiting costs nothing but a heap entry, so a connect storm of hundreds of robots each
+waiting a second holds no worker threads.  Use it for delayed publishes, retries, timeouts
+and alarms.
+
+Timer functions run on the timer thread and must be quick, anything slow or touching the
+database should be handed to the dispatcher, e.g.
+    timers.call_later(1.0, server.submit_work, device_id, functor, device_id)
+'''
+import heapq
+import itertools
+import logging
+import threading
+import time
+from .metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+'''
+A scheduled call, which can be cancelled until it runs.
+'''
+class TimerHandle:
+    __slots__ = ('due', 'functor', 'args', 'cancelled')
+    def __init__(self, due, functor, args):
+        self.due = due
+        self.functor = functor
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+'''
+TimerQueue holds pending calls in a heap ordered by due time (time.monotonic).  Cancelled
+calls stay in the heap and are skipped when due.
+'''
+class TimerQueue:
+    def __init__(self, name='moxie-timers'):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._lateness = histogram('moxie_timer_lateness_seconds', 'Time timers ran after they were due')
+        self._metrics = { 'scheduled': 0, 'fired': 0, 'cancelled': 0, 'errors': 0 }
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # Call functor(*args) after delay seconds
+    def call_later(self, delay, functor, *args):
+        return self.call_at(time.monotonic() + delay, functor, *args)
+
+    # Call functor(*args) at a time.monotonic() time
+    def call_at(self, due, functor, *args):
+        handle = TimerHandle(due, functor, args)
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), handle))
+            self._metrics['scheduled'] += 1
+            # wake the thread only if this is the new earliest
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def _next_due(self):
+        with self._cond:
+            while self._running:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, _, handle = self._heap[0]
+                if handle.cancelled:
+                    heapq.heappop(self._heap)
+                    self._metrics['cancelled'] += 1
+                    continue
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                return handle
+            return None
+
+    def _run(self):
+        while True:
+            handle = self._next_due()
+            if handle is None:
+                return
+            self._lateness.observe(time.monotonic() - handle.due)
+            self._metrics['fired'] += 1
+            try:
+                handle.functor(*handle.args)
+            except Exception:
+                self._metrics['errors'] += 1
+                logger.exception(f'Error running timer {getattr(handle.functor, "__name__", handle.functor)}:')
+
+    # Calls not yet run, including cancelled ones not yet skipped
+    def pending(self):
+        return len(self._heap)
+
+    def metrics(self):
+        m = dict(self._metrics)
+        m['pending'] = len(self._heap)
+        return m
+
+    # Stop the thread, pending calls are dropped
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
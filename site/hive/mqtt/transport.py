@@ -0,0 +1,133 @@
+'''
+TRANSPORT - MQTT client transports for MoxieServer
+
+MoxieServer talks to the broker through a transport with the paho Client interface.  In
+service that is a real paho client.  InMemoryTransport implements the same calls with no
+network at all: messages are injected straight into the server's on_message, and every
+publish is captured.  This makes the whole ingress path (topic routing, decoding, connect
+detection, handler dispatch) repeatable in tests and microbenchmarks without a broker.
+'''
+import collections
+import ssl
+import threading
+import paho.mqtt.client as mqtt
+
+# Create the paho client used in service
+def create_paho_transport(client_id, use_tls=True, cert_required=True):
+    client = mqtt.Client(client_id=client_id, transport="tcp")
+    if use_tls:
+        if cert_required:
+            client.tls_set()
+        else:
+            client.tls_set(cert_reqs=ssl.CERT_NONE)
+    return client
+
+'''
+In-memory stand-in for the paho client.  Publishes are kept in published (the newest
+capture_limit of them), or passed to publish_hook if set.  With loopback, publishes to
+subscribed topics are delivered back to on_message, like a broker would.
+'''
+class InMemoryTransport:
+    def __init__(self, client_id='', capture_limit=10000, loopback=False):
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_disconnect = None
+        self.publish_hook = None
+        self.published = collections.deque(maxlen=capture_limit)
+        self.publish_count = 0
+        self.subscriptions = []
+        self.will = None
+        self._loopback = loopback
+        self._connected = False
+        self._mid = 0
+        self._lock = threading.Lock()
+
+    def _next_mid(self):
+        with self._lock:
+            self._mid += 1
+            return self._mid
+
+    # paho client calls MoxieServer makes, most have nothing to do here
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload)
+
+    def connect(self, host=None, port=None, keepalive=60):
+        self._connected = True
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        self._connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self._connected
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def loop_misc(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        return (mqtt.MQTT_ERR_SUCCESS, self._next_mid())
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        mid = self._next_mid()
+        msg = self.make_message(topic, payload, mid)
+        self.publish_count += 1
+        if self.publish_hook:
+            self.publish_hook(msg)
+        else:
+            self.published.append(msg)
+        info = mqtt.MQTTMessageInfo(mid)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        if self.on_publish and qos > 0:
+            self.on_publish(self, None, mid)
+        if self._loopback and any(mqtt.topic_matches_sub(sub, topic) for sub in self.subscriptions):
+            self.inject_message(msg)
+        return info
+
+    # Messages are real paho messages, so handlers see exactly what paho gives them
+    @staticmethod
+    def make_message(topic, payload, mid=0):
+        msg = mqtt.MQTTMessage(mid, topic.encode('utf-8'))
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        msg.payload = payload if payload is not None else b''
+        return msg
+
+    # Deliver a message as if it arrived from the broker, on the calling thread
+    def inject(self, topic, payload):
+        self.inject_message(self.make_message(topic, payload))
+
+    def inject_message(self, msg):
+        self.on_message(self, None, msg)
+
+    # Deliver prebuilt messages, for benchmarks where building them shouldn't count
+    def inject_many(self, messages):
+        on_message = self.on_message
+        for msg in messages:
+            on_message(self, None, msg)
+
+    def clear(self):
+        self.published.clear()
+        self.publish_count = 0
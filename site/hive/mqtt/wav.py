@@ -0,0 +1,133 @@
+'''
+WAV - Speech audio buffering and WAV framing for STT uploads
+
+Robots stream speech as 16 bit mono PCM in many small ZMQ frames.  Frames are copied once into
+fixed size preallocated blocks, so a long utterance never regrows and recopies one buffer.  When
+the utterance ends a 44 byte PCM header is made and the upload reads the WAV file straight from
+the header and blocks, with no array conversion, encoder or joined copy in between.
+'''
+import bisect
+import io
+import os
+import struct
+
+WAV_HEADER_SIZE = 44
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+# Bytes per audio block, about two seconds of speech
+_BLOCK_SIZE = 65536
+
+# Canonical 44 byte RIFF/WAVE header for PCM audio of data_size bytes
+def wav_header(data_size, sample_rate=SAMPLE_RATE, channels=1, sample_width=SAMPLE_WIDTH):
+    block_align = channels * sample_width
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels,
+                       sample_rate, sample_rate * block_align, block_align, sample_width * 8, b'data', data_size)
+
+'''
+AudioBuffer accumulates the PCM frames of one utterance in blocks, the last one partly filled.
+'''
+class AudioBuffer:
+    __slots__ = ('_blocks', '_fill', '_size')
+    def __init__(self):
+        self._blocks = []
+        # bytes used in the last block, full until the first append
+        self._fill = _BLOCK_SIZE
+        self._size = 0
+
+    # Add a frame, returns the total bytes buffered
+    def append(self, data):
+        size = len(data)
+        if not size:
+            # nothing to copy, and there may be no block yet
+            return self._size
+        if self._fill + size <= _BLOCK_SIZE:
+            self._blocks[-1][self._fill:self._fill + size] = data
+            self._fill += size
+        else:
+            view = memoryview(data)
+            while view:
+                if self._fill == _BLOCK_SIZE:
+                    self._blocks.append(bytearray(_BLOCK_SIZE))
+                    self._fill = 0
+                count = min(len(view), _BLOCK_SIZE - self._fill)
+                self._blocks[-1][self._fill:self._fill + count] = view[:count]
+                self._fill += count
+                view = view[count:]
+        self._size += size
+        return self._size
+
+    def __len__(self):
+        return self._size
+
+    # File-like WAV of the audio so far, a trailing partial sample is left out
+    def wav_reader(self, sample_rate=SAMPLE_RATE):
+        data_size = self._size - self._size % SAMPLE_WIDTH
+        return ChunkReader([ wav_header(data_size, sample_rate) ] + self._blocks, WAV_HEADER_SIZE + data_size)
+
+    # The WAV file as one bytes object, for logging and comparison
+    def wav_bytes(self, sample_rate=SAMPLE_RATE):
+        return self.wav_reader(sample_rate).read()
+
+'''
+ChunkReader is a seekable read-only file over a list of byte chunks, truncated to size.  Upload
+clients read it in blocks, and seek to measure it and to rewind on retries.  Reads copy each
+byte once, from the chunks into the returned bytes.
+'''
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks, size=None):
+        self._chunks = [ memoryview(chunk) for chunk in chunks ]
+        self._starts = []
+        offset = 0
+        for chunk in self._chunks:
+            self._starts.append(offset)
+            offset += len(chunk)
+        self._size = offset if size is None else min(size, offset)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+        self._pos = offset
+        return offset
+
+    # Views of the chunks covering the next count bytes, advancing the position
+    def _take(self, count):
+        end = min(self._pos + count, self._size)
+        views = []
+        if self._pos < end:
+            index = bisect.bisect_right(self._starts, self._pos) - 1
+            while self._pos < end:
+                chunk = self._chunks[index]
+                offset = self._pos - self._starts[index]
+                view = chunk[offset:offset + end - self._pos]
+                views.append(view)
+                self._pos += len(view)
+                index += 1
+        return views
+
+    def read(self, size=-1):
+        return b''.join(self._take(self._size if size is None or size < 0 else size))
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        out = memoryview(buffer).cast('B')
+        copied = 0
+        for view in self._take(len(out)):
+            out[copied:copied + len(view)] = view
+            copied += len(view)
+        return copied
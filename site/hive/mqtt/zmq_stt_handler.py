@@ -1,18 +1,19 @@
 from .moxie_zmq_handler import ZMQHandler
 from .protos.embodied.perception.audio.zmqSTT_pb2 import zmqSTTRequest,zmqSTTResponse
-import soundfile as sf
-import numpy as np
-import io
 import time
 import logging
-import concurrent.futures
 from .ai_factory import create_openai
+from .metrics import histogram
+from .wav import AudioBuffer
 
 LOG_WAV=False
 OPENAI_MODEL='whisper-1'
 
 logger = logging.getLogger(__name__)
 
+_ENCODE_SECONDS = histogram('moxie_stt_seconds', 'STT stage latency', stage='encode')
+_TRANSCRIBE_SECONDS = histogram('moxie_stt_seconds', 'STT stage latency', stage='transcribe')
+
 def now_ms():
     return time.time_ns() // 1_000_000
 
@@ -27,27 +28,36 @@ class STTSession:
         self._parent = parent
         self._device_id = device_id
         self._session_id = session_id
-        self._stream_bytes = bytearray()
+        self._audio = AudioBuffer()
         self._start_ts = None
 
     def on_request(self, req):
         # future ref, this is technically wrong in the design, this ts is realtime on robot, not audio timestamp
         if not self._start_ts:
             self._start_ts = req.timestamp
-        self._stream_bytes += req.audio_content
-        return len(self._stream_bytes)
+        return self._audio.append(req.audio_content)
     
     def perform(self):
-        logger.info(f'Processing session_id {self._session_id} with {len(self._stream_bytes)} bytes')
-        buffer = io.BytesIO()
-        sf.write(
-            buffer,  # File-like object (None for bytes)
-            np.frombuffer(self._stream_bytes, dtype=np.int16),
-            16000,
-            format='WAV',
-            subtype='PCM_16'  # 16-bit PCM
-            )
-        wav_bytes = buffer.getvalue()
+        wav_file = self.encode_wav()
+        resp = self.transcribe(wav_file)
+        # send response to device
+        self._parent.zmq_reply(self._device_id, resp)
+        self.log_wav(wav_file)
+
+    # asyncio engine variant, only the OpenAI request runs on the bounded AI executor
+    async def perform_async(self):
+        wav_file = self.encode_wav()
+        resp = await self._parent.server().engine().run_ai(self.transcribe, wav_file)
+        await self._parent.zmq_reply_async(self._device_id, resp)
+        self.log_wav(wav_file)
+
+    # A file-like WAV read straight from the received frames, for the upload
+    def encode_wav(self):
+        logger.info(f'Processing session_id {self._session_id} with {len(self._audio)} bytes')
+        with _ENCODE_SECONDS.time():
+            return self._audio.wav_reader()
+
+    def transcribe(self, wav_file):
         # Create proto response, send regardless
         resp = zmqSTTResponse()
         resp.uuid = self._session_id
@@ -56,11 +66,12 @@ class STTSession:
 
         try:
             client = create_openai()
-            transcript = client.audio.transcriptions.create(
-                file=('test.wav', wav_bytes),
-                model=OPENAI_MODEL,
-                response_format="verbose_json",
-                timestamp_granularities=["word"])
+            with _TRANSCRIBE_SECONDS.time():
+                transcript = client.audio.transcriptions.create(
+                    file=('test.wav', wav_file),
+                    model=OPENAI_MODEL,
+                    response_format="verbose_json",
+                    timestamp_granularities=["word"])
             resp.speech = transcript.text
             min_start = min(d.start for d in transcript.words) if transcript.words else 0
             max_end = max(d.end for d in transcript.words) if transcript.words else 0
@@ -71,14 +82,14 @@ class STTSession:
             logger.warning(f'Exception handling openAI request: {e}')
             resp.error_code = 66
             resp.error_message = str(e)
+        return resp
 
-        # send response to device
-        self._parent.zmq_reply(self._device_id, resp)
-
+    def log_wav(self, wav_file):
         if LOG_WAV:
             logfile = f'{self._session_id}.wav'
+            wav_file.seek(0)
             with open(logfile, 'wb') as f:
-                f.write(wav_bytes)
+                f.write(wav_file.read())
                 logger.info(f'Wrote WAV data to {logfile}')
 
 '''
@@ -92,7 +103,6 @@ class STTHandler(ZMQHandler):
     def __init__(self, server):
         super().__init__(server)
         self._sessions = {}
-        self._worker_queue = concurrent.futures.ThreadPoolExecutor(max_workers=5)
 
     def handle_zmq(self, device_id, protoname, protodata):
         req = zmqSTTRequest()
@@ -107,4 +117,4 @@ class STTHandler(ZMQHandler):
             logger.info(f'Session reached END OF SPEECH')
             # session is done, do the work
             sess = self._sessions.pop(sesskey)
-            self._worker_queue.submit(sess.perform)
+            self._server.submit_work(device_id, sess.perform)
@@ -1,3 +1,903 @@
-from django.test import TestCase
+'''
+QUERY BUDGETS - The most queries each hot operation may run
 
-# Create your tests here.
+Connects, state reports, mentor behaviors, schedules and the dashboard run for every robot,
+so a query added per robot or per record (N+1) multiplies across the fleet.  Each test
+asserts an upper bound, and where it matters, that the bound holds as rows are added.
+
+SCHEDULE GENERATOR - Properties of generated schedules over RECOMMENDABLE_MODULES, for every
+length and many seeds.
+
+WRITE-BEHIND - State, persistent data and mentor behaviors buffered in memory, written
+later, retried after errors and flushed before they are read.
+
+WAV - STT audio framing, read back with the standard library.
+
+PUBLISHER - Ack tracking and queue admission of the outbound publisher.
+
+DEVICE REGISTRY - Device lifecycle, and work deferred until a robot is loaded.
+
+DISPATCHER - Per-device ordering across lanes, and queue limits.
+
+ADMISSION - Degraded mode watermarks, sampling and latest-only work.
+
+TIMERS - Delayed calls and cancellation on the timer queue.
+
+CLUSTER - Device ownership on the hash ring as workers join and leave.
+
+SERVER - Messages injected through InMemoryTransport, end to end through MoxieServer.
+'''
+import asyncio
+import contextlib
+import io
+import os
+import random
+import threading
+import time
+import wave
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .content.data import RECOMMENDABLE_MODULES
+from .models import MoxieDevice, MoxieSchedule, MentorBehavior, SinglePromptChat, HiveConfiguration, PersistentData
+from .mqtt import admission, codec, moxie_server
+from .mqtt.moxie_server import MoxieServer
+from .mqtt.robot_credentials import RobotCredentials
+from .mqtt.robot_data import RobotData
+from .mqtt.device_registry import DeviceRegistry, DeviceRecord, RELEASING
+from .mqtt.admission import AdmissionController
+from .mqtt.cluster import HashRing
+from .mqtt.dispatcher import DeviceDispatcher, INTERACTIVE, BACKGROUND, WorkShed, lane_index
+from .mqtt.mbh_buffer import MbhBuffer
+from .mqtt.mbh_index import MbhIndex
+from .mqtt.persist_checkpoint import PersistCheckpointer
+from .mqtt.publisher import OutboundPublisher, no_wait
+from .mqtt.scheduler import select_modules, expand_schedule, recency_penalties
+from .mqtt.state_store import StateStore
+from .mqtt.timers import TimerQueue
+from .mqtt.transport import InMemoryTransport
+from .mqtt.wav import AudioBuffer, WAV_HEADER_SIZE
+
+_SCHEDULE = {
+    'provided_schedule': [ { 'module_id': 'WELCOME' }, { 'module_id': 'TNT' }, { 'module_id': 'SYSTEMSCHECK' } ],
+    'generate': { 'chat_count': 2, 'module_count': 6 },
+}
+
+# Background writers never run on their own, tests flush explicitly on the test connection
+@override_settings(MOXIE_STATE_STORE={ 'flush_interval': 3600, 'flush_size': 100000 },
+                   MOXIE_MBH_BUFFER={ 'flush_interval': 3600, 'flush_size': 100000 },
+                   MOXIE_PERSIST_CHECKPOINT={ 'interval': 3600, 'linger': 3600 })
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.schedule = MoxieSchedule.objects.create(name='default', schedule=_SCHEDULE)
+
+    def setUp(self):
+        self.robot_data = RobotData()
+
+    def tearDown(self):
+        self.robot_data.shutdown()
+
+    @contextlib.contextmanager
+    def assertMaxQueries(self, limit):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        self.assertLessEqual(len(context), limit, 'Queries:\n' + '\n'.join(q['sql'] for q in context.captured_queries))
+
+    def make_devices(self, count, prefix='d_budget'):
+        return MoxieDevice.objects.bulk_create([ MoxieDevice(device_id=f'{prefix}_{i}', schedule=self.schedule, last_connect=timezone.now())
+                                                 for i in range(count) ])
+
+    def make_mbh(self, device, count):
+        MentorBehavior.objects.bulk_create([ MentorBehavior(device=device, module_id='DM', content_id=f'cid_{i}', timestamp=1700000000000 + i,
+                                                            action='COMPLETED', instance_id=i) for i in range(count) ])
+
+    def test_connect_new_device(self):
+        # counts include transaction savepoints
+        with self.assertMaxQueries(13):
+            self.robot_data.db_connect('d_budget_new')
+        self.assertTrue(self.robot_data.device_online('d_budget_new'))
+
+    def test_connect_does_not_scale_with_history(self):
+        device = self.make_devices(1)[0]
+        self.make_mbh(device, 200)
+        with self.assertMaxQueries(10):
+            self.robot_data.db_connect(device.device_id)
+        self.assertEqual(len(self.robot_data.get_mbh(device.device_id)), 200)
+
+    def test_warm_start_and_connect(self):
+        devices = self.make_devices(30)
+        for device in devices[:5]:
+            self.make_mbh(device, 10)
+        with self.assertMaxQueries(6):
+            self.assertEqual(self.robot_data.warm_start(), 30)
+        with self.assertMaxQueries(0):
+            for device in devices:
+                self.robot_data.db_connect(device.device_id)
+
+    def test_warm_start_owned(self):
+        devices = self.make_devices(10)
+        self.robot_data.db_connect(devices[0].device_id)
+        # robots already connected, or owned by another worker, aren't loaded
+        owned = set(d.device_id for d in devices[::2])
+        self.assertEqual(self.robot_data.warm_start(owns=owned.__contains__), 4)
+        self.robot_data.drop_warm(lambda device_id: device_id != devices[2].device_id)
+        self.assertEqual(self.robot_data.warm_metrics()['pending'], 3)
+
+    def test_state_put_and_flush(self):
+        devices = self.make_devices(30)
+        for device in devices:
+            self.robot_data.db_connect(device.device_id)
+        with self.assertMaxQueries(0):
+            for device in devices:
+                self.robot_data.put_state(device.device_id, { 'battery_level': 80 })
+        with self.assertMaxQueries(4):
+            self.robot_data.shutdown()
+        self.assertEqual(MoxieDevice.objects.filter(state__battery_level=80).count(), 30)
+
+    def test_mbh_get_and_insert(self):
+        devices = self.make_devices(10)
+        for device in devices:
+            self.robot_data.db_connect(device.device_id)
+        with self.assertMaxQueries(0):
+            for i, device in enumerate(devices * 5):
+                self.robot_data.add_mbh(device.device_id, { 'module_id': 'DM', 'content_id': f'cid_{i}', 'timestamp': 1700000000000 + i,
+                                                            'action': 'COMPLETED', 'instance_id': i })
+            count, payload = self.robot_data.get_mbh_payload(devices[0].device_id)
+        self.assertEqual(count, 5)
+        with self.assertMaxQueries(3):
+            self.robot_data.shutdown()
+        self.assertEqual(MentorBehavior.objects.count(), 50)
+
+    def test_mbh_get_offline(self):
+        device = self.make_devices(1)[0]
+        self.make_mbh(device, 100)
+        with self.assertMaxQueries(3):
+            self.assertEqual(len(self.robot_data.get_mbh(device.device_id)), 100)
+
+    def test_schedule_expand(self):
+        device = self.make_devices(1)[0]
+        self.make_mbh(device, 50)
+        self.robot_data.db_connect(device.device_id)
+        # first time user experience checks count completions in the MBH index
+        with self.assertMaxQueries(0):
+            schedule = self.robot_data.get_schedule(device.device_id)
+            self.robot_data.add_mbh(device.device_id, { 'module_id': 'TNT', 'content_id': 'tnt_1', 'timestamp': 1800000000000,
+                                                        'action': 'COMPLETED', 'instance_id': 1 })
+            self.robot_data.get_schedule(device.device_id)
+        self.assertIn('provided_schedule', schedule)
+        self.assertNotIn('WELCOME', [ m['module_id'] for m in schedule['provided_schedule'] ])
+
+    def test_prepared_schedule(self):
+        device = self.make_devices(1)[0]
+        self.robot_data.db_connect(device.device_id)
+        self.robot_data.prepare_schedule(device.device_id)
+        with self.assertMaxQueries(0):
+            payload = self.robot_data.take_schedule_payload(device.device_id)
+        self.assertIn('provided_schedule', codec.loads(payload))
+        # used once, the next session gets a fresh schedule
+        self.robot_data.take_schedule_payload(device.device_id)
+        self.assertEqual(self.robot_data.schedule_metrics(), { 'prepared': 1, 'hits': 1, 'misses': 1 })
+
+    def test_schedule_expand_offline(self):
+        device = self.make_devices(1)[0]
+        self.make_mbh(device, 50)
+        with self.assertMaxQueries(3):
+            self.robot_data.get_schedule(device.device_id)
+
+    def test_ftue_counts_consistency(self):
+        device = self.make_devices(1)[0]
+        self.robot_data.db_connect(device.device_id)
+        self.robot_data.add_mbh(device.device_id, { 'module_id': 'TNT', 'content_id': 'tnt_1', 'timestamp': 1800000000000,
+                                                    'action': 'COMPLETED', 'instance_id': 1 })
+        self.assertTrue(self.robot_data.check_ftue_counts(device.device_id))
+        # rows written behind the index's back
+        self.make_mbh(device, 5)
+        self.assertFalse(self.robot_data.check_ftue_counts(device.device_id))
+        self.assertTrue(self.robot_data.check_ftue_counts(device.device_id))
+        self.assertEqual(len(self.robot_data.get_mbh(device.device_id)), 6)
+
+    def test_mbh_reported_while_loading(self):
+        device = self.make_devices(1)[0]
+        self.make_mbh(device, 3)
+        # seen, and not loaded yet
+        self.assertTrue(self.robot_data.connect_init_needed(device.device_id))
+        self.robot_data.add_mbh(device.device_id, { 'module_id': 'TNT', 'content_id': 'tnt_1', 'timestamp': 1800000000000,
+                                                    'action': 'COMPLETED', 'instance_id': 1 })
+        self.robot_data.db_connect(device.device_id)
+        self.assertEqual(len(self.robot_data.get_mbh(device.device_id)), 4)
+        self.robot_data.shutdown()
+        self.assertEqual(MentorBehavior.objects.filter(device=device).count(), 4)
+
+    def test_dashboard_render(self):
+        server = MoxieServer(RobotCredentials(True), self.robot_data, 'openmoxie', 'localhost', 1883, transport=InMemoryTransport())
+        previous, moxie_server._MOXIE_SERVICE_INSTANCE = moxie_server._MOXIE_SERVICE_INSTANCE, server
+        try:
+            self.make_devices(5)
+            with CaptureQueriesContext(connection) as few:
+                self.assertEqual(self.client.get(reverse('hive:dashboard')).status_code, 200)
+            self.make_devices(50, prefix='d_budget_more')
+            with self.assertMaxQueries(len(few)):
+                self.assertEqual(self.client.get(reverse('hive:dashboard')).status_code, 200)
+        finally:
+            moxie_server._MOXIE_SERVICE_INSTANCE = previous
+            server.timers().stop()
+            server.publisher().stop()
+            server.dispatcher().shutdown()
+
+@override_settings(MOXIE_STATE_STORE={ 'flush_interval': 3600, 'flush_size': 100000 },
+                   MOXIE_MBH_BUFFER={ 'flush_interval': 3600, 'flush_size': 100000 },
+                   MOXIE_PERSIST_CHECKPOINT={ 'interval': 3600, 'linger': 3600 })
+class WriteBehindTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.schedule = MoxieSchedule.objects.create(name='default', schedule=_SCHEDULE)
+
+    def make_device(self, device_id):
+        return MoxieDevice.objects.create(device_id=device_id, schedule=self.schedule)
+
+    def test_state_retried_after_error(self):
+        store = StateStore({ 'flush_interval': 3600, 'flush_size': 100000 })
+        self.addCleanup(store.stop)
+        self.make_device('d_wb_1')
+        self.make_device('d_wb_2')
+        store.put('d_wb_1', { 'battery_level': 50 })
+        store.put('d_wb_2', { 'battery_level': 70 })
+        def failing_write(batch, connects):
+            # a newer report arrives while the failed batch is being written
+            store.put('d_wb_1', { 'battery_level': 40 })
+            raise DatabaseError('database is locked')
+        with mock.patch.object(store, '_write', side_effect=failing_write):
+            self.assertEqual(store.flush(), 0)
+        m = store.metrics()
+        self.assertEqual((m['errors'], m['pending']), (1, 2))
+        self.assertEqual(store.flush(), 2)
+        self.assertEqual(store.metrics()['pending'], 0)
+        levels = dict(MoxieDevice.objects.filter(device_id__startswith='d_wb_').values_list('device_id', 'state__battery_level'))
+        self.assertEqual(levels, { 'd_wb_1': 40, 'd_wb_2': 70 })
+
+    def test_checkpoint_on_release(self):
+        checkpointer = PersistCheckpointer({ 'interval': 3600, 'linger': 3600 })
+        self.addCleanup(checkpointer.stop)
+        recs = []
+        for device_id in [ 'd_wb_changed', 'd_wb_same' ]:
+            persist = PersistentData.objects.create(device=self.make_device(device_id), data={ 'count': 1 })
+            rec = DeviceRecord(device_id)
+            rec.persist_pk = persist.pk
+            rec.persist = { 'count': 1 }
+            checkpointer.track(rec)
+            recs.append(rec)
+        # changed without a touch, so only the release writes it
+        recs[0].persist['count'] = 2
+        self.assertEqual(checkpointer.checkpoint(), 0)
+        for rec in recs:
+            checkpointer.release(rec)
+        m = checkpointer.metrics()
+        self.assertEqual((m['written'], m['tracked']), (1, 0))
+        data = dict(PersistentData.objects.values_list('device__device_id', 'data__count'))
+        self.assertEqual(data, { 'd_wb_changed': 2, 'd_wb_same': 1 })
+
+    def test_mbh_flushed_before_read(self):
+        robot_data = RobotData()
+        self.addCleanup(robot_data.shutdown)
+        self.make_device('d_wb_offline')
+        robot_data.add_mbh('d_wb_offline', { 'module_id': 'DM', 'content_id': 'cid', 'timestamp': 1700000000000,
+                                             'action': 'COMPLETED', 'instance_id': 1 })
+        self.assertEqual(robot_data.mbh_metrics()['pending'], 1)
+        self.assertEqual(MentorBehavior.objects.count(), 0)
+        # offline reads come from the database, after writing what is buffered
+        self.assertEqual([ m['content_id'] for m in robot_data.get_mbh('d_wb_offline') ], [ 'cid' ])
+        self.assertEqual(robot_data.mbh_metrics()['pending'], 0)
+        count, _ = robot_data.get_mbh_payload('d_wb_offline')
+        self.assertEqual(count, 1)
+
+    def test_mbh_without_timestamp(self):
+        robot_data = RobotData()
+        self.addCleanup(robot_data.shutdown)
+        self.make_device('d_wb_no_ts')
+        robot_data.db_connect('d_wb_no_ts')
+        robot_data.add_mbh('d_wb_no_ts', { 'module_id': 'DM', 'content_id': 'cid', 'action': 'COMPLETED', 'instance_id': 1 })
+        self.assertEqual(robot_data.get_mbh('d_wb_no_ts'), [])
+        mbh = MbhIndex()
+        mbh.add({ 'module_id': 'DM', 'content_id': 'cid', 'timestamp': None, 'action': 'COMPLETED', 'instance_id': 1 })
+        self.assertEqual(len(mbh), 0)
+
+    def test_mbh_bad_record_dropped(self):
+        buffer = MbhBuffer({ 'flush_interval': 3600, 'flush_size': 100000 })
+        self.addCleanup(buffer.stop)
+        devices = [ self.make_device('d_wb_good'), self.make_device('d_wb_mixed') ]
+        def mbh(i, **fields):
+            return dict({ 'module_id': 'DM', 'content_id': f'cid_{i}', 'timestamp': 1700000000000 + i, 'action': 'COMPLETED', 'instance_id': i }, **fields)
+        # refused up front, instance_id is NOT NULL
+        self.assertFalse(buffer.put('d_wb_mixed', devices[1].pk, mbh(0, instance_id=None)))
+        buffer.put('d_wb_good', devices[0].pk, mbh(1))
+        buffer.put('d_wb_mixed', devices[1].pk, mbh(2))
+        # only fails when written
+        buffer.put('d_wb_mixed', devices[1].pk, mbh(3, timestamp='soon'))
+        buffer.put('d_wb_mixed', devices[1].pk, mbh(4))
+        self.assertEqual(buffer.flush(), 3)
+        m = buffer.metrics()
+        self.assertEqual((m['written'], m['rejected'], m['errors'], m['pending']), (3, 2, 1, 0))
+        self.assertEqual(sorted(MentorBehavior.objects.values_list('content_id', flat=True)), [ 'cid_1', 'cid_2', 'cid_4' ])
+        # nothing left to hold back later flushes
+        buffer.put('d_wb_mixed', devices[1].pk, mbh(5))
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.metrics()['errors'], 1)
+
+class ScheduleGeneratorTests(SimpleTestCase):
+    SEEDS = range(100)
+
+    def category(self, module):
+        return module.get('category', 'User')
+
+    def each_schedule(self, **kwargs):
+        for seed in self.SEEDS:
+            for count in range(1, len(RECOMMENDABLE_MODULES) + 2):
+                yield count, select_modules(RECOMMENDABLE_MODULES, count, rng=random.Random(seed), **kwargs)
+
+    def test_length_and_unique(self):
+        for count, modules in self.each_schedule():
+            self.assertEqual(len(modules), min(count, len(RECOMMENDABLE_MODULES)))
+            self.assertEqual(len(set(m['module_id'] for m in modules)), len(modules))
+
+    def test_no_adjacent_category(self):
+        for count, modules in self.each_schedule():
+            for a, b in zip(modules, modules[1:]):
+                self.assertNotEqual(self.category(a), self.category(b), modules)
+
+    def test_category_spread(self):
+        available = {}
+        for module in RECOMMENDABLE_MODULES:
+            available[self.category(module)] = available.get(self.category(module), 0) + 1
+        for count, modules in self.each_schedule():
+            used = dict.fromkeys(available, 0)
+            for module in modules:
+                used[self.category(module)] += 1
+            # a category is used again only once every category with modules left has been used as often
+            open_counts = [ n for cat, n in used.items() if n < available[cat] ]
+            if open_counts:
+                self.assertLessEqual(max(used.values()) - min(open_counts), 1, used)
+
+    def test_seed_is_repeatable(self):
+        for count in range(1, len(RECOMMENDABLE_MODULES) + 1):
+            self.assertEqual(select_modules(RECOMMENDABLE_MODULES, count, rng=random.Random(count)),
+                             select_modules(RECOMMENDABLE_MODULES, count, rng=random.Random(count)))
+        schedule = dict(_SCHEDULE, generate=dict(_SCHEDULE['generate'], seed=7))
+        self.assertEqual(expand_schedule(schedule, 'd_seed', (0, 0, 0)), expand_schedule(schedule, 'd_seed', (0, 0, 0)))
+
+    def test_weights_recency_and_exclusions(self):
+        excluded = { 'AFFIRM', 'AB' }
+        for count, modules in self.each_schedule(excluded=excluded):
+            self.assertFalse(excluded.intersection(m['module_id'] for m in modules))
+        # the first round has one module per category, its best scoring one
+        for count, modules in self.each_schedule(weights={ 'JOKE': 5.0 }, recency={ 'ANIMALEXERCISE': 3.0 }):
+            ids = [ m['module_id'] for m in modules[:8] ]
+            if count >= 8:
+                self.assertIn('JOKE', ids)
+                self.assertIn('DANCE', ids)
+            self.assertNotIn('ANIMALEXERCISE', ids)
+
+    def test_recency_penalties(self):
+        now = 1800000000000
+        day = 24 * 3600 * 1000
+        mbh = MbhIndex()
+        for i, (module_id, age) in enumerate([ ('JOKE', 0), ('AB', 30 * day) ] + [ ('AFFIRM', day * i) for i in range(10) ]):
+            mbh.add({ 'module_id': module_id, 'content_id': f'cid_{i}', 'timestamp': now - age, 'action': 'COMPLETED', 'instance_id': i })
+        mbh.add({ 'module_id': 'READ', 'content_id': 'cid', 'timestamp': now, 'action': 'ABORTED', 'instance_id': 0 })
+        self.assertEqual(mbh.completions('JOKE'), (1, now))
+        self.assertEqual(mbh.completions('READ'), (0, None))
+        penalties = recency_penalties(mbh, now=now)
+        # recently completed modules, and the most played category, sink
+        self.assertGreater(penalties['JOKE'], penalties['FF'])
+        self.assertGreater(penalties['AFFIRM'], penalties['AB'])
+        self.assertGreater(penalties['BODYSCAN'], penalties['READ'])
+        self.assertEqual(penalties['READ'], 0.0)
+        for count, modules in self.each_schedule(recency=penalties):
+            self.assertNotIn('JOKE', [ m['module_id'] for m in modules[:8] ])
+            self.assertNotIn('AFFIRM', [ m['module_id'] for m in modules[:8] ])
+            if count < 8:
+                self.assertNotIn('REGULATION', [ self.category(m) for m in modules ])
+
+class WavTests(SimpleTestCase):
+    def test_frames_round_trip(self):
+        frames = [ os.urandom(size) for size in [ 640 ] * 300 + [ 70000, 1, 2 ] ]
+        audio = AudioBuffer()
+        for frame in frames:
+            audio.append(frame)
+        pcm = b''.join(frames)
+        self.assertEqual(len(audio), len(pcm))
+        wav_bytes = audio.wav_bytes()
+        self.assertEqual(len(wav_bytes), WAV_HEADER_SIZE + len(pcm) - 1)
+        with wave.open(io.BytesIO(wav_bytes)) as reader:
+            self.assertEqual((reader.getnchannels(), reader.getsampwidth(), reader.getframerate()), (1, 2, 16000))
+            # the odd trailing byte is not a whole sample
+            self.assertEqual(reader.readframes(reader.getnframes()), pcm[:-1])
+
+    def test_empty_frames(self):
+        audio = AudioBuffer()
+        self.assertEqual(audio.append(b''), 0)
+        with wave.open(io.BytesIO(audio.wav_bytes())) as reader:
+            self.assertEqual(reader.getnframes(), 0)
+        audio.append(b'\x01\x02')
+        self.assertEqual(audio.append(b''), 2)
+        self.assertEqual(audio.wav_bytes()[WAV_HEADER_SIZE:], b'\x01\x02')
+
+    def test_reader_blocks_and_seek(self):
+        audio = AudioBuffer()
+        for _ in range(500):
+            audio.append(os.urandom(640))
+        reader = audio.wav_reader()
+        size = reader.seek(0, os.SEEK_END)
+        reader.seek(0)
+        blocks = []
+        while block := reader.read(65536):
+            blocks.append(block)
+        self.assertEqual(size, WAV_HEADER_SIZE + 500 * 640)
+        self.assertEqual(b''.join(blocks), audio.wav_bytes())
+        reader.seek(10)
+        buffer = bytearray(100)
+        self.assertEqual(reader.readinto(buffer), 100)
+        self.assertEqual(bytes(buffer), audio.wav_bytes()[10:110])
+
+class PublisherTests(SimpleTestCase):
+    def test_early_acks_reconciled(self):
+        # the in-memory transport acks inside publish(), before the mid is returned
+        publisher = OutboundPublisher(InMemoryTransport(), { 'qos': 1 })
+        for i in range(50):
+            publisher.publish(f'/devices/d_pub/commands/c{i}', { 'i': i })
+        publisher.stop()
+        m = publisher.metrics()
+        self.assertEqual((m['published'], m['acked'], m['unacked'], m['early_acks']), (50, 50, 0, 0))
+
+    def test_unacked_expire(self):
+        transport = InMemoryTransport()
+        publisher = OutboundPublisher(transport, { 'qos': 1, 'ack_timeout': 0.05 })
+        # acks lost on the way back
+        transport.on_publish = None
+        publisher.publish('/devices/d_pub/commands/lost', {})
+        deadline = time.monotonic() + 5
+        while publisher.metrics()['ack_expired'] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        publisher.stop()
+        self.assertEqual(publisher.metrics()['unacked'], 0)
+        self.assertEqual(publisher.metrics()['ack_expired'], 1)
+
+    def test_network_thread_never_waits(self):
+        transport = InMemoryTransport()
+        release = threading.Event()
+        transport.publish_hook = lambda msg: release.wait(5)
+        publisher = OutboundPublisher(transport, { 'max_queue': 1, 'enqueue_timeout': 5.0 })
+        try:
+            publisher.publish('/devices/d_pub/commands/stuck', {})
+            publisher.publish('/devices/d_pub/commands/full', {})
+            deadline = time.monotonic() + 5
+            while publisher.queue_depth() < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # handling a message from the network thread, or on an event loop
+            async def on_loop():
+                return publisher.publish('/devices/d_pub/commands/shed', {})
+            start = time.monotonic()
+            with no_wait():
+                self.assertFalse(publisher.publish('/devices/d_pub/commands/shed', {}))
+            self.assertFalse(asyncio.run(on_loop()))
+            self.assertLess(time.monotonic() - start, 1.0)
+            self.assertEqual(publisher.metrics()['dropped'], 2)
+        finally:
+            release.set()
+            publisher.stop()
+
+class DeviceRegistryTests(SimpleTestCase):
+    def test_deferred_work_runs_before_new_work(self):
+        registry = DeviceRegistry()
+        rec, _ = registry.begin_connect('d_reg')
+        order = []
+        deferred = []
+        def first():
+            order.append('first')
+            # work arriving while deferred work is handed off queues behind it
+            deferred.append(registry.when_loaded('d_reg', order.append, 'second'))
+        self.assertTrue(registry.when_loaded('d_reg', first))
+        registry.mark_loaded(rec)
+        self.assertEqual(deferred, [ True ])
+        self.assertTrue(rec.is_loaded)
+        self.assertFalse(registry.when_loaded('d_reg', order.append, 'third'))
+        self.assertEqual(order, [ 'first', 'second', 'third' ])
+
+    def test_deferred_work_runs_when_load_fails(self):
+        registry = DeviceRegistry()
+        rec, _ = registry.begin_connect('d_reg')
+        ran = []
+        registry.when_loaded('d_reg', ran.append, 'deferred')
+        # what wait_loaded blocks on
+        loaded = rec.loaded
+        registry.mark_failed(rec, RuntimeError('load failed'))
+        self.assertEqual(ran, [ 'deferred' ])
+        self.assertIsInstance(loaded.exception(0), RuntimeError)
+        self.assertIsNone(registry.get('d_reg'))
+        # the next message retries with a new record
+        retry, new = registry.begin_connect('d_reg')
+        self.assertTrue(new)
+        self.assertIsNot(retry, rec)
+
+    def test_release_while_connecting(self):
+        registry = DeviceRegistry()
+        rec, _ = registry.begin_connect('d_reg')
+        ran = []
+        self.assertTrue(registry.when_loaded('d_reg', ran.append, 'deferred'))
+        self.assertIs(registry.begin_release('d_reg'), rec)
+        self.assertIsNone(registry.begin_release('d_reg'))
+        # nothing new waits on a releasing record
+        self.assertFalse(registry.when_loaded('d_reg', ran.append, 'immediate'))
+        self.assertTrue(registry.wait_loaded('d_reg', 0))
+        self.assertFalse(registry.is_online('d_reg'))
+        # the load finishing late still hands off deferred work, and doesn't revive the record
+        registry.mark_loaded(rec)
+        self.assertEqual(ran, [ 'immediate', 'deferred' ])
+        self.assertEqual(rec.status, RELEASING)
+        reconnect, new = registry.begin_connect('d_reg')
+        self.assertTrue(new)
+        registry.remove(rec)
+        self.assertIs(registry.get('d_reg'), reconnect)
+
+class DispatcherTests(SimpleTestCase):
+    def test_per_device_order(self):
+        dispatcher = DeviceDispatcher({ INTERACTIVE: 4, BACKGROUND: 1 })
+        self.addCleanup(dispatcher.shutdown)
+        devices = [ f'd_lane_{i}' for i in range(100) ]
+        self.assertEqual(set(lane_index(d, 4) for d in devices), set(range(4)))
+        seen = { d: [] for d in devices }
+        def work(device_id, seq):
+            if random.random() < 0.01:
+                time.sleep(0.001)
+            seen[device_id].append(seq)
+        futures = [ dispatcher.submit(d, work, d, seq) for seq in range(20) for d in devices ]
+        for future in futures:
+            future.result(5)
+        for device_id in devices:
+            self.assertEqual(seen[device_id], list(range(20)), device_id)
+
+    def test_blocked_lane_holds_only_its_devices(self):
+        dispatcher = DeviceDispatcher({ INTERACTIVE: 4, BACKGROUND: 1 })
+        release = threading.Event()
+        self.addCleanup(dispatcher.shutdown)
+        self.addCleanup(release.set)
+        blocked = 'd_lane_0'
+        other = next(f'd_lane_{i}' for i in range(1, 100) if lane_index(f'd_lane_{i}', 4) != lane_index(blocked, 4))
+        stuck = dispatcher.submit(blocked, release.wait, 5)
+        behind = dispatcher.submit(blocked, lambda: 'behind')
+        self.assertEqual(dispatcher.submit(other, lambda: 'other').result(5), 'other')
+        self.assertFalse(behind.done())
+        release.set()
+        self.assertTrue(stuck.result(5))
+        self.assertEqual(behind.result(5), 'behind')
+
+    def test_submits_counted_from_every_thread(self):
+        dispatcher = DeviceDispatcher({ INTERACTIVE: 1, BACKGROUND: 1 })
+        def submitter():
+            for _ in range(500):
+                dispatcher.submit('d_lane_count', int)
+        threads = [ threading.Thread(target=submitter) for _ in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        # drains the lanes
+        dispatcher.shutdown()
+        m = dispatcher.metrics()[INTERACTIVE]
+        self.assertEqual((m['submitted'], m['completed']), (4000, 4000))
+
+    def test_full_lane(self):
+        dispatcher = DeviceDispatcher({ INTERACTIVE: 1, BACKGROUND: 1 }, { INTERACTIVE: 1, BACKGROUND: 1 })
+        release = threading.Event()
+        self.addCleanup(dispatcher.shutdown)
+        self.addCleanup(release.set)
+        running = [ dispatcher.submit('d_full', release.wait, 5, work_class=wc) for wc in [ INTERACTIVE, BACKGROUND ] ]
+        deadline = time.monotonic() + 5
+        while any(d for d in dispatcher.class_depths().values()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        queued = [ dispatcher.submit('d_full', int, work_class=wc) for wc in [ INTERACTIVE, BACKGROUND ] ]
+        # past the limit background work is shed, unless it must run, interactive work always runs
+        shed = dispatcher.submit('d_full', int, work_class=BACKGROUND)
+        self.assertIsInstance(shed.exception(0), WorkShed)
+        queued.append(dispatcher.submit('d_full', int, work_class=BACKGROUND, sheddable=False))
+        queued.append(dispatcher.submit('d_full', int))
+        release.set()
+        for future in running + queued:
+            future.result(5)
+        m = dispatcher.metrics()
+        self.assertEqual((m[BACKGROUND]['shed'], m[BACKGROUND]['overflow']), (1, 1))
+        self.assertEqual((m[INTERACTIVE]['shed'], m[INTERACTIVE]['overflow']), (0, 1))
+
+class AdmissionTests(SimpleTestCase):
+    def setUp(self):
+        # queue depths are read on every check
+        patcher = mock.patch.object(admission, '_DEPTH_CHECK_INTERVAL', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.depths = { INTERACTIVE: 0, BACKGROUND: 0 }
+        self.queued = []
+        # queues work without running it
+        self.dispatcher = SimpleNamespace(class_depths=lambda: dict(self.depths), submit=self.submit)
+
+    def submit(self, device_id, functor, *args, work_class=INTERACTIVE, sheddable=None):
+        self.queued.append((functor, args))
+        return Future()
+
+    def make_controller(self, **admission_settings):
+        settings = { 'interactive_high': 10, 'interactive_low': 2, 'background_high': 100, 'background_low': 20 }
+        settings.update(admission_settings)
+        return AdmissionController(self.dispatcher, settings)
+
+    def test_watermarks(self):
+        controller = self.make_controller()
+        self.depths[INTERACTIVE] = 9
+        self.assertFalse(controller.degraded())
+        self.depths[INTERACTIVE] = 10
+        self.assertTrue(controller.degraded())
+        # stays degraded until every class is back under its low watermark
+        self.depths[INTERACTIVE] = 3
+        self.assertTrue(controller.degraded())
+        self.depths[BACKGROUND] = 100
+        self.depths[INTERACTIVE] = 2
+        self.assertTrue(controller.degraded())
+        self.depths[BACKGROUND] = 20
+        self.assertFalse(controller.degraded())
+        self.depths[BACKGROUND] = 100
+        self.assertTrue(controller.degraded())
+        self.assertEqual(controller.metrics()['degraded_count'], 2)
+
+    def test_sample_rate(self):
+        controller = self.make_controller(sample_rate=5)
+        self.assertTrue(all(controller.admit('device-logs') for _ in range(20)))
+        self.depths[INTERACTIVE] = 10
+        admitted = [ controller.admit('device-logs') for _ in range(20) ]
+        self.assertEqual(admitted.count(True), 4)
+        self.assertFalse(any(controller.admit('sys/clients') for _ in range(5)))
+        # unknown kinds and remote chat are never shed
+        self.assertTrue(all(controller.admit(kind) for kind in [ 'remote-chat', 'no-such-event' ]))
+        self.assertEqual(controller.metrics()['shed'], { 'device-logs': 16, 'sys/clients': 5 })
+
+    def test_latest_only(self):
+        controller = self.make_controller()
+        handled = []
+        def ingest(device_id, state):
+            handled.append((device_id, state))
+        self.assertTrue(controller.submit_latest('state', 'd_adm', ingest, b'{"n":1}', decoder=codec.loads))
+        # replaces the report not yet handled, and isn't queued again
+        self.assertFalse(controller.submit_latest('state', 'd_adm', ingest, b'{"n":2}', decoder=codec.loads))
+        self.assertTrue(controller.submit_latest('state', 'd_other', ingest, b'{"n":3}', decoder=codec.loads))
+        self.assertEqual(len(self.queued), 2)
+        for functor, args in self.queued:
+            functor(*args)
+        self.assertEqual(handled, [ ('d_adm', { 'n': 2 }), ('d_other', { 'n': 3 }) ])
+        self.assertEqual(controller.metrics()['pending_latest'], 0)
+        # past the background high watermark new reports are shed
+        self.depths[BACKGROUND] = 100
+        self.assertFalse(controller.submit_latest('state', 'd_adm', ingest, b'{"n":4}', decoder=codec.loads))
+        self.assertEqual(controller.metrics()['shed'], { 'state': 2 })
+
+    def test_latest_refused_by_full_lane(self):
+        dispatcher = DeviceDispatcher({ INTERACTIVE: 1, BACKGROUND: 1 }, { INTERACTIVE: 1, BACKGROUND: 1 })
+        release = threading.Event()
+        self.addCleanup(dispatcher.shutdown)
+        self.addCleanup(release.set)
+        controller = AdmissionController(dispatcher, {})
+        handled = []
+        dispatcher.submit('d_adm', release.wait, 5, work_class=BACKGROUND)
+        deadline = time.monotonic() + 5
+        while dispatcher.class_depths()[BACKGROUND] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        dispatcher.submit('d_adm', int, work_class=BACKGROUND)
+        self.assertFalse(controller.submit_latest('state', 'd_adm', lambda d, s: handled.append(s), b'1'))
+        # nothing is left pending, so the next report is queued once there is room
+        release.set()
+        deadline = time.monotonic() + 5
+        while dispatcher.class_depths()[BACKGROUND] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(controller.submit_latest('state', 'd_adm', lambda d, s: handled.append(s), b'2'))
+        dispatcher.shutdown()
+        self.assertEqual(handled, [ b'2' ])
+
+class TimerQueueTests(SimpleTestCase):
+    def test_cancel(self):
+        timers = TimerQueue()
+        fired = []
+        done = threading.Event()
+        handle = timers.call_later(0.05, fired.append, 'cancelled')
+        timers.call_later(0.01, fired.append, 'kept')
+        timers.call_later(0.1, done.set)
+        handle.cancel()
+        self.assertTrue(done.wait(5))
+        timers.stop()
+        self.assertEqual(fired, [ 'kept' ])
+        m = timers.metrics()
+        self.assertEqual((m['scheduled'], m['fired'], m['cancelled'], m['pending']), (3, 2, 1, 0))
+
+class ClusterTests(SimpleTestCase):
+    def setUp(self):
+        self.devices = [ f'd_ring_{i}' for i in range(2000) ]
+
+    def owners(self, ring):
+        return { device_id: ring.owner(device_id) for device_id in self.devices }
+
+    def test_single_owner(self):
+        ring = HashRing()
+        self.assertIsNone(ring.owner(self.devices[0]))
+        for worker in [ 'w1', 'w2', 'w3' ]:
+            ring.add(worker)
+        owners = self.owners(ring)
+        self.assertEqual(set(owners.values()), { 'w1', 'w2', 'w3' })
+        # any worker building the ring from the same members agrees, whatever order they joined in
+        other = HashRing()
+        for worker in [ 'w3', 'w1', 'w2' ]:
+            other.add(worker)
+        self.assertEqual(self.owners(other), owners)
+
+    def test_join_and_leave(self):
+        ring = HashRing()
+        for worker in [ 'w1', 'w2', 'w3' ]:
+            ring.add(worker)
+        before = self.owners(ring)
+        # a joining worker only takes devices, the rest keep their owner
+        self.assertTrue(ring.add('w4'))
+        joined = self.owners(ring)
+        moved = [ d for d in self.devices if joined[d] != before[d] ]
+        self.assertTrue(moved)
+        self.assertTrue(all(joined[d] == 'w4' for d in moved))
+        self.assertLess(len(moved), len(self.devices) / 2)
+        # a leaving worker's devices move, nobody else's, and the ring is as it was
+        self.assertTrue(ring.remove('w4'))
+        self.assertEqual(self.owners(ring), before)
+        ring.remove('w2')
+        left = self.owners(ring)
+        self.assertTrue(all(left[d] == before[d] for d in self.devices if before[d] != 'w2'))
+        self.assertNotIn('w2', left.values())
+        self.assertFalse(ring.remove('w2'))
+
+# Handlers run on worker threads with their own connections, so data is committed, not in a test transaction.
+# Each test gets a started server, subclasses override settings for the whole class so setUp sees them.
+@override_settings(MOXIE_AI={ 'backend': 'stub', 'llm_latency': 0 })
+class ServerTestCase(TransactionTestCase):
+    def setUp(self):
+        MoxieSchedule.objects.create(name='default', schedule=_SCHEDULE)
+        self.robot_data = RobotData()
+        self.transport = InMemoryTransport()
+        self.server = MoxieServer(RobotCredentials(True), self.robot_data, 'openmoxie', 'localhost', 1883, transport=self.transport)
+        self.server.connect(start=True)
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.timers().stop()
+        self.server.publisher().stop()
+        self.server.dispatcher().shutdown()
+        self.robot_data.shutdown()
+
+    # The first publish to a topic, waiting for it to arrive
+    def wait_published(self, topic, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for msg in list(self.transport.published):
+                if msg.topic == topic:
+                    return codec.loads(msg.payload)
+            time.sleep(0.01)
+        self.fail(f'Nothing published to {topic}')
+
+    # Wait for a condition set by work on another thread
+    def wait_until(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting')
+            time.sleep(0.01)
+
+@override_settings(MOXIE_ENGINE={ 'mode': 'asyncio' })
+class AsyncioServerTests(ServerTestCase):
+    def setUp(self):
+        # chats are loaded when the server starts
+        for content_id in [ 'first', 'second' ]:
+            SinglePromptChat.objects.create(name=content_id, module_id='OPENMOXIE_CHAT', content_id=content_id,
+                                            opener=f'Hello from {content_id}', prompt='Be brief')
+        super().setUp()
+
+    def test_router_prompt(self):
+        topic = '/devices/d_async/commands/remote_chat'
+        # the first arrives while the robot is loading, the second once it is loaded
+        for content_id in [ 'first', 'second' ]:
+            self.transport.published.clear()
+            rcr = { 'backend': 'router', 'command': 'prompt', 'event_id': content_id, 'module_id': 'OPENMOXIE_CHAT', 'content_id': content_id }
+            # delivered on the event loop, like the engine's socket reads
+            self.server.engine().call_on_loop(self.transport.inject, '/devices/d_async/events/remote-chat', codec.dumps(rcr))
+            response = self.wait_published(topic)
+            self.assertEqual(response['event_id'], content_id)
+            self.assertEqual(response['output']['text'], f'Hello from {content_id}')
+
+@override_settings(MOXIE_CLUSTER={ 'enabled': True, 'worker_id': 'w1' })
+class ClusterServerTests(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport.inject('openmoxie/cluster/openmoxie/members/w2', codec.dumps({ 'worker_id': 'w2' }))
+
+    def test_hive_updated(self):
+        HiveConfiguration.objects.create(name='default')
+        self.assertEqual(self.wait_published('openmoxie/cluster/openmoxie/control/w2'), { 'action': 'hive_updated' })
+        # and from another worker, reloaded from the database
+        invalidations = self.robot_data.config_metrics()['invalidations']
+        self.transport.inject('openmoxie/cluster/openmoxie/control/w1', codec.dumps({ 'action': 'hive_updated' }))
+        self.wait_until(lambda: self.robot_data.config_metrics()['invalidations'] > invalidations)
+
+    def test_schedule_updated(self):
+        device_id = next(f'd_sched_{i}' for i in range(100) if self.server.owns_device(f'd_sched_{i}'))
+        schedule = MoxieSchedule.objects.get(name='default')
+        MoxieDevice.objects.create(device_id=device_id, schedule=schedule)
+        self.robot_data.db_connect(device_id)
+        schedule.schedule = { 'provided_schedule': [ { 'module_id': 'TNT' } ] }
+        schedule.save()
+        self.assertEqual(self.wait_published('openmoxie/cluster/openmoxie/control/w2'),
+                         { 'action': 'schedule_updated', 'schedule_id': schedule.pk })
+        self.assertEqual(self.robot_data.get_schedule(device_id, expand=False), schedule.schedule)
+        # and edited by another worker, behind our save signal's back, after a reload dropped the cached copy
+        self.robot_data.invalidate_configs()
+        MoxieSchedule.objects.filter(pk=schedule.pk).update(schedule=_SCHEDULE)
+        self.transport.inject('openmoxie/cluster/openmoxie/control/w1', codec.dumps({ 'action': 'schedule_updated', 'schedule_id': schedule.pk }))
+        self.wait_until(lambda: self.robot_data.get_schedule(device_id, expand=False) == _SCHEDULE)
+
+class ServerTests(ServerTestCase):
+    def test_routes(self):
+        zmq = []
+        self.server.add_zmq_handler('embodied.perception.audio.zmqSTTRequest', SimpleNamespace(handle_zmq=lambda device_id, name, data: zmq.append(data)))
+        before = self.server.route_counters()
+        modules_query = { 'backend': 'data', 'query': { 'query': 'modules' }, 'event_id': 'm1' }
+        messages = [
+            ('/devices/d_route/events/remote-chat', { 'backend': 'router', 'command': 'notify', 'module_id': 'NONE', 'content_id': 'none' }, 'remote-chat/router'),
+            ('/devices/d_route/events/remote-chat', modules_query, 'remote-chat/data/modules'),
+            ('/devices/d_route/events/remote-chat-staging', modules_query, 'remote-chat/data/modules'),
+            # deeper event topics are routed by their event name
+            ('/devices/d_route/events/remote-chat/extra', modules_query, 'remote-chat/data/modules'),
+            ('/devices/d_route/events/client-service-activity-log', { 'subtopic': 'query', 'query': 'schedule', 'request_id': 's1' },
+             'client-service-activity-log/query/schedule'),
+            ('/devices/d_route/events/client-service-activity-log', { 'subtopic': 'query', 'query': 'mentor_behaviors', 'request_id': 'b1' },
+             'client-service-activity-log/query/mentor_behaviors'),
+            ('/devices/d_route/events/client-service-activity-log', { 'subtopic': 'query', 'query': 'license', 'request_id': 'l1' },
+             'client-service-activity-log/query/license'),
+            ('/devices/d_route/events/client-service-activity-log', { 'mentor_behavior': { 'module_id': 'TNT', 'content_id': 'tnt', 'timestamp': 1800000000000,
+                                                                                           'action': 'COMPLETED', 'instance_id': 1 } },
+             'client-service-activity-log/mentor_behavior'),
+            ('/devices/d_route/events/client-service-activity-log', { 'subtopic': 'telehealth', 'message': { 'state': 'idle' } },
+             'client-service-activity-log/telehealth'),
+            ('/devices/d_route/events/zmq', b'embodied.perception.audio.zmqSTTRequest:audio', 'zmq/embodied.perception.audio.zmqSTTRequest'),
+            ('/devices/d_route/events/device-logs', { 'tag': 'test', 'message': 'hello' }, 'device-logs'),
+            ('$SYS/broker/clients/connected', b'3', 'sys/clients'),
+        ]
+        for topic, payload, route in messages:
+            self.transport.inject(topic, payload if isinstance(payload, bytes) else codec.dumps(payload))
+        expected = {}
+        for topic, payload, route in messages:
+            expected[route] = expected.get(route, 0) + 1
+        expected['events'] = sum(1 for m in messages if '/events/' in m[0])
+        after = self.server.route_counters()
+        for route, count in expected.items():
+            self.assertEqual(after[route] - before.get(route, 0), count, route)
+        self.assertEqual(zmq, [ b'audio' ])
+        self.assertEqual(self.wait_published('/devices/d_route/commands/remote_chat')['event_id'], 'm1')
+        self.assertEqual(self.wait_published('/devices/d_route/commands/query_result')['request_id'], 's1')
+        self.wait_until(lambda: len(self.server.robot_data().get_mbh('d_route')) == 1)
+
+        # connects and disconnects from the broker log
+        self.transport.inject('$SYS/broker/log/N', 'New client connected from 10.0.0.2:1234 as d_abc123 (p2, c1, k60).')
+        self.wait_until(lambda: self.server.robot_data().device_online('d_abc123'))
+        self.transport.inject('$SYS/broker/log/N', 'Client d_abc123 closed its connection.')
+        self.wait_until(lambda: not self.server.robot_data().device_online('d_abc123'))
+        self.assertEqual(self.server.route_counters()['sys/log'] - before.get('sys/log', 0), 2)
+
+        # anything else is counted and ignored
+        self.transport.inject('/devices/d_route/events/no-such-event', b'{}')
+        self.transport.inject('/devices/d_route/events', b'{}')
+        self.transport.inject('some/other/topic', b'{}')
+        after = self.server.route_counters()
+        self.assertEqual(after['unmatched_events'] - before['unmatched_events'], 1)
+        self.assertEqual(after['unmatched_topics'] - before['unmatched_topics'], 2)
@@ -9,6 +9,7 @@ urlpatterns = [
     path('hive_configure/', views.hive_configure, name='hive_configure'),
     path("dashboard", views.DashboardView.as_view(), name="dashboard"),
     path('dashboard/<str:alert_message>/', views.DashboardView.as_view(), name='dashboard_alert'),
+    path("metrics", views.metrics, name="metrics"),
     path("interact/<int:pk>", views.InteractionView.as_view(), name="interact"),
     path("interact_update", views.interact_update, name="interact_update"),
     path("reload_database", views.reload_database, name="reload_database"),
@@ -19,6 +19,7 @@ from .data_import import update_import_status, import_content
 from .mqtt.moxie_server import get_instance
 from .mqtt.robot_data import DEFAULT_ROBOT_CONFIG, DEFAULT_ROBOT_SETTINGS
 from .mqtt.volley import Volley
+from .mqtt.metrics import REGISTRY as METRICS
 import json
 import uuid
 import logging
@@ -91,12 +92,17 @@ class DashboardView(generic.TemplateView):
         alert_message = kwargs.get('alert_message', None)
         if alert_message:
             context['alert'] = alert_message
-        context['recent_devices'] = MoxieDevice.objects.all()
+        context['recent_devices'] = MoxieDevice.objects.select_related('schedule')
         context['conversations'] = SinglePromptChat.objects.all()
         context['schedules'] = MoxieSchedule.objects.all()
-        context['live'] = get_instance().robot_data().connected_list()
+        context['live'] = set(get_instance().robot_data().connected_list())
+        context['performance'] = METRICS.summary()
         return context
 
+# METRICS - Service latency histograms in Prometheus text format
+def metrics(request):
+    return HttpResponse(METRICS.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # INTERACT - Chat with a remote conversation
 class InteractionView(generic.DetailView):
     template_name = "hive/interact.html"
@@ -294,6 +300,8 @@ class MoxieMissionsView(generic.DetailView):
 def mission_edit(request, pk):
     try:
         device = MoxieDevice.objects.get(pk=pk)
+        # write any buffered reports before changing them
+        get_instance().robot_data().flush_mbh(device.device_id)
 
         mission_action = request.POST["mission_action"]
         if mission_action == "reset":
@@ -312,6 +320,8 @@ def mission_edit(request, pk):
                 # Create new completions for all these mission content IDs
                 get_instance().robot_data().add_mbh_completion_bulk(device.device_id, module_id="DM", content_id_list=dm_cid_list)
                 msg = f'Completed {len(mission_sets)} Daily Mission Sets ({len(dm_cid_list)} missions) for {device}'
+        # the robot's history is cached while it is connected
+        get_instance().handle_mbh_updated(device)
 
         return redirect('hive:dashboard_alert', alert_message=msg)
     except MoxieDevice.DoesNotExist as e:
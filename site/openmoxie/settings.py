@@ -102,6 +102,88 @@ MQTT_ENDPOINT = {
     'port': 8883,
     'project': 'openmoxie',
     'cert_required': False,
+    # 'tls': False connects over plain TCP, only for local test brokers
+}
+
+# AI backend for chat and speech.  'stub' replaces OpenAI with canned results after a fixed
+# latency (seconds), for load testing with manage.py simulate_fleet
+MOXIE_AI = {
+    'backend': 'openai',
+    'llm_latency': 0.8,
+    'stt_latency': 0.4,
+}
+
+# Worker lanes for device work.  Work for one device always runs in order on one lane,
+# interactive (volleys, schedules, STT) and background (state, MBH ingest) are separate.
+# Past max_queue, background work that may be shed is refused, other work is counted as overflow.
+MOXIE_DISPATCHER = {
+    'interactive_lanes': 8,
+    'background_lanes': 2,
+    'interactive_max_queue': 4000,
+    'background_max_queue': 10000,
+}
+
+# MQTT engine.  'threaded' uses the paho network thread and the dispatcher lanes above,
+# 'asyncio' drives MQTT from an event loop with bounded executors for database and AI work
+MOXIE_ENGINE = {
+    'mode': 'threaded',
+    'db_workers': 4,
+    'ai_workers': 32,
+    'interactive_max_queue': 4000,
+    'background_max_queue': 10000,
+}
+
+# Outbound messages to robots, queued and published from one thread.  qos 1 tracks broker acks.
+MOXIE_PUBLISHER = {
+    'max_queue': 10000,
+    'qos': 0,
+}
+
+# Load shedding.  Past the high watermark of queued work for a class the server is degraded,
+# device logs are sampled (1 in sample_rate) and broker metrics dropped until it drops under
+# low.  Remote chat and queries are never shed, only the newest state per device is kept.
+MOXIE_ADMISSION = {
+    'interactive_high': 200,
+    'interactive_low': 50,
+    'background_high': 2000,
+    'background_low': 500,
+    'sample_rate': 20,
+}
+
+# Robot state reports are kept in memory and written in batches, every flush_interval seconds
+# or once flush_size devices have unwritten state.  Disconnects and shutdown write right away.
+MOXIE_STATE_STORE = {
+    'flush_interval': 5.0,
+    'flush_size': 500,
+}
+
+# Mentor behavior reports are buffered and inserted in batches, every flush_interval seconds or
+# once flush_size are waiting.  Reading them from the database, disconnects and shutdown write first.
+MOXIE_MBH_BUFFER = {
+    'flush_interval': 1.0,
+    'flush_size': 200,
+}
+
+# Changed robot PersistentData is saved every interval seconds.  Data handed to a volley is
+# checked for changes until linger seconds later.  Disconnects and shutdown save right away.
+MOXIE_PERSIST_CHECKPOINT = {
+    'interval': 10.0,
+    'linger': 60.0,
+}
+
+# At startup, robots connected within recent_days are loaded in bulk so their reconnects need
+# no queries.  Data a robot hasn't claimed after ttl seconds is dropped.  0 disables it.
+MOXIE_WARM_START = {
+    'recent_days': 30,
+    'ttl': 600.0,
+}
+
+# Clustered mode, many worker processes (manage.py mqtt_worker) split the devices between
+# them by consistent hash.  worker_id defaults to host-pid.  See doc/Cluster.md
+MOXIE_CLUSTER = {
+    'enabled': False,
+    'group': 'openmoxie',
+    'vnodes': 128,
 }
 
 BOOTSTRAP5 = {